@@ -1,5 +1,5 @@
 import re
-from typing import Callable
+from typing import Callable, List
 import pathlib
 import logging
 
@@ -7,18 +7,26 @@ import uvicorn
 from fastapi import FastAPI, Depends, HTTPException, status, Request, Query
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from starlette.routing import Mount
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from sqlalchemy.log import rootlogger
 
-from src.database.db import get_db
+from src.database.db import get_db, DBSession
 from src.routes import auth, users, myuser, photos
 from src.conf.config import BASE_DIR
 from src.conf import messages
-from src.services.custom_limiter import RateLimiter
+from src.services.custom_limiter import RateLimiter, request_counters
 from src.services.custom_json import Jsons
+from src.services.auth_context import get_user_context
+from src.services.page_cache import page_cache
+from src.services.user_cache import user_cache
+from src.services.validators import url_checker
+from src.services.jobs import job_queue
 from src.base import app, templates, user_agent_ban_list
 from src.repository.tags import TagRepository
+from src.repository.photos import PhotosRepository
+from src.repository.auth import Auth as repository_auth
 
 
 logging.disable(logging.WARNING)
@@ -50,6 +58,33 @@ app.mount("/images", StaticFiles(directory=BASE_DIR / "images"), name="images")
 #     return response
 
 
+# the mounted static files need no user
+STATIC_PATHS = tuple(route.path + "/" for route in app.routes if isinstance(route, Mount))
+
+
+@app.middleware("http")
+async def auth_context_middleware(request: Request, call_next: Callable):
+    """
+    Resolves the user of the request once, from its "atuser" cookie, into request.state.user.
+    Every request has its own user: the workers share no authentication state.
+    """
+    if not request.url.path.startswith(STATIC_PATHS):
+        await repository_auth.resolve_user_context(request)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def rate_limit_headers_middleware(request: Request, call_next: Callable):
+    """
+    Adds the X-RateLimit-* headers of the RateLimiter dependency of the route to its response
+    """
+    response = await call_next(request)
+    headers = getattr(request.state, "rate_limit_headers", None)
+    if headers:
+        response.headers.update(headers)
+    return response
+
+
 @app.middleware("http")
 async def user_agent_ban_middleware(request: Request, call_next: Callable):
     """
@@ -77,9 +112,11 @@ async def root( request: Request,
                 per_page: int = Query(None, ge=10, le=50, description="Items per page"),
                 user_id: int = Query(None, description="Filter by user"),
                 keyword: str = Query(None, description="Keyword to search in photo descriptions"),
-                tag: str = Query(None, description="Filter photos by tag"),
-                order_by: str = Query("newest", description="Sort order date('newest' or 'oldest'"),
-                db: Session = Depends(get_db)):
+                tag: List[str] = Query(None, description="Filter photos by tags"),
+                match: str = Query("all", description="Tags match('all' or 'any')"),
+                order_by: str = Query("newest", description="Sort order date('newest' or 'oldest') or 'rank' of keyword relevance"),
+                cursor: str = Query(None, description="Cursor of the next/previous page"),
+                db: AsyncSession = Depends(get_db)):
     """
     The root function is the entry point for the application.
         - It returns a TemplateResponse object, which renders an HTML template using Jinja2.
@@ -90,7 +127,14 @@ async def root( request: Request,
     :doc-author: Python-WEB13-project-team-2
     """
     # print(f"app.extra: {app.extra}")
-    images, pages = await photos.get_and_search_photos(request=request, db=db, page=page, per_page=per_page, user_id=user_id, keyword=keyword, tag=tag, order_by=order_by)
+    cache_key = page_cache.get_key(request)
+    if cache_key:
+        cached = await page_cache.get(cache_key)
+        if cached:
+            return cached
+        generation = await page_cache.generation()
+
+    images, pages = await photos.get_and_search_photos(request=request, db=db, page=page, per_page=per_page, user_id=user_id, keyword=keyword, tag=tag, order_by=order_by, cursor=cursor, match=match)
 
     top_tags = await TagRepository().get_tags_max10(session=db)
     top = []
@@ -102,28 +146,47 @@ async def root( request: Request,
         if len(top) >= 10:
             break
 
-    return templates.TemplateResponse('index.html', {"request": request,
-                                                     "title": messages.CONTACTS_APP, 
-                                                     "user": app.extra["user"],
-                                                     "view_tag": tag,
-                                                     "top_tags": top,
-                                                     "pages": pages,
-                                                     "photos": Jsons.list_photoresponse_to_json(images)})
+    response = templates.TemplateResponse('index.html', {"request": request,
+                                                         "title": messages.CONTACTS_APP, 
+                                                         "user": get_user_context(request),
+                                                         "view_tag": ", ".join(tag) if tag else None,
+                                                         "top_tags": top,
+                                                         "pages": pages,
+                                                         "photos": Jsons.list_photoresponse_to_json(images)})
+    if cache_key:
+        page_cache.set(cache_key, response.body, generation)
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    async with DBSession() as db:
+        await PhotosRepository().load_hash_index(db)
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    await url_checker.close()
+    await request_counters.close()
+    await user_cache.close()
+    await page_cache.close()
 
 
 @app.get("/api/healthchecker")
-def healthchecker(db: Session = Depends(get_db)):
+async def healthchecker(db: AsyncSession = Depends(get_db)):
     """
     The healthchecker function is used to check the health of the database.
         It will return a 200 status code if it can successfully connect to the database, and a 500 status code otherwise.
     
-    :param db: Session: Pass the database session to the function
+    :param db: AsyncSession: Pass the database session to the function
     :return: A dictionary with a message
     :doc-author: Python-WEB13-project-team-2
     """
     try:
         # Make request
-        result = db.execute(text("SELECT 1")).fetchone()
+        result = (await db.execute(text("SELECT 1"))).fetchone()
         if result is None:
             raise HTTPException(status_code=500, detail=messages.DATABASE_IS_NOT_CONFIGURED_CORRECTLY)
         return {"message": messages.WELCOME_TO_FASTAPI}
@@ -132,5 +195,15 @@ def healthchecker(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=messages.ERROR_CONNECTING_TO_THE_DATABASE)
 
 
+@app.get("/api/healthchecker/page_cache")
+def page_cache_stats():
+    """
+    The page_cache_stats function returns the hit/miss counters and the size of the rendered-page cache.
+
+    :return: A dictionary with the cache counters
+    """
+    return page_cache.stats()
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
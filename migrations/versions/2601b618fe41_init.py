@@ -45,7 +45,7 @@ def upgrade() -> None:
                 # "id": 1,
                 "username": "admin",
                 "email": "admin@email.com",
-                "password": auth_service.get_password_hash("admin"),
+                "password": auth_service.pwd_context.hash("admin"),
                 "created_at": created_at,
                 # "avatar": "",
                 "confirmed": True,
@@ -0,0 +1,48 @@
+"""photo description full-text search
+
+Revision ID: 3b9d1f0a7c21
+Revises: cf7be320fcc4
+Create Date: 2026-10-18 10:12:04.118342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9d1f0a7c21'
+down_revision: Union[str, None] = 'cf7be320fcc4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("ALTER TABLE photos ADD COLUMN description_tsv tsvector "
+                   "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(description, ''))) STORED")
+        op.create_index('ix_photos_description_tsv', 'photos', ['description_tsv'], postgresql_using='gin')
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE photos_fts USING fts5(description, content='photos', content_rowid='id')")
+        op.execute("CREATE TRIGGER photos_fts_ai AFTER INSERT ON photos BEGIN "
+                   "INSERT INTO photos_fts(rowid, description) VALUES (new.id, new.description); END")
+        op.execute("CREATE TRIGGER photos_fts_ad AFTER DELETE ON photos BEGIN "
+                   "INSERT INTO photos_fts(photos_fts, rowid, description) VALUES ('delete', old.id, old.description); END")
+        op.execute("CREATE TRIGGER photos_fts_au AFTER UPDATE OF description ON photos BEGIN "
+                   "INSERT INTO photos_fts(photos_fts, rowid, description) VALUES ('delete', old.id, old.description); "
+                   "INSERT INTO photos_fts(rowid, description) VALUES (new.id, new.description); END")
+        op.execute("INSERT INTO photos_fts(photos_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.drop_index('ix_photos_description_tsv', table_name='photos')
+        op.drop_column('photos', 'description_tsv')
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS photos_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS photos_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS photos_fts_ai")
+        op.execute("DROP TABLE IF EXISTS photos_fts")
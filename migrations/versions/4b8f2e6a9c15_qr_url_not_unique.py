@@ -0,0 +1,29 @@
+"""qr url not unique
+
+Revision ID: 4b8f2e6a9c15
+Revises: c93d17b8e5a0
+Create Date: 2026-10-18 23:41:07.318054
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b8f2e6a9c15'
+down_revision: Union[str, None] = 'c93d17b8e5a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # the photos sharing one file_url render the same QR-code, a content-addressed storage keeps it once
+    op.drop_constraint('photos_qr_url_key', 'photos', type_='unique')
+    op.drop_constraint('photo_urls_qr_url_key', 'photo_urls', type_='unique')
+
+
+def downgrade() -> None:
+    op.create_unique_constraint('photo_urls_qr_url_key', 'photo_urls', ['qr_url'])
+    op.create_unique_constraint('photos_qr_url_key', 'photos', ['qr_url'])
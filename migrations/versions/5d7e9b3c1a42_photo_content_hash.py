@@ -0,0 +1,37 @@
+"""photo content hash
+
+Revision ID: 5d7e9b3c1a42
+Revises: 8e4c2a6d5b10
+Create Date: 2026-10-18 15:20:11.204517
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d7e9b3c1a42'
+down_revision: Union[str, None] = '8e4c2a6d5b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_photos_content_hash'), 'photos', ['content_hash'], unique=False)
+    # photos with the same content share one stored image and so its transformations
+    op.drop_constraint('photos_file_url_key', 'photos', type_='unique')
+    op.create_index(op.f('ix_photos_file_url'), 'photos', ['file_url'], unique=False)
+    op.drop_constraint('photo_urls_file_url_key', 'photo_urls', type_='unique')
+    op.create_index(op.f('ix_photo_urls_file_url'), 'photo_urls', ['file_url'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_photo_urls_file_url'), table_name='photo_urls')
+    op.create_unique_constraint('photo_urls_file_url_key', 'photo_urls', ['file_url'])
+    op.drop_index(op.f('ix_photos_file_url'), table_name='photos')
+    op.create_unique_constraint('photos_file_url_key', 'photos', ['file_url'])
+    op.drop_index(op.f('ix_photos_content_hash'), table_name='photos')
+    op.drop_column('photos', 'content_hash')
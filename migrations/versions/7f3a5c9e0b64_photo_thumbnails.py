@@ -0,0 +1,36 @@
+"""photo thumbnails
+
+Revision ID: 7f3a5c9e0b64
+Revises: e2b6d04a9f17
+Create Date: 2026-10-18 18:51:27.640158
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7f3a5c9e0b64'
+down_revision: Union[str, None] = 'e2b6d04a9f17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('photo_thumbnails',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('photo_id', sa.Integer(), nullable=False),
+    sa.Column('width', sa.Integer(), nullable=False),
+    sa.Column('format', sa.String(length=10), nullable=False),
+    sa.Column('file_url', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['photo_id'], ['photos.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('photo_id', 'width', 'format', name='uq_photo_thumbnails')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('photo_thumbnails')
@@ -0,0 +1,29 @@
+"""tag usage count
+
+Revision ID: 8e4c2a6d5b10
+Revises: 3b9d1f0a7c21
+Create Date: 2026-10-18 11:02:47.530914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4c2a6d5b10'
+down_revision: Union[str, None] = '3b9d1f0a7c21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('tags', sa.Column('usage_count', sa.Integer(), server_default='0', nullable=False))
+    op.create_index(op.f('ix_tags_usage_count'), 'tags', ['usage_count'], unique=False)
+    op.execute("UPDATE tags SET usage_count = (SELECT count(*) FROM tag_m2m_photo WHERE tag_m2m_photo.tag_id = tags.id)")
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_tags_usage_count'), table_name='tags')
+    op.drop_column('tags', 'usage_count')
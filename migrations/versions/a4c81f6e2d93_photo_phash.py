@@ -0,0 +1,26 @@
+"""photo perceptual hash
+
+Revision ID: a4c81f6e2d93
+Revises: 5d7e9b3c1a42
+Create Date: 2026-10-18 16:42:05.817330
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c81f6e2d93'
+down_revision: Union[str, None] = '5d7e9b3c1a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('phash', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('photos', 'phash')
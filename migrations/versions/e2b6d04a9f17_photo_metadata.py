@@ -0,0 +1,36 @@
+"""photo image metadata
+
+Revision ID: e2b6d04a9f17
+Revises: a4c81f6e2d93
+Create Date: 2026-10-18 17:35:48.092614
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b6d04a9f17'
+down_revision: Union[str, None] = 'a4c81f6e2d93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('photos', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('photos', sa.Column('format', sa.String(length=10), nullable=True))
+    op.add_column('photos', sa.Column('file_size', sa.Integer(), nullable=True))
+    op.add_column('photos', sa.Column('orientation', sa.SmallInteger(), nullable=True))
+    op.add_column('photos', sa.Column('dominant_color', sa.String(length=7), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('photos', 'dominant_color')
+    op.drop_column('photos', 'orientation')
+    op.drop_column('photos', 'file_size')
+    op.drop_column('photos', 'format')
+    op.drop_column('photos', 'height')
+    op.drop_column('photos', 'width')
@@ -7,7 +7,6 @@ from fastapi.staticfiles import StaticFiles
 
 
 app = FastAPI()
-app.extra.update({"user": {"is_authenticated": False}})
 app.extra.update({"errors": []})
 app.extra.update({"history": []})
 app.extra.update({"qualifiers": {}})
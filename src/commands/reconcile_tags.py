@@ -0,0 +1,21 @@
+"""
+Rebuild Tag.usage_count from tag_m2m_photo.
+
+    python -m src.commands.reconcile_tags
+"""
+import asyncio
+
+from src.database.db import DBSession
+from src.repository.tags import TagRepository
+
+
+async def main():
+    session = DBSession()
+    try:
+        await TagRepository().reconcile_usage_count(session)
+    finally:
+        await session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -30,6 +30,9 @@ NO_MORE_THAN_10_REQUESTS_PER_MINUTE = "No more than 10 requests per minute"
 NOT_FOUND = "Not Found"
 FORBIDDEN = "Operation forbidden"
 BAD_REQUEST = "Bad request"
+INVALID_CURSOR = "Invalid pagination cursor"
+URL_WITHOUT_PUBLIC_ID = "URL does not contain 'public_id' of the storage"
+TRANSFORM_NOT_SUPPORTED = "Transformations are not supported by the image storage"
 
 CONTACTS_APP = "PhotoShare"
 WELCOME_TO_FASTAPI = "Welcome to FastAPI!"
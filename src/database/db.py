@@ -1,6 +1,5 @@
 from fastapi import HTTPException, status
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 
 from src.conf.config import settings
@@ -13,16 +12,38 @@ port = settings.postgres_port
 database = settings.postgres_db
 URL = settings.sqlalchemy_database_url
 
-engine = create_engine(URL, echo=True)
-DBSession = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+def get_async_url(url: str) -> str:
+    """
+    The get_async_url function replaces the synchronous driver of a database URL with its asyncio counterpart:
+        - postgresql(+psycopg2) -> postgresql+asyncpg
+        - sqlite(+pysqlite) -> sqlite+aiosqlite
+
+    :param url: str: The database URL from the settings (used by Alembic as is)
+    :return: The database URL for the AsyncEngine
+    :doc-author: Python-WEB13-project-team-2
+    """
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect in ("postgresql", "postgres"):
+        return f"postgresql+asyncpg{sep}{rest}"
+    if dialect == "sqlite":
+        return f"sqlite+aiosqlite{sep}{rest}"
+    return url
+
+
+ASYNC_URL = get_async_url(URL)
+
+engine = create_async_engine(ASYNC_URL, echo=True)
+DBSession = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False, class_=AsyncSession)
 
 
 # Dependency
-def get_db():
+async def get_db():
     """
     The get_db function is a context manager that will automatically close the database connection when it goes out of scope.
         It also handles any exceptions that occur within the with block, rolling back any changes to the database and closing the connection before re-raising them.
-    
+
     :return: A context manager that can be used to get a database connection
     :doc-author: Python-WEB13-project-team-2
     """
@@ -30,7 +51,7 @@ def get_db():
     try:
         yield db
     except SQLAlchemyError as err:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
     finally:
-        db.close()
+        await db.close()
@@ -1,6 +1,6 @@
 import enum
 
-from sqlalchemy import Column, Integer, String, DateTime, func, event, UniqueConstraint, Boolean, Enum
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Text, Index, DateTime, func, event, UniqueConstraint, Boolean, Enum, DDL
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql.schema import ForeignKey, Table
 
@@ -40,18 +40,53 @@ class Photo(Base, PrimaryKeyABC, DateTimeABC):
     __tablename__ = "photos"
     # id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
-    file_url = Column(String, nullable=False, unique=True)
-    qr_url = Column(String(255), nullable=True, unique=True)
+    file_url = Column(String, nullable=False, index=True)           # Shared by the photos with the same content
+    qr_url = Column(String(255), nullable=True)                     # Shared with file_url: the same QR-code image
     description = Column(String, nullable=True)
+    content_hash = Column(String(64), nullable=True, index=True)    # SHA-256 of the uploaded file
+    phash = Column(BigInteger, nullable=True)                       # 64-bit perceptual hash (dHash), signed
+    # Image metadata, read at upload; width and height as displayed, with the EXIF orientation applied
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    format = Column(String(10), nullable=True)
+    file_size = Column(Integer, nullable=True)                      # bytes
+    orientation = Column(SmallInteger, nullable=True)               # EXIF orientation, 1 - normal
+    dominant_color = Column(String(7), nullable=True)               # #rrggbb
     # created_at = Column('created_at', DateTime, default=func.now())
     # updated_at = Column('updated_at', DateTime, default=func.now(), onupdate=func.now())
     user = relationship('User', backref='photos')
 
 
+# Full-text search over Photo.description:
+#   PostgreSQL - generated tsvector column with a GIN index
+#   SQLite     - FTS5 external content table kept in sync by triggers
+PHOTO_FTS_CONFIG = 'simple'
+PHOTO_FTS_COLUMN = 'description_tsv'
+PHOTO_FTS_TABLE = 'photos_fts'
+
+for ddl in (f"ALTER TABLE photos ADD COLUMN IF NOT EXISTS {PHOTO_FTS_COLUMN} tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{PHOTO_FTS_CONFIG}', coalesce(description, ''))) STORED",
+            f"CREATE INDEX IF NOT EXISTS ix_photos_{PHOTO_FTS_COLUMN} ON photos USING gin ({PHOTO_FTS_COLUMN})"):
+    event.listen(Photo.__table__, 'after_create', DDL(ddl).execute_if(dialect='postgresql'))
+
+for ddl in (f"CREATE VIRTUAL TABLE IF NOT EXISTS {PHOTO_FTS_TABLE} USING fts5(description, content='photos', content_rowid='id')",
+            f"CREATE TRIGGER IF NOT EXISTS {PHOTO_FTS_TABLE}_ai AFTER INSERT ON photos BEGIN "
+            f"INSERT INTO {PHOTO_FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+            f"CREATE TRIGGER IF NOT EXISTS {PHOTO_FTS_TABLE}_ad AFTER DELETE ON photos BEGIN "
+            f"INSERT INTO {PHOTO_FTS_TABLE}({PHOTO_FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); END",
+            f"CREATE TRIGGER IF NOT EXISTS {PHOTO_FTS_TABLE}_au AFTER UPDATE OF description ON photos BEGIN "
+            f"INSERT INTO {PHOTO_FTS_TABLE}({PHOTO_FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); "
+            f"INSERT INTO {PHOTO_FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+            f"INSERT INTO {PHOTO_FTS_TABLE}({PHOTO_FTS_TABLE}) VALUES ('rebuild')"):
+    event.listen(Photo.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+event.listen(Photo.__table__, 'before_drop', DDL(f"DROP TABLE IF EXISTS {PHOTO_FTS_TABLE}").execute_if(dialect='sqlite'))
+
+
 class Tag(Base, PrimaryKeyABC, CreatedABC):
     __tablename__ = "tags"
     # id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, unique=True)
+    usage_count = Column(Integer, nullable=False, default=0, server_default='0', index=True)    # Number of photos with the tag
 
 
 tag_photo_association = Table(
@@ -63,11 +98,23 @@ tag_photo_association = Table(
  )
 
 
+class PhotoThumbnail(Base, PrimaryKeyABC, CreatedABC):
+    """
+    Responsive thumbnails of a photo made by the system after upload, not shown as user transformations
+    """
+    __tablename__ = "photo_thumbnails"
+    __table_args__ = (UniqueConstraint('photo_id', 'width', 'format', name='uq_photo_thumbnails'),)
+    photo_id = Column(Integer, ForeignKey("photos.id", ondelete='CASCADE'), nullable=False)
+    width = Column(Integer, nullable=False)         # px, the width bucket
+    format = Column(String(10), nullable=False)
+    file_url = Column(String, nullable=False)
+
+
 class PhotoURL(Base, PrimaryKeyABC, DateTimeABC):
     __tablename__ = "photo_urls"
     # id = Column(Integer, primary_key=True)
-    file_url = Column(String, nullable=False, unique=True)
-    qr_url = Column(String(255), nullable=True, unique=True)
+    file_url = Column(String, nullable=False, index=True)
+    qr_url = Column(String(255), nullable=True)
     #
     params = Column(String, nullable=True)      # Dictionary of Params
     #
@@ -86,3 +133,22 @@ class Comment(Base, PrimaryKeyABC, DateTimeABC):
     # updated_at = Column('updated_at', DateTime, default=func.now(), onupdate=func.now())
     photo = relationship('Photo', backref='comments')
     user = relationship('User', backref='comments')
+
+
+class Job(Base, PrimaryKeyABC, DateTimeABC):
+    """
+    Deferred side effect (image deletion, thumbnails, QR-codes) run by the JobQueue workers.
+    pending -> running -> done, or back to pending with a backoff after a failure,
+    or dead after max_attempts failures (kept with the last error for inspection).
+    """
+    __tablename__ = "jobs"
+    __table_args__ = (Index('ix_jobs_status_run_at', 'status', 'run_at'),)
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False, default='{}')                # JSON
+    idempotency_key = Column(String(255), nullable=True, unique=True)   # one job per key
+    status = Column(String(10), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_at = Column(DateTime, nullable=False)                           # UTC, not before
+    locked_until = Column(DateTime, nullable=True)                      # UTC, lease of the running worker
+    last_error = Column(Text, nullable=True)
@@ -1,20 +1,27 @@
+import logging
 from typing import List
 
 from fastapi import HTTPException, Depends, Request
 from fastapi.security.utils import get_authorization_scheme_param
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
 
-from src.base import app
+from src.database.db import get_db
 from src.database.models import User
 from src.repository import users as repository_users
 from src.services.auth import auth_service
 from src.services.custom_json import Jsons
+from src.services.user_cache import user_cache
+from src.services.auth_context import get_user_context, set_user_context
+
+logger = logging.getLogger(__name__)
+
 
 class Auth:
     def __init__(self):
         self.errors: List = []
 
-    async def check_authentication(self, request: Request, db: Session, is_logout: bool=False) -> User | None:
+    async def check_authentication(self, request: Request, db: AsyncSession, is_logout: bool=False) -> User | None:
         self.errors = []
         # print(f">>> check_authentication: cookies={request.cookies}")
         token = request.cookies.get("atuser")
@@ -23,12 +30,12 @@ class Auth:
         # print(f">>> check_authentication: scheme={scheme}, param={param}")
         current_user = None
         try:
-            current_user = await auth_service.get_current_user(token=param, db=db)
+            current_user = await auth_service.get_current_user(request=request, token=param, db=db)
             # print(f">>> check_authentication: current_user.id={current_user}")
             if not is_logout:
                 log_user = Jsons.userresponse_to_json(user=current_user, auth=True)
                 # print(f">>> check_authentication: current_user={log_user}")
-                app.extra.update({"user": log_user})
+                set_user_context(request, log_user)
                 return current_user
         
         except HTTPException as err:
@@ -36,7 +43,7 @@ class Auth:
                 # print(f">>> check_authentication: HTTPException = {err.detail}")
                 self.errors.append({"key": "message", "value": err.detail})
 
-            user = app.extra["user"]
+            user = get_user_context(request)
             email = user.get("email")
             if email:
                 try:
@@ -48,12 +55,36 @@ class Auth:
 
         if current_user:
             current_user.refresh_token = None
-            db.commit
+            await db.commit()
+            await user_cache.invalidate(email=current_user.email)
             # print(f">>> check_authentication: refresh_token = None")
         
-        app.extra.pop("user")
-        app.extra.update({"user": {"is_authenticated": False}})
-        # app.extra["user"].update({"is_authenticated": False})
+        set_user_context(request, None)
         # print(f">>> check_authentication: is_authenticated = False")
 
         return None
+
+    @staticmethod
+    async def resolve_user_context(request: Request):
+        """
+        Authenticate the request by its cookie, once, and keep the user for the templates in request.state.
+        get_current_user of the route reuses the user (or the error) kept in request.state.auth_user.
+        An unavailable database makes the request anonymous.
+        """
+        token = request.cookies.get("atuser")
+        log_user = None
+        if token:
+            scheme, param = get_authorization_scheme_param(token)
+            # the session of the routes, overridden by the tests
+            sessions = request.app.dependency_overrides.get(get_db, get_db)()
+            try:
+                db = await sessions.__anext__()
+                current_user = await auth_service.get_current_user(request=request, token=param, db=db)
+                log_user = Jsons.userresponse_to_json(user=current_user, auth=True)
+            except HTTPException:
+                pass
+            except (SQLAlchemyError, OSError) as err:
+                logger.exception(f"resolve_user_context: {err}")
+            finally:
+                await sessions.aclose()
+        set_user_context(request, log_user)
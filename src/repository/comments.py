@@ -1,7 +1,7 @@
-from typing import List
+from typing import List, Dict
 
-from sqlalchemy import and_, desc
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, desc, select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, status
 
 from src.conf import messages
@@ -9,70 +9,109 @@ from src.schemas import CommentModel, CommentUpdate, CommentDelete
 from src.database.models import Comment, User, Photo, UserRole
 
 
-async def get_comments(page: int, per_page: int, photo_id: int, db: Session) -> List[Comment]:
+async def get_comments(page: int, per_page: int, photo_id: int, db: AsyncSession) -> List[Comment]:
     """
     Returns all comments associated with that photo.
 
     Args:
         photo_id (int): The id of the desired photo.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Returns:
         List[Comment]: A list of comments for a given photo_id
     """
     if page and per_page:
         offset = (page - 1) * per_page
-        comments = db.query(Comment.id,
-                            Comment.text,
-                            Comment.user_id,
-                            User.username
-                            ) \
+        query = select(Comment.id,
+                       Comment.text,
+                       Comment.user_id,
+                       User.username
+                       ) \
                     .select_from(Comment) \
                     .join(User) \
                     .filter(Comment.photo_id == photo_id) \
                     .order_by(desc(Comment.id)) \
-                    .offset(offset).limit(per_page).all()
+                    .offset(offset).limit(per_page)
     else:
-        comments = db.query(Comment.id,
-                            Comment.text,
-                            Comment.user_id,
-                            User.username
-                            ) \
+        query = select(Comment.id,
+                       Comment.text,
+                       Comment.user_id,
+                       User.username
+                       ) \
                     .select_from(Comment) \
                     .join(User) \
                     .filter(Comment.photo_id == photo_id) \
-                    .order_by(desc(Comment.id)) \
-                    .all()
+                    .order_by(desc(Comment.id))
+    comments = (await db.execute(query)).all()
 
     return comments  # noqa
 
 
-async def get_comment_by_id(photo_id: int, comment_id: int, db: Session) -> Comment:
+async def get_comments_by_photos(photo_ids: List[int], per_photo: int, db: AsyncSession) -> Dict[int, List[Comment]]:
+    """
+    Returns the newest comments for several photos in a single query.
+
+    Args:
+        photo_ids (List[int]): The ids of the desired photos.
+        per_photo (int): The maximum number of comments per photo (0 - all comments).
+        db (AsyncSession): The database session.
+
+    Returns:
+        Dict[int, List[Comment]]: Comments grouped by photo_id, newest first
+    """
+    result = {photo_id: [] for photo_id in photo_ids}
+    if not photo_ids:
+        return result
+
+    row_num = func.row_number().over(partition_by=Comment.photo_id, order_by=desc(Comment.id)).label('row_num')
+    sub = select(Comment.id,
+                 Comment.text,
+                 Comment.user_id,
+                 Comment.photo_id,
+                 User.username,
+                 row_num
+                 ) \
+            .select_from(Comment) \
+            .join(User) \
+            .where(Comment.photo_id.in_(photo_ids)) \
+            .subquery()
+
+    query = select(sub.c.id, sub.c.text, sub.c.user_id, sub.c.photo_id, sub.c.username) \
+                .order_by(sub.c.photo_id, desc(sub.c.id))
+    if per_photo:
+        query = query.where(sub.c.row_num <= per_photo)
+
+    for comment in (await db.execute(query)).all():
+        result[comment.photo_id].append(comment)
+    return result
+
+
+async def get_comment_by_id(photo_id: int, comment_id: int, db: AsyncSession) -> Comment:
     """
     Returns all comments associated with that photo.
 
     Args:
         photo_id (int): The id of the desired photo.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Returns:
         List[Comment]: A list of comments for a given photo_id
     """
-    comment = db.query(Comment.id,
-                       Comment.text,
-                       Comment.user_id,
-                       User.username
-                       ) \
+    query = select(Comment.id,
+                   Comment.text,
+                   Comment.user_id,
+                   User.username
+                   ) \
                 .select_from(Comment) \
                 .join(User) \
                 .filter(Comment.photo_id == photo_id) \
-                .order_by(desc(Comment.id)) \
-                .first()
+                .order_by(desc(Comment.id))
+    comment = (await db.execute(query)).first()
 
     return comment  # noqa
 
 
-async def create_comment(photo_id: int, body: CommentModel, user: User, db: Session) -> Comment:
+async def create_comment(photo_id: int, body: CommentModel, user: User, db: AsyncSession) -> Comment:
     """
     Creates a new comment for a given photo.
 
@@ -80,47 +119,47 @@ async def create_comment(photo_id: int, body: CommentModel, user: User, db: Sess
         photo_id (int): The id of the desired photo.
         body (CommentModel): The comment to be created.
         user (User): The user who is creating the comment.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Returns:
         Comment: The newly created comment.
     """
-    photo = db.query(Photo).filter(Photo.id == photo_id).first()
+    photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
     if not photo:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
     
     comment = Comment(
         text=body.text,
-        user=user,
-        photo=photo
+        user_id=user.id,
+        photo_id=photo.id
     )
 
     db.add(comment)
-    db.commit()
-    db.refresh(comment)
+    await db.commit()
+    await db.refresh(comment)
     return await get_comment_by_id(photo_id=photo_id, comment_id=comment.id, db=db)
 
     # return comment
 
 
-async def update_comment(photo_id: int, comment_id: int, body: CommentModel, user: User, db: Session) -> Comment | None:
+async def update_comment(photo_id: int, comment_id: int, body: CommentModel, user: User, db: AsyncSession) -> Comment | None:
     """
     Updates a comment.
 
     Args:
         body (CommentUpdate): The comment to be updated.
         user (User): The user who is updating the comment.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Returns:
         Comment | None: The updated comment, or None if the comment does not exist.
     """
-    comment = db.query(Comment).filter(and_(Comment.photo_id == photo_id, Comment.id == comment_id)).first()
+    comment = await db.scalar(select(Comment).filter(and_(Comment.photo_id == photo_id, Comment.id == comment_id)))
 
     if comment:
         if user.id == comment.user_id:
             comment.text = body.text
-            db.commit()
+            await db.commit()
         else:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
     else:
@@ -130,23 +169,23 @@ async def update_comment(photo_id: int, comment_id: int, body: CommentModel, use
     # return comment
 
 
-async def delete_comment(photo_id: int, comment_id: int, user: User, db: Session) -> Comment | None:
+async def delete_comment(photo_id: int, comment_id: int, user: User, db: AsyncSession) -> Comment | None:
     """
     Deletes a comment.
 
     Args:
         body (CommentDelete): The comment to be deleted.
-        db (Session): The database session.
+        db (AsyncSession): The database session.
 
     Returns:
         Comment | None: The deleted comment, or None if the comment does not exist.
     """
-    comment = db.query(Comment).filter(and_(Comment.photo_id == photo_id, Comment.id == comment_id)).first()
+    comment = await db.scalar(select(Comment).filter(and_(Comment.photo_id == photo_id, Comment.id == comment_id)))
 
     if comment:
         if user.id == comment.user_id or user.roles in [UserRole.admin, UserRole.moderator]:
-            db.delete(comment)
-            db.commit()
+            await db.delete(comment)
+            await db.commit()
         else:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
     else:
@@ -1,26 +1,34 @@
-import re
-import qrcode
-import aiofiles.os
+import io
 import json
-from typing import List, Optional
+import asyncio
+import logging
+from typing import List, Optional, AsyncIterator
 
 from fastapi import HTTPException, status, UploadFile
-from sqlalchemy import insert, select, update, delete, desc, asc, and_
-from sqlalchemy.orm import Session
+from sqlalchemy import insert, select, update, delete, desc, asc, and_, or_, func, exists
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.base import app, templates
-from src.database.models import UserRole, Photo, User, PhotoURL, Tag, tag_photo_association as t2p
+from src.database.models import UserRole, Photo, User, PhotoURL, PhotoThumbnail, Tag, tag_photo_association as t2p
 from src.repository.tags import TagRepository
 from src.schemas import PhotoTransformModel, PhotoQRCodeModel, PhotoResponse
 from src.conf import messages
-from src.conf.config import MAX_TAGS_COUNT
+from src.conf.config import MAX_TAGS_COUNT, PHOTOS_PER_PAGE, PHOTOS_STREAM_BATCH, QR_BULK_CONCURRENCY, \
+                           THUMBNAIL_WIDTHS, THUMBNAIL_FORMATS, THUMBNAIL_CONCURRENCY
 from src.services.cloud_image import CloudImage
+from src.services.qr_code import qr_renderer
+from src.services.similarity import photo_hash_index, to_unsigned
+from src.services.image_info import inspect_image
+from src.services.jobs import job_queue
 from src.services.validators import Validator
 from src.services.custom_json import Jsons
-from src.repository.comments import get_comments
-from src.services.pager import Pagination
+from src.repository.comments import get_comments, get_comments_by_photos
+from src.services.pager import Pagination, Keyset
+from src.services.fulltext import FullTextSearch
 
 
+logger = logging.getLogger(__name__)
+
 
 class PhotosRepository:
 
@@ -29,7 +37,7 @@ class PhotosRepository:
                                tags: List[str],
                                photo_file: UploadFile,
                                current_user: User,
-                               session: Session) -> Photo:
+                               session: AsyncSession) -> Photo:
         """
         Upload a new photo with description and tags, associated with the given user
         Args:
@@ -46,33 +54,93 @@ class PhotosRepository:
         """
         user_id = current_user.id
         try:
-            photo_url = CloudImage.upload_image(photo_file=photo_file.file, user=current_user)
+            info = await self.inspect_upload(photo_file)
+            # the same content uploaded before - reuse the stored image
+            photo_url = await session.scalar(select(Photo.file_url).filter(Photo.content_hash == info["content_hash"])
+                                             .limit(1))
+            if not photo_url:
+                photo_url = await CloudImage.upload_image(photo_file=photo_file.file, user=current_user)
 
             query = insert(Photo).values(
                 description=photo_description,
                 file_url=photo_url,
                 user_id=user_id,
+                **info
             ).returning(Photo)
-            new_photo = session.execute(query).scalar_one()
+            new_photo = (await session.execute(query)).scalar_one()
 
             tags_list = []
             if tags:
                 tags_list = await TagRepository().add_tags_to_photo(tags, new_photo.id, session, False)
-            session.commit()
+            await job_queue.enqueue(session, "create_thumbnails", {"photo_id": new_photo.id},
+                                    key=f"create_thumbnails:{new_photo.id}")
+            await session.commit()
+            if new_photo.phash is not None:
+                photo_hash_index.add(new_photo.id, to_unsigned(new_photo.phash))
             return new_photo
 
         except Exception as e:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
-    async def add_tag_to_photo(self, tags: List[str], photo_id: int, current_user: User, session: Session) -> PhotoResponse:
+    @staticmethod
+    async def inspect_upload(photo_file: UploadFile) -> dict:
+        """
+        Content hash, size and image metadata of an uploaded file, read once by chunks and rewound for the upload
+        """
+        await photo_file.seek(0)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, inspect_image, photo_file.file)
+        finally:
+            await photo_file.seek(0)
+
+
+    async def load_hash_index(self, session: AsyncSession) -> int:
+        """
+        Rebuild the in-process perceptual hash index from the database, returns the number of indexed photos
+        """
+        photo_hash_index.clear()
+        query = select(Photo.id, Photo.phash).filter(Photo.phash.isnot(None)) \
+                    .execution_options(yield_per=PHOTOS_STREAM_BATCH)
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            for photo_id, phash in rows:
+                photo_hash_index.add(photo_id, to_unsigned(phash))
+        await result.close()
+        return len(photo_hash_index)
+
+
+    async def get_similar_photos(self, photo_id: int, distance: int, limit: int, session: AsyncSession) -> List[dict]:
+        """
+        Photos visually similar to the given one: perceptual hashes within the Hamming distance, the closest first
+        Args:
+            photo_id (int): The ID of the photo.
+            distance (int): The largest Hamming distance between the hashes, up to SIMILAR_MAX_DISTANCE bits.
+            limit (int): The maximum number of photos.
+            session: The database session
+        Returns:
+            List[dict]: The list of {"photo", "tags", "comments"} dictionaries
+        Raises:
+            HTTPException: If the photo is not found.
+        """
+        photo = (await session.execute(select(Photo.id, Photo.phash).filter(Photo.id == photo_id))).first()
+        if photo is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
+        if photo.phash is None:
+            return []
+        found = photo_hash_index.search(to_unsigned(photo.phash), distance)
+        photo_ids = [found_id for _, found_id in found if found_id != photo_id][:limit]
+        return await self.get_photos_by_ids(photo_ids, session)
+
+
+    async def add_tag_to_photo(self, tags: List[str], photo_id: int, current_user: User, session: AsyncSession) -> PhotoResponse:
         """
         Add a tag to a photo and return the updated photo.
         Args:
             tag (str): The name of the tag to be added.
             photo_id (int): The ID of the photo to which the tag should be added.
             current_user (User): The current user performing the action.
-            session (Session): The SQLAlchemy session.
+            session (AsyncSession): The SQLAlchemy session.
         Returns:
             PhotoResponse: A response object containing the updated photo information.
         Raises:
@@ -84,20 +152,20 @@ class PhotosRepository:
         tags_new, tags_full = await TagRepository().get_different_tags(tags, tags_photo)
         await Validator().validate_tags_count(tags_str="", tags=tags_full)
         await TagRepository().add_tags_to_photo(tags_new, photo_id, session, False)
-        session.commit()
+        await session.commit()
         photo = await self.get_photo_by_id(photo_id=photo_id, session=session)
         return photo
 
 
     async def remove_tag_from_photo(self, tag: str, photo_id: int, current_user: User,
-                                    session: Session) -> PhotoResponse:
+                                    session: AsyncSession) -> PhotoResponse:
         """
         Remove a tag from a photo and return the updated photo.
         Args:
             tag (str): The name of the tag to be removed.
             photo_id (int): The ID of the photo from which the tag should be removed.
             current_user (User): The current user performing the action.
-            session (Session): The SQLAlchemy session.
+            session (AsyncSession): The SQLAlchemy session.
         Returns:
             PhotoResponse: A response object containing the updated photo information.
         Raises:
@@ -106,17 +174,19 @@ class PhotosRepository:
             updated_photo = await remove_tag_from_photo("landscape", 1, current_user, session)
         """
         query = select(Tag).where(Tag.name == tag)
-        tag_ = session.execute(query).scalar_one_or_none()
+        tag_ = (await session.execute(query)).scalar_one_or_none()
         if not tag_:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.TAG_PHOTO_NOT_FOUND)
         query = delete(t2p).where(t2p.c.tag_id == tag_.id, t2p.c.photo_id == photo_id)
-        session.execute(query)
-        session.commit()
+        result = await session.execute(query)
+        if result.rowcount:
+            await TagRepository().change_usage_count([tag_.id], -1, session)
+        await session.commit()
         photo = await self.get_photo_by_id(photo_id=photo_id, session=session)
         return photo
 
 
-    async def delete_photo(self, photo_id: int, current_user: User, session: Session) -> None:
+    async def delete_photo(self, photo_id: int, current_user: User, session: AsyncSession) -> None:
         """
         Delete a photo with the given photo_id associated with the user
         Args:
@@ -127,50 +197,52 @@ class PhotosRepository:
         Raises:
             HTTPException: If the photo is not found or an error occurs during deletion.
         """
-        query = delete(Photo).where(Photo.id == photo_id).returning(Photo)
-        photo = session.execute(query).scalar_one_or_none()
-        tags = await TagRepository().get_tags_photo(photo_id, session)
-        comm = await get_comments(page=0, per_page=0, photo_id=photo.id, db=session)
-
+        photo = (await session.execute(select(Photo).filter(Photo.id == photo_id))).scalar_one_or_none()
         if not photo:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
         elif photo.user_id != current_user.id and current_user.roles != UserRole.admin:
-            session.rollback()
             raise HTTPException(status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
 
+        tags = await TagRepository().get_tags_photo(photo_id, session)
+        comm = await get_comments(page=0, per_page=0, photo_id=photo.id, db=session)
+        await TagRepository().change_usage_count([tag.id for tag in tags], -1, session)
+        await session.execute(delete(Photo).where(Photo.id == photo_id))
+
         await self.delete_all_transform_photo(photo, session, is_commit=False)
 
         if photo.qr_url:
-            result = CloudImage.delete_image(photo.qr_url)
-            if result:
-                session.rollback()
-                raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=result)
-
-        result = CloudImage.delete_image(photo.file_url)
-        if result:
-            session.rollback()
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=result)
+            await self.delete_image_later(photo.qr_url, session)
+
+        # the stored image may be shared with the photos of the same content
+        is_shared = await session.scalar(select(exists().where(Photo.file_url == photo.file_url)))
+        if not is_shared:
+            await self.delete_image_later(photo.file_url, session)
         
-        session.commit()
+        await session.commit()
+        photo_hash_index.remove(photo.id)
         return {"photo": photo, "tags": tags, "comments": comm}
 
 
     async def search_photos(self,
-                            session: Session, 
+                            session: AsyncSession, 
                             page: int=None, 
                             per_page: int=None, 
                             user_id: int=None, 
                             keyword: str=None, 
-                            tag: str=None, 
-                            order_by: str=None):
+                            tag: str | List[str]=None, 
+                            order_by: str=None,
+                            cursor: str=None,
+                            match: str='all'):
         """
         Search for photos by keyword or tag and filter the results by rating or date.
 
         Args:
-            keyword (str): The keyword to search for in photo descriptions.
-            tag (str): The tag to filter photos by.
-            order_by (str): The sorting criteria ('rating' or 'date').
-            session (Session): The database session.
+            keyword (str): The words to search for in photo descriptions (full-text, prefix matching).
+            tag (str | List[str]): The tag(s) to filter photos by.
+            match (str): 'all' - photos having every tag, 'any' - photos having at least one of the tags.
+            order_by (str): The sorting criteria ('newest', 'oldest' or 'rank' - relevance to the keyword).
+            cursor (str): The opaque cursor of the next/previous page (keyset pagination, 'newest'/'oldest' only).
+            session (AsyncSession): The database session.
 
         Returns:
             List[Photo]: A list of Photo objects that match the search and filter criteria.
@@ -186,33 +258,154 @@ class PhotosRepository:
         if user_id:
             photos_query = photos_query.where(Photo.user_id == user_id)
             
+        rank = None
         if keyword:
-            keyword_filter = Photo.description.ilike(f"%{keyword}%")
-            photos_query = photos_query.where(keyword_filter)
+            photos_query, rank = FullTextSearch(session).search_photos(photos_query, keyword)
 
         if tag:
-            tag_query = select(Tag).where(Tag.name == tag)
-            tag_obj = session.execute(tag_query).scalar_one_or_none()
-
-            if tag_obj:
-                tag_filter = t2p.c.tag_id == tag_obj.id
-                photos_query = photos_query.join(t2p).where(tag_filter)
-
+            tags = list(dict.fromkeys([tag] if isinstance(tag, str) else tag))
+            if match == 'any':
+                tag_filter = exists().where(t2p.c.photo_id == Photo.id) \
+                                     .where(t2p.c.tag_id == Tag.id) \
+                                     .where(Tag.name.in_(tags))
+            else:
+                tag_filter = Photo.id.in_(select(t2p.c.photo_id)
+                                          .join(Tag, Tag.id == t2p.c.tag_id)
+                                          .where(Tag.name.in_(tags))
+                                          .group_by(t2p.c.photo_id)
+                                          .having(func.count(Tag.id) == len(tags)))
+            photos_query = photos_query.where(tag_filter)
+
+        keyset = None
         if order_by == 'newest':
             photos_query = photos_query.order_by(Photo.created_at.desc())
+            keyset = Keyset([Photo.created_at, Photo.id], descending=True)
         elif order_by == 'oldest':
             photos_query = photos_query.order_by(Photo.created_at.asc())
+            keyset = Keyset([Photo.created_at, Photo.id], descending=False)
+        elif order_by == 'rank' and rank is not None:
+            photos_query = photos_query.order_by(rank.desc(), Photo.id.desc())
         
-        paginate = Pagination(photos_query, session, page, per_page)
-        photos, pages = paginate.get_page()
-        result = []
-        for photo in photos:
-            ph1 = await self.get_photo_by_id(photo_id=photo.id, session=session, limit_comment=MAX_TAGS_COUNT)
-            result.append(ph1)
+        paginate = Pagination(photos_query, session, page, per_page, keyset=keyset, cursor=cursor)
+        photos, pages = await paginate.get_page()
+        result = await self.get_photos_by_ids(photo_ids=[photo.id for photo in photos], session=session, limit_comment=MAX_TAGS_COUNT)
         return result, pages
 
 
-    async def get_photo_by_id(self, photo_id: int, session: Session, limit_comment: int = 0) -> Optional[Photo]:
+    async def get_photos_by_ids(self, photo_ids: List[int], session: AsyncSession, limit_comment: int = 0) -> List[dict]:
+        """
+        Retrieve several photos with their tags and newest comments using one query per entity
+        Args:
+            photo_ids (List[int]): The IDs of the photos, in the order they should be returned.
+            session: The database session
+            limit_comment (int): The maximum number of comments per photo (0 - all comments).
+        Returns:
+            List[dict]: The list of {"photo", "tags", "comments"} dictionaries
+        """
+        if not photo_ids:
+            return []
+
+        query = select(Photo.id,
+                       Photo.file_url,
+                       Photo.qr_url,
+                       Photo.description,
+                       Photo.created_at,
+                       Photo.user_id,
+                       Photo.width,
+                       Photo.height,
+                       Photo.format,
+                       Photo.file_size,
+                       Photo.orientation,
+                       Photo.dominant_color,
+                       User.username
+                       ) \
+                    .select_from(Photo) \
+                    .join(User) \
+                    .filter(Photo.id.in_(photo_ids))
+        photos = (await session.execute(query)).all()
+        photos = {photo.id: photo for photo in photos}
+        return await self.hydrate_photos([photos[photo_id] for photo_id in photo_ids if photo_id in photos],
+                                         session, limit_comment)
+
+
+    async def hydrate_photos(self, photos: List[Photo], session: AsyncSession, limit_comment: int = 0) -> List[dict]:
+        """
+        Attach tags and newest comments to already loaded photo rows using one query per entity
+        Args:
+            photos (List[Photo]): The photo rows, in the order they should be returned.
+            session: The database session
+            limit_comment (int): The maximum number of comments per photo (0 - all comments).
+        Returns:
+            List[dict]: The list of {"photo", "tags", "comments"} dictionaries
+        """
+        photo_ids = [photo.id for photo in photos]
+        tags = await TagRepository().get_tags_photos(photo_ids, session)
+        comm = await get_comments_by_photos(photo_ids=photo_ids, per_photo=limit_comment, db=session)
+        thumbnails = await self.get_thumbnails_photos(photo_ids, session)
+        return [{"photo": photo, "tags": tags[photo.id], "comments": comm[photo.id], "thumbnails": thumbnails[photo.id]}
+                for photo in photos]
+
+
+    async def get_thumbnails_photos(self, photo_ids: List[int], session: AsyncSession) -> dict:
+        """
+        Responsive thumbnails of several photos by one query
+        Returns:
+            dict: {photo_id: [PhotoThumbnail, ...]} ordered by format and width
+        """
+        result = {photo_id: [] for photo_id in photo_ids}
+        if photo_ids:
+            query = select(PhotoThumbnail).filter(PhotoThumbnail.photo_id.in_(photo_ids)) \
+                        .order_by(PhotoThumbnail.format, PhotoThumbnail.width)
+            for thumbnail in (await session.execute(query)).scalars().all():
+                result[thumbnail.photo_id].append(thumbnail)
+        return result
+
+
+    async def create_thumbnails(self, photo_id: int, session: AsyncSession) -> List[PhotoThumbnail]:
+        """
+        Make the responsive thumbnails of a photo: every THUMBNAIL_FORMATS in every THUMBNAIL_WIDTHS bucket
+        narrower than the photo (at least the smallest one), replacing the thumbnails made before
+        """
+        photo = (await session.execute(select(Photo.file_url, Photo.width).filter(Photo.id == photo_id))).first()
+        if photo is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
+
+        widths = [width for width in THUMBNAIL_WIDTHS if not photo.width or width < photo.width] \
+                 or [min(THUMBNAIL_WIDTHS)]
+        formats = [fetch_format for fetch_format in THUMBNAIL_FORMATS if CloudImage.supports_format(fetch_format)]
+        buckets = [(width, fetch_format) for fetch_format in formats for width in widths]
+        semaphore = asyncio.Semaphore(THUMBNAIL_CONCURRENCY)
+
+        async def make_thumbnail(width: int, fetch_format: str) -> str:
+            async with semaphore:
+                return await CloudImage.build_thumbnail_url(photo.file_url, width, fetch_format)
+
+        # a failed bucket does not throw away the others
+        urls = await asyncio.gather(*[make_thumbnail(width, fetch_format) for width, fetch_format in buckets],
+                                    return_exceptions=True)
+        made, errors = [], []
+        for (width, fetch_format), url in zip(buckets, urls):
+            if isinstance(url, BaseException):
+                logger.error(f"Thumbnail {width}px {fetch_format} of the photo {photo_id}: {url!r}")
+                errors.append(url)
+            else:
+                made.append(((width, fetch_format), url))
+
+        if made:
+            made_buckets = [and_(PhotoThumbnail.width == width, PhotoThumbnail.format == fetch_format)
+                            for (width, fetch_format), _ in made]
+            await session.execute(delete(PhotoThumbnail).where(PhotoThumbnail.photo_id == photo_id, or_(*made_buckets)))
+        thumbnails = [PhotoThumbnail(photo_id=photo_id, width=width, format=fetch_format, file_url=url)
+                      for (width, fetch_format), url in made]
+        session.add_all(thumbnails)
+        await session.commit()
+        if errors:
+            # the job is retried for the failed buckets, the ones made are kept
+            raise errors[0]
+        return thumbnails
+
+
+    async def get_photo_by_id(self, photo_id: int, session: AsyncSession, limit_comment: int = 0) -> Optional[Photo]:
         """
         Retrieve a photo with the given photo_id associated with the user
         Args:
@@ -225,18 +418,24 @@ class PhotosRepository:
         Raises:
             HTTPException: If the photo is not found.
         """
-        photo = session.query(Photo.id,
-                              Photo.file_url,
-                              Photo.qr_url,
-                              Photo.description,
-                              Photo.created_at,
-                              Photo.user_id,
-                              User.username
-                            ) \
+        query = select(Photo.id,
+                       Photo.file_url,
+                       Photo.qr_url,
+                       Photo.description,
+                       Photo.created_at,
+                       Photo.user_id,
+                       Photo.width,
+                       Photo.height,
+                       Photo.format,
+                       Photo.file_size,
+                       Photo.orientation,
+                       Photo.dominant_color,
+                       User.username
+                       ) \
                     .select_from(Photo) \
                     .join(User) \
-                    .filter(Photo.id == photo_id) \
-                    .first()
+                    .filter(Photo.id == photo_id)
+        photo = (await session.execute(query)).first()
 
         if not photo:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -247,7 +446,7 @@ class PhotosRepository:
 
 
     async def update_photo_description(self, photo_id: int, description: str,
-                                       current_user: User, session: Session) -> Optional[Photo]:
+                                       current_user: User, session: AsyncSession) -> Optional[Photo]:
         """
         Update the description of a photo with the given photo_id associated with the user
         Args:
@@ -267,20 +466,43 @@ class PhotosRepository:
             .values({"description": description})
             .returning(Photo)
         )
-        photo = session.execute(query).scalar_one_or_none()
+        photo = (await session.execute(query)).scalar_one_or_none()
 
         if not photo:
             raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Photo not found")
         elif photo.user_id != current_user.id and current_user.roles != UserRole.admin:
-            session.rollback()
+            await session.rollback()
             raise HTTPException(status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
 
-        session.commit()
+        await session.commit()
         tags = await TagRepository().get_tags_photo(photo_id, session)
         return {"photo": photo, "tags": tags}
 
 
-    async def get_all_photos(self, page: int, per_page: int, session: Session) -> List[Photo]:
+    def _select_photos(self, user_id: int | None = None):
+        query = select(Photo.id,
+                       Photo.file_url,
+                       Photo.qr_url,
+                       Photo.description,
+                       Photo.created_at,
+                       Photo.user_id,
+                       Photo.width,
+                       Photo.height,
+                       Photo.format,
+                       Photo.file_size,
+                       Photo.orientation,
+                       Photo.dominant_color,
+                       User.username
+                       ) \
+                    .select_from(Photo) \
+                    .join(User) \
+                    .order_by(Photo.created_at.desc(), Photo.id.desc())
+        if user_id:
+            query = query.where(Photo.user_id == user_id)
+        return query
+
+
+    async def get_all_photos(self, page: int = 1, per_page: int = PHOTOS_PER_PAGE, session: AsyncSession = None) -> List[Photo]:
         """
         Retrieve a list of photos with pagination, sorted from newest to oldest
         Args:
@@ -290,30 +512,16 @@ class PhotosRepository:
         Returns:
             List[Photo]: The list of photos
         """
-        result = []
+        page = page if page and page > 0 else 1
+        per_page = per_page if per_page and per_page > 0 else PHOTOS_PER_PAGE
         offset = (page - 1) * per_page
 
-        photos = session.query(Photo.id,
-                               Photo.file_url,
-                               Photo.qr_url,
-                               Photo.description,
-                               Photo.created_at,
-                               Photo.user_id,
-                               User.username
-                              ) \
-                    .select_from(Photo) \
-                    .join(User) \
-                    .all()
-
-        for photo in photos:
-            tags = tags = await TagRepository().get_tags_photo(photo.id, session)
-            comm = await get_comments(page=0, per_page=0, photo_id=photo.id, db=session)
-            result.append({"photo": photo, "tags": tags, "comments": comm})
+        photos = (await session.execute(self._select_photos().limit(per_page).offset(offset))).all()
+        return await self.hydrate_photos(photos, session)
 
-        return result
 
-
-    async def get_photos_by_user(self, user_id: int | None, current_user: User, page: int, per_page: int, session: Session) -> List[Photo]:
+    async def get_photos_by_user(self, user_id: int | None, current_user: User, page: int = 1, per_page: int = PHOTOS_PER_PAGE,
+                                 session: AsyncSession = None) -> List[Photo]:
         """
         Retrieve a list of photos uploaded by a specific user with pagination, sorted from newest to oldest
         Args:
@@ -324,55 +532,60 @@ class PhotosRepository:
         Returns:
             List[Photo]: The list of photos uploaded by the user
         """
-        result = []
+        page = page if page and page > 0 else 1
+        per_page = per_page if per_page and per_page > 0 else PHOTOS_PER_PAGE
         offset = (page - 1) * per_page
         if user_id is None:
             user_id = current_user.id
 
-        photos = session.query(Photo.id,
-                               Photo.file_url,
-                               Photo.qr_url,
-                               Photo.description,
-                               Photo.created_at,
-                               Photo.user_id,
-                               User.username
-                              ) \
-                    .select_from(Photo) \
-                    .join(User) \
-                    .filter(Photo.user_id == user_id) \
-                    .all()
+        photos = (await session.execute(self._select_photos(user_id).limit(per_page).offset(offset))).all()
+        return await self.hydrate_photos(photos, session)
 
-        for photo in photos:
-            tags = tags = await TagRepository().get_tags_photo(photo.id, session)
-            comm = await get_comments(page=0, per_page=0, photo_id=photo.id, db=session)
-            result.append({"photo": photo, "tags": tags, "comments": comm})
 
-        return result
+    async def stream_photos(self, session: AsyncSession, user_id: int | None = None,
+                            batch_size: int = PHOTOS_STREAM_BATCH) -> AsyncIterator[dict]:
+        """
+        Iterate over all photos (of a user), sorted from newest to oldest, without loading them all into memory.
+        Rows are fetched through a server-side cursor in batches of batch_size,
+        tags and comments are loaded with one query per batch.
+        Args:
+            session: The database session
+            user_id: The ID of the user whose photos are being fetched (None - all photos).
+            batch_size (int): The number of photos fetched at once.
+        Yields:
+            dict: {"photo", "tags", "comments"} dictionary
+        """
+        result = await session.stream(self._select_photos(user_id).execution_options(yield_per=batch_size))
+        try:
+            async for photos in result.partitions():
+                for photo in await self.hydrate_photos(photos, session):
+                    yield photo
+        finally:
+            await result.close()
 
 
-    async def get_transform_photos(self, photo_id, session: Session):
-        photo_transforms = session.query(PhotoURL) \
-                                .filter(PhotoURL.photo_id == photo_id) \
-                                .all()
+    async def get_transform_photos(self, photo_id, session: AsyncSession):
+        query = select(PhotoURL).filter(PhotoURL.photo_id == photo_id)
+        photo_transforms = (await session.execute(query)).scalars().all()
         return photo_transforms
 
 
-    async def get_transform_photo(self, photo_id, transform_id, session: Session):
-        photo_transform = session.query(PhotoURL) \
-                                .filter(and_(PhotoURL.photo_id == photo_id, PhotoURL.id == transform_id)) \
-                                .first()
+    async def get_transform_photo(self, photo_id, transform_id, session: AsyncSession):
+        query = select(PhotoURL).filter(and_(PhotoURL.photo_id == photo_id, PhotoURL.id == transform_id))
+        photo_transform = await session.scalar(query)
         return photo_transform
 
 
-    async def upload_transform_photo(self, body: PhotoTransformModel, photo: Photo, db: Session) -> Photo:
+    async def upload_transform_photo(self, body: PhotoTransformModel, photo: Photo, db: AsyncSession) -> Photo:
 
-        url_changed_photo = CloudImage.upload_transform_image(body, photo.file_url)
+        url_changed_photo = await CloudImage.upload_transform_image(body, photo.file_url)
         # print(f">>> UpLoad_transform: {url_changed_photo}")
         err = await Validator().check_transform_url(url_changed_photo)
         if err:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=err)
 
-        photourl = db.query(PhotoURL).filter(PhotoURL.file_url == url_changed_photo).first()
+        photourl = await db.scalar(select(PhotoURL).filter(and_(PhotoURL.photo_id == photo.id,
+                                                                PhotoURL.file_url == url_changed_photo)))
         if photourl:
             return photourl
         
@@ -382,12 +595,12 @@ class PhotosRepository:
             # print(f">>> UpLoad_transform: {params}")
 
             new_photo = PhotoURL(file_url=url_changed_photo,
-                                 photo=photo,
+                                 photo_id=photo.id,
                                  params=params
                                 )
             db.add(new_photo)
-            db.commit()
-            db.refresh(new_photo)
+            await db.commit()
+            await db.refresh(new_photo)
         except Exception as err:
             s = str(err)
             ind = s.find("\n")
@@ -399,15 +612,16 @@ class PhotosRepository:
 
 
     async def update_transform_photo(self, body: PhotoTransformModel, photo: Photo, trans_photo: PhotoURL,
-                                     db: Session) -> Photo:
+                                     db: AsyncSession) -> Photo:
 
-        url_changed_photo = CloudImage.upload_transform_image(body, photo.file_url)
+        url_changed_photo = await CloudImage.upload_transform_image(body, photo.file_url)
         # print(f">>> update_transform: {url_changed_photo}")
         err = await Validator().check_transform_url(url_changed_photo)
         if err:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=err)
 
-        photourl = db.query(PhotoURL).filter(PhotoURL.file_url == url_changed_photo).first()
+        photourl = await db.scalar(select(PhotoURL).filter(and_(PhotoURL.photo_id == photo.id,
+                                                                PhotoURL.file_url == url_changed_photo)))
         if photourl:
             return photourl
         
@@ -417,14 +631,12 @@ class PhotosRepository:
             # print(f">>> update_transform: {params}")
 
             if trans_photo.params != params and trans_photo.qr_url:     # Изменился URL и есть старый QR
-                result = CloudImage.delete_image(trans_photo.qr_url)    # Удалить QR
-                if result:
-                    raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=result)
+                await self.delete_image_later(trans_photo.qr_url, db)    # Удалить QR
                 trans_photo.qr_url = None
 
             trans_photo.file_url = url_changed_photo
             trans_photo.params = params
-            db.commit()
+            await db.commit()
         except Exception as err:
             s = str(err)
             ind = s.find("\n")
@@ -437,79 +649,142 @@ class PhotosRepository:
 
     async def update_qr_url(self, body: PhotoQRCodeModel, photo: Photo | PhotoURL, is_transform: bool=False) -> str:
         qr_name = f"c{photo.id}" if is_transform else f"b{photo.id}"
-        qr_extension = "png"
-
-        qr_os_folder = "./temp_qr_photo"
-        qr_os_path = f"{qr_os_folder}/{qr_name}.{qr_extension}"
-
-        cl_math = re.search(r"/v\d+/(.+)/\w+\.\w+$", photo.file_url)
-        if not cl_math:
-            cl_math = re.search(r"/v\d+/(.+)/\w+$", photo.file_url)
-        ci_folder = cl_math.group(1)
-        qr_ci_folder = f"{ci_folder}/qr"
-
-        if not await aiofiles.os.path.exists(qr_os_folder):
-            await aiofiles.os.mkdir(qr_os_folder)
-
-        qr = qrcode.QRCode()
-        qr.add_data(photo.file_url)
-        qr.make(fit=True)
 
-        img = qr.make_image(fill_color=body.fill_color, back_color=body.back_color)
-        img.save(qr_os_path)
+        ci_folder = CloudImage.get_folder(photo.file_url)
+        qr_ci_folder = f"{ci_folder}/qr" if ci_folder else "qr"
 
-        photo_qr_url = CloudImage.upload_qrcode(qr_os_path, qr_ci_folder, qr_name)
+        qr_png = await qr_renderer.render(photo.file_url, body.fill_color, body.back_color)
 
-        await aiofiles.os.remove(qr_os_path)
+        photo_qr_url = await CloudImage.upload_qrcode(io.BytesIO(qr_png), qr_ci_folder, qr_name)
         return photo_qr_url
 
 
     async def update_photo_qr_url(self, body: PhotoQRCodeModel, photo: Photo | PhotoURL,
-                                  db: Session) -> Photo | PhotoURL:
+                                  db: AsyncSession) -> Photo | PhotoURL:
         if not photo.qr_url:
             photo_qr_url = await self.update_qr_url(body, photo)
             photo.qr_url = photo_qr_url
-            db.commit()
+            await db.commit()
 
         return photo
 
 
     async def update_transphoto_qr_url(self, body: PhotoQRCodeModel, photo: Photo | PhotoURL,
-                                        db: Session) -> Photo | PhotoURL:
+                                        db: AsyncSession) -> Photo | PhotoURL:
         if not photo.qr_url:
             photo_qr_url = await self.update_qr_url(body, photo, True)
             photo.qr_url = photo_qr_url
-            db.commit()
+            await db.commit()
         return photo
 
 
-    async def delete_transform_photo(self, photo: PhotoURL, db: Session) -> None:
-
-        db.delete(photo)
+    async def update_all_qr_urls(self, body: PhotoQRCodeModel, photo: Photo,
+                                 db: AsyncSession) -> List[Photo | PhotoURL]:
+        """
+        Creates the missing QR-codes of a photo and all its transformations at once:
+        at most QR_BULK_CONCURRENCY are rendered and uploaded in parallel, the urls are saved by one commit.
+        The QR-codes created before a failure are saved too, a repeated call creates only the rest.
+        """
+        transforms = await self.get_transform_photos(photo.id, db)
+        items = [(photo, False)] + [(transform, True) for transform in transforms]
+        semaphore = asyncio.Semaphore(QR_BULK_CONCURRENCY)
+
+        async def make_qr(item: Photo | PhotoURL, is_transform: bool) -> str:
+            async with semaphore:
+                return await self.update_qr_url(body, item, is_transform)
+
+        missing = [(item, is_transform) for item, is_transform in items if not item.qr_url]
+        results = await asyncio.gather(*[make_qr(item, is_transform) for item, is_transform in missing],
+                                       return_exceptions=True)
+        errors = []
+        for (item, _), result in zip(missing, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                item.qr_url = result
+        if len(errors) < len(missing):
+            await db.commit()
+        if errors:
+            err = errors[0]
+            raise HTTPException(status.HTTP_400_BAD_REQUEST,
+                                detail=err.detail if isinstance(err, HTTPException) else str(err))
+        return [item for item, _ in items]
+
+
+    async def delete_transform_photo(self, photo: PhotoURL, db: AsyncSession) -> None:
+
+        await db.delete(photo)
 
         if photo.qr_url:
-            result = CloudImage.delete_image(photo.qr_url)
-            if result:
-                db.rollback()
-                raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=result)
+            await self.delete_image_later(photo.qr_url, db)
 
-        db.commit()
+        await db.commit()
 
 
-    async def delete_all_transform_photo(self, photo: Photo, db: Session, is_commit: bool=True) -> None:
+    async def delete_all_transform_photo(self, photo: Photo, db: AsyncSession, is_commit: bool=True) -> None:
 
-        photos_to_del = db.query(PhotoURL).filter(PhotoURL.photo_id == photo.id).all()
+        photos_to_del = (await db.execute(select(PhotoURL).filter(PhotoURL.photo_id == photo.id))).scalars().all()
 
         query = delete(PhotoURL).where(PhotoURL.photo_id == photo.id)
-        db.execute(query)
+        await db.execute(query)
 
         for one_photo in photos_to_del:
             if one_photo.qr_url:
-                result = CloudImage.delete_image(one_photo.qr_url)
-                if result:
-                    db.rollback()
-                    raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=result)
+                await self.delete_image_later(one_photo.qr_url, db)
 
         if is_commit:
-            db.commit()
+            await db.commit()
+
+
+    @staticmethod
+    async def create_all_qr_urls_later(body: PhotoQRCodeModel, photo: Photo, session: AsyncSession) -> int:
+        """
+        Schedule the job creating the missing QR-codes of a photo and its transformations, returns the job id
+        """
+        job = await job_queue.enqueue(session, "create_qr_codes",
+                                      {"photo_id": photo.id, "fill_color": body.fill_color, "back_color": body.back_color},
+                                      key=f"create_qr_codes:{photo.id}")
+        await session.commit()
+        return job.id
+
+
+    @staticmethod
+    async def delete_image_later(image_url: str, session: AsyncSession):
+        """
+        Delete a stored image by a background job, committed together with the session
+        """
+        await job_queue.enqueue(session, "delete_image", {"url": image_url}, key=f"delete_image:{image_url}")
+
+
+@job_queue.handler("delete_image")
+async def delete_image_job(payload: dict, session: AsyncSession):
+    # the stored image is in use again: uploaded and shared by a new photo in the meantime,
+    # or a new QR-code uploaded to the same public_id (another version of the url)
+    public_id = CloudImage.get_public_id(payload["url"])
+    if public_id:
+        part = f"/{public_id}."
+        in_use = or_(exists().where(or_(Photo.file_url.contains(part, autoescape=True),
+                                        Photo.qr_url.contains(part, autoescape=True))),
+                     exists().where(PhotoURL.qr_url.contains(part, autoescape=True)))
+    else:
+        in_use = exists().where(Photo.file_url == payload["url"])
+    if await session.scalar(select(in_use)):
+        return
+    result = await CloudImage.delete_image(payload["url"])
+    if result and result != messages.URL_WITHOUT_PUBLIC_ID:
+        raise RuntimeError(result)
+
+
+@job_queue.handler("create_thumbnails")
+async def create_thumbnails_job(payload: dict, session: AsyncSession):
+    if await session.get(Photo, payload["photo_id"]) is not None:
+        await PhotosRepository().create_thumbnails(payload["photo_id"], session)
+
+
+@job_queue.handler("create_qr_codes")
+async def create_qr_codes_job(payload: dict, session: AsyncSession):
+    photo = await session.get(Photo, payload["photo_id"])
+    if photo is not None:
+        body = PhotoQRCodeModel(fill_color=payload["fill_color"], back_color=payload["back_color"])
+        await PhotosRepository().update_all_qr_urls(body, photo, session)
 
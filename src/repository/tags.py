@@ -1,36 +1,36 @@
-from typing import List
+from typing import List, Dict
 
-from sqlalchemy import select, insert, func, desc
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.database.models import Tag, tag_photo_association as t2p
 
 
 class TagRepository:
 
-    async def check_tag_exist_or_create(self, tag_name: str, session: Session) -> Tag:
+    async def check_tag_exist_or_create(self, tag_name: str, session: AsyncSession) -> Tag:
         """
         Check if a tag with the specified name exists in the database.
         If the tag does not exist, create a new tag with the provided name.
 
         Args:
             tag_name (str): The name of the tag to check or create.
-            session (Session): The database session to use for querying and creating tags.
+            session (AsyncSession): The database session to use for querying and creating tags.
 
         Returns:
             Tag: The existing or newly created Tag object.
         """
         query = select(Tag).where(Tag.name == tag_name)
-        tag = session.execute(query).scalar_one_or_none()
+        tag = (await session.execute(query)).scalar_one_or_none()
         if tag:
             return tag
         query_ = insert(Tag).values(name=tag_name).returning(Tag)
-        new_tag = session.execute(query_).scalar_one()
-        session.commit()
+        new_tag = (await session.execute(query_)).scalar_one()
+        await session.commit()
         return new_tag
 
 
-    async def add_tags_to_photo(self, tags: List[str], photo_id: int, session: Session, is_commit: bool=True) -> List[Tag]:
+    async def add_tags_to_photo(self, tags: List[str], photo_id: int, session: AsyncSession, is_commit: bool=True) -> List[Tag]:
         """
         Add tags to a photo
         Args:
@@ -43,30 +43,77 @@ class TagRepository:
         result = []
         for tag in tags:
             query = select(Tag).where(Tag.name == tag)
-            tag_ = session.execute(query).scalar_one_or_none()
+            tag_ = (await session.execute(query)).scalar_one_or_none()
             if not tag_:
                 query_ = insert(Tag).values(name=tag).returning(Tag)
-                tag_ = session.execute(query_).scalar_one()
+                tag_ = (await session.execute(query_)).scalar_one()
             
             try:
                 query = insert(t2p).values(tag_id=tag_.id, photo_id=photo_id).returning(t2p)
-                add_tag_to_db = session.execute(query)
+                add_tag_to_db = await session.execute(query)
+                await self.change_usage_count([tag_.id], 1, session)
             except Exception as err:
                 if str(err).find("duplicate key") < 0:
                     raise
                 
             result.append(tag_)
         if is_commit:
-            session.commit()
+            await session.commit()
         return result
 
 
-    async def get_tags_photo(self, photo_id: int, session: Session) -> List[Tag]:
+    async def change_usage_count(self, tag_ids: List[int], delta: int, session: AsyncSession) -> None:
+        """
+        Change the usage counters of tags, in the current transaction
+        Args:
+            tag_ids (List[int]): The IDs of the tags.
+            delta (int): +1 when the tags were added to a photo, -1 when removed.
+            session (AsyncSession): The database session.
+        """
+        if tag_ids:
+            query = update(Tag).where(Tag.id.in_(tag_ids)).values(usage_count=Tag.usage_count + delta)
+            await session.execute(query)
+
+
+    async def reconcile_usage_count(self, session: AsyncSession) -> None:
+        """
+        Recalculate the usage counters of all tags from tag_m2m_photo
+        Args:
+            session (AsyncSession): The database session.
+        """
+        photos_count = select(func.count()).select_from(t2p).where(t2p.c.tag_id == Tag.id).scalar_subquery()
+        await session.execute(update(Tag).values(usage_count=photos_count))
+        await session.commit()
+
+
+    async def get_tags_photo(self, photo_id: int, session: AsyncSession) -> List[Tag]:
         tquery = select(Tag).join(t2p).where(Tag.id == t2p.c.tag_id).where(t2p.c.photo_id == photo_id)
-        tags = session.execute(tquery).scalars().all()
+        tags = (await session.execute(tquery)).scalars().all()
         return tags 
 
 
+    async def get_tags_photos(self, photo_ids: List[int], session: AsyncSession) -> Dict[int, List[Tag]]:
+        """
+        Get tags of several photos in a single query
+        Args:
+            photo_ids (List[int]): The IDs of the photos.
+            session (AsyncSession): The database session.
+        Returns:
+            Dict[int, List[Tag]]: Tags grouped by photo_id
+        """
+        result = {photo_id: [] for photo_id in photo_ids}
+        if not photo_ids:
+            return result
+        tquery = select(t2p.c.photo_id, Tag.id, Tag.name) \
+                    .select_from(Tag) \
+                    .join(t2p, Tag.id == t2p.c.tag_id) \
+                    .where(t2p.c.photo_id.in_(photo_ids)) \
+                    .order_by(t2p.c.photo_id, Tag.id)
+        for tag in (await session.execute(tquery)).all():
+            result[tag.photo_id].append(tag)
+        return result
+
+
     async def get_different_tags(self, tags: List[str], tags_photo: List[Tag]) -> (List[str], List[str]):
         diff_list = tags
         tags_list = []
@@ -82,22 +129,18 @@ class TagRepository:
         return diff_list, tags_list
 
 
-    async def get_tags_all(self, session: Session) -> List[Tag]:
-        # tquery = select(Tag)
-        # tags = session.execute(tquery).scalars().all()
-        tags = session.query(Tag) \
-                      .order_by(Tag.name) \
-                      .all()
+    async def get_tags_all(self, session: AsyncSession) -> List[Tag]:
+        tquery = select(Tag).order_by(Tag.name)
+        tags = (await session.execute(tquery)).scalars().all()
         return tags 
 
 
-    async def get_tags_max10(self, session: Session) -> List[Tag]:
-        tags = session.query(Tag.id,
-                             Tag.name,
-                             func.count(Tag.id).label('tag_count')) \
-                        .select_from(Tag) \
-                        .join(t2p) \
-                        .group_by(Tag.id, Tag.name) \
-                        .order_by(desc("tag_count")) \
-                        .limit(10).all()
+    async def get_tags_max10(self, session: AsyncSession) -> List[Tag]:
+        tquery = select(Tag.id,
+                        Tag.name,
+                        Tag.usage_count.label('tag_count')) \
+                    .filter(Tag.usage_count > 0) \
+                    .order_by(desc(Tag.usage_count), Tag.id) \
+                    .limit(10)
+        tags = (await session.execute(tquery)).all()
         return tags 
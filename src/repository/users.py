@@ -2,7 +2,7 @@ from datetime import datetime
 from typing import List
 
 from libgravatar import Gravatar
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import func, and_, or_, select
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -10,9 +10,10 @@ from src.database.db import DBSession
 from src.database.models import User, UserRole, Photo
 from src.schemas import UserModel, UserDbResponse, UserDbAdmin
 from src.services.pager import Pagination
+from src.services.user_cache import user_cache
 
 
-async def get_users(per_page: int, page: int, session: Session) -> List[UserDbAdmin]:
+async def get_users(per_page: int, page: int, session: AsyncSession) -> List[UserDbAdmin]:
     # res = session.query(User.id, 
     #                     User.username,
     #                     User.email,
@@ -40,13 +41,13 @@ async def get_users(per_page: int, page: int, session: Session) -> List[UserDbAd
             .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles, User.confirmed, User.is_banned) 
     # print('>>> get_users(select): ', sel)
     paginate = Pagination(sel, session, page, per_page)
-    res, pages = paginate.get_page()
+    res, pages = await paginate.get_page()
     # res = session.execute(sel).all()
     # print('>>> get_users(result): ', res)
     return res, pages
 
 
-async def get_users_by_mask(per_page: int, page: int, search_mask:str, session: Session) -> List[UserDbAdmin]:
+async def get_users_by_mask(per_page: int, page: int, search_mask:str, session: AsyncSession) -> List[UserDbAdmin]:
     sel_users = select( User.id, 
                         User.username,
                         User.email,
@@ -61,55 +62,57 @@ async def get_users_by_mask(per_page: int, page: int, search_mask:str, session:
                 .filter(or_(User.username.like(search_mask), User.email.like(search_mask)))\
                 .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles, User.confirmed, User.is_banned)
     paginate = Pagination(sel_users, session, page, per_page)
-    res, pages = paginate.get_page()
+    res, pages = await paginate.get_page()
     return res, pages
 
 
-async def toggle_banned_user(user_id: int, db: Session) -> UserDbAdmin:
-    user = db.query(User).filter(User.id == user_id).first()
+async def toggle_banned_user(user_id: int, db: AsyncSession) -> UserDbAdmin:
+    user = await db.scalar(select(User).filter(User.id == user_id))
     if user:
         user.is_banned = not user.is_banned
-        db.commit()
+        await db.commit()
+        await user_cache.invalidate(email=user.email, user_id=user_id)
     return await get_user_by_id(user_id, db)
 
 
-async def set_roles_user(user_id: int, role: UserRole, db: Session) -> UserDbAdmin:
-    user = db.query(User).filter(User.id == user_id).first()
+async def set_roles_user(user_id: int, role: UserRole, db: AsyncSession) -> UserDbAdmin:
+    user = await db.scalar(select(User).filter(User.id == user_id))
     if user:
         user.roles = role
-        db.commit()
+        await db.commit()
+        await user_cache.invalidate(email=user.email, user_id=user_id)
     return await get_user_by_id(user_id, db)
 
 
-async def get_user_by_id(user_id: int, session: Session) -> UserDbAdmin:
-    res = session.query(User.id.label('id'), 
-                        User.username.label('username'),
-                        User.email.label('email'),
-                        User.created_at.label('created_at'),
-                        User.avatar.label('avatar'),
-                        User.roles.label('roles'),
-                        User.confirmed.label('confirmed'),
-                        User.is_banned.label('is_banned'),
-                        func.count(Photo.user_id).label('photo_count')) \
-                .select_from(User) \
-                .join(Photo, isouter=True) \
-                .filter(User.id == user_id) \
-                .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles, User.confirmed, User.is_banned) \
-                .first()
+async def get_user_by_id(user_id: int, session: AsyncSession) -> UserDbAdmin:
+    sel = select(User.id.label('id'), 
+                    User.username.label('username'),
+                    User.email.label('email'),
+                    User.created_at.label('created_at'),
+                    User.avatar.label('avatar'),
+                    User.roles.label('roles'),
+                    User.confirmed.label('confirmed'),
+                    User.is_banned.label('is_banned'),
+                    func.count(Photo.user_id).label('photo_count')) \
+            .select_from(User) \
+            .join(Photo, isouter=True) \
+            .filter(User.id == user_id) \
+            .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles, User.confirmed, User.is_banned)
+    res = (await session.execute(sel)).first()
     return res
 
 
-async def get_user_by_email(email: str, db: Session) -> User:
+async def get_user_by_email(email: str, db: AsyncSession) -> User:
     """
     The get_user_by_email function takes in an email and a database session, then returns the user with that email.
     
     :param email: str: Pass in the email address of the user
-    :param db: Session: Pass the database session to the function
+    :param db: AsyncSession: Pass the database session to the function
     :return: The user object
     :doc-author: Python-WEB13-project-team-2
     """
     # print(f">>> get_user_by_email: {email}")
-    res = db.query(User).filter(User.email == email).first()
+    res = await db.scalar(select(User).filter(User.email == email))
     # res = db.query(User.id.label('id'), 
     #                 User.username.label('username'),
     #                 User.email.label('email'),
@@ -128,17 +131,17 @@ async def get_user_by_email(email: str, db: Session) -> User:
     return res
 
 
-async def create_user(body: UserModel, db: Session) -> User:
+async def create_user(body: UserModel, db: AsyncSession) -> User:
     """
     The create_user function creates a new user in the database.
         Args:
             - body (UserModel): The UserModel object containing the data to be inserted into the database.\n
-            - db (Session): The SQLAlchemy Session object used to interact with the database.
+            - db (AsyncSession): The SQLAlchemy Session object used to interact with the database.
         Returns:
             - User: A newly created user from the database.
     
     :param body: UserModel: Create a new user based on the usermodel schema
-    :param db: Session: Create a new database session
+    :param db: AsyncSession: Create a new database session
     :return: A user object
     :doc-author: Python-WEB13-project-team-2
     """
@@ -151,71 +154,74 @@ async def create_user(body: UserModel, db: Session) -> User:
         avatar = ""
     new_user = User(username=body.username, email=body.email, password=body.password, avatar=avatar)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
-async def update_token(user: User, token: str | None, db: Session) -> None:
+async def update_token(user: User, token: str | None, db: AsyncSession) -> None:
     """
     The update_token function updates the refresh token for a user.
     
     :param user: User: Identify the user in the database
     :param token: str | None: Specify the type of token
-    :param db: Session: Commit the changes to the database
+    :param db: AsyncSession: Commit the changes to the database
     :return: Nothing, so the return type should be none
     :doc-author: Python-WEB13-project-team-2
     """
     user.refresh_token = token
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(email=user.email)
 
 
-async def confirmed_email(email: str, db: Session) -> None:
+async def confirmed_email(email: str, db: AsyncSession) -> None:
     """
     The confirmed_email function sets the confirmed field of a user to True.
     
     :param email: str: Get the email of the user
-    :param db: Session: Access the database
+    :param db: AsyncSession: Access the database
     :return: None, which is not a valid return type
     :doc-author: Python-WEB13-project-team-2
     """
     user = await get_user_by_email(email, db)
     user.confirmed = True
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(email=email)
 
 
-async def update_avatar(user: User, url: str, db: Session) -> UserDbResponse:
+async def update_avatar(user: User, url: str, db: AsyncSession) -> UserDbResponse:
     """
     The update_avatar function updates the avatar of a user.
     
     Args:
         - email (str): The email address of the user to update.\n
         - url (str): The URL for the new avatar image.\n
-        - db (Session, optional): A database session object to use instead of creating one locally. Defaults to None.  # noQA: E501 line too long
+        - db (AsyncSession, optional): A database session object to use instead of creating one locally. Defaults to None.  # noQA: E501 line too long
     
     :param email: Get the user from the database
     :param url: str: Specify that the url parameter is a string
-    :param db: Session: Pass the database session to the function
+    :param db: AsyncSession: Pass the database session to the function
     :return: A user object
     :doc-author: Python-WEB13-project-team-2
     """
     user.avatar = url
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(email=user.email)
     return await get_user_info(user.id, db)
 
 
-async def get_user_info(user_id: int, session: Session) -> UserDbResponse:
-    res = session.query(User.id, 
-                        User.username,
-                        User.email,
-                        User.created_at,
-                        User.avatar,
-                        User.roles,
-                        func.count(Photo.user_id).label('photo_count')) \
-                .select_from(User) \
-                .join(Photo, isouter=True) \
-                .filter(User.id == user_id) \
-                .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles) \
-                .first()
+async def get_user_info(user_id: int, session: AsyncSession) -> UserDbResponse:
+    sel = select(User.id, 
+                    User.username,
+                    User.email,
+                    User.created_at,
+                    User.avatar,
+                    User.roles,
+                    func.count(Photo.user_id).label('photo_count')) \
+            .select_from(User) \
+            .join(Photo, isouter=True) \
+            .filter(User.id == user_id) \
+            .group_by(User.id, User.username, User.email, User.created_at, User.avatar, User.roles)
+    res = (await session.execute(sel)).first()
     return res
     
\ No newline at end of file
@@ -2,9 +2,9 @@ from fastapi import APIRouter, HTTPException, Depends, status, Security, Backgro
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.base import app, templates
+from src.base import templates
 from src.database.db import get_db
 from src.database.models import User
 from src.schemas import UserModel, UserResponse, TokenModel, LoginModel, LoginResponse, RequestEmail, UserDb
@@ -14,6 +14,7 @@ from src.services.auth import auth_service
 from src.services.email import send_email
 from src.services.custom_limiter import RateLimiter
 from src.services.custom_json import Jsons
+from src.services.auth_context import get_user_context, set_user_context
 from src.conf import messages
 from src.routes.forms.signup_form import UserCreateForm
 from src.routes.forms.login_form import LoginForm
@@ -26,14 +27,14 @@ security = HTTPBearer()
 async def register(request: Request):
     return templates.TemplateResponse("auth/signup.html", {"request": request,
                                                            "title": messages.CONTACTS_APP, 
-                                                           "user": app.extra["user"]})
+                                                           "user": get_user_context(request)})
 
 
 @router.post("/signup", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def signup(body: UserModel,
                  background_tasks: BackgroundTasks, 
                  request: Request, 
-                 db: Session = Depends(get_db)):
+                 db: AsyncSession = Depends(get_db)):
     """
     The signup function creates a new user in the database.
         - It also sends an email to the user's email address for confirmation.
@@ -42,7 +43,7 @@ async def signup(body: UserModel,
     :param body: UserModel: Get the user's email and password
     :param background_tasks: BackgroundTasks: Add a task to the background tasks queue
     :param request: Request: Get the base url of the application
-    :param db: Session: Get the database session
+    :param db: AsyncSession: Get the database session
     :return: A dictionary with two keys, user and detail
     :doc-author: Python-WEB13-project-team-2
     """
@@ -55,7 +56,7 @@ async def signup(body: UserModel,
     if exist_user:
         return {"user": user, "detail": {"errors": [{"key": "username", "value": messages.ACCOUNT_ALREADY_EXISTS}]}}
     
-    body.password = auth_service.get_password_hash(body.password)
+    body.password = await auth_service.get_password_hash(body.password)
     new_user = await repository_users.create_user(body, db)
     background_tasks.add_task(send_email, new_user.email, new_user.username, request.base_url)
     
@@ -68,12 +69,12 @@ async def signup(body: UserModel,
 async def login_user(request: Request,
                      response: Response, 
                      body: LoginModel, 
-                     db: Session = Depends(get_db)):
+                     db: AsyncSession = Depends(get_db)):
     """
     The login function is used to authenticate a user.
     
     :param body: OAuth2PasswordRequestForm: Get the username and password from the body of the request
-    :param db: Session: Get the database session
+    :param db: AsyncSession: Get the database session
     :return: An access token and a refresh token
     :doc-author: Python-WEB13-project-team-2
     """
@@ -92,8 +93,11 @@ async def login_user(request: Request,
     if user.is_banned:
         return {"user": Jsons.userresponse_to_json(user), "detail": {"errors": {"key": "message", "value": messages.YOU_ARE_BANNED}}}
     
-    if not auth_service.verify_password(body.password, user.password):
+    is_valid, new_hash = await auth_service.verify_and_update_password(body.password, user.password)
+    if not is_valid:
         return {"user": Jsons.userresponse_to_json(user), "detail": {"errors": {"key": "message", "value": messages.INVALID_PASSWORD}}}
+    if new_hash:
+        user.password = new_hash    # saved with the refresh token below
     
     # Generate JWT
     access_token = await auth_service.create_access_token(data={"sub": user.email})
@@ -104,9 +108,9 @@ async def login_user(request: Request,
 
     user = await repository_users.get_user_by_id(user.id, db)
     log_user = Jsons.userresponse_to_json(user=user, auth=True)
-    app.extra.update({"user": log_user})
+    set_user_context(request, log_user)
 
-    return {"user": app.extra["user"], "detail": {"success": [{"key": "message", "value": messages.LOGIN_SUCCESSFUL},
+    return {"user": get_user_context(request), "detail": {"success": [{"key": "message", "value": messages.LOGIN_SUCCESSFUL},
                                                               {"key": "access_token", "value": f"Bearer {access_token}"},
                                                               {"key": "refresh_token", "value": f"Bearer {refresh_token}"},
                                                               {"key": "reload", "value": "/"}]}}
@@ -115,7 +119,7 @@ async def login_user(request: Request,
 @router.post("/logout")
 async def logout_user(request: Request,
                       response: Response, 
-                      db: Session = Depends(get_db)):
+                      db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db, is_logout=True)
@@ -129,14 +133,14 @@ async def logout_user(request: Request,
 
 
 @router.get('/refresh_token', response_model=TokenModel)
-async def refresh_token(request: Request, credentials: HTTPAuthorizationCredentials = Security(security), db: Session = Depends(get_db)):
+async def refresh_token(request: Request, credentials: HTTPAuthorizationCredentials = Security(security), db: AsyncSession = Depends(get_db)):
     """
     The refresh_token function is used to refresh the access token.
         It takes in a refresh token and returns a new access_token, refresh_token, and token type.
     
     
     :param credentials: HTTPAuthorizationCredentials: Get the token from the authorization header
-    :param db: Session: Get the database session
+    :param db: AsyncSession: Get the database session
     :return: A dictionary with the access_token, refresh_token and token type
     :doc-author: Python-WEB13-project-team-2
     """
@@ -154,7 +158,7 @@ async def refresh_token(request: Request, credentials: HTTPAuthorizationCredenti
 
 
 @router.get('/confirmed_email/{token}')
-async def confirmed_email(request: Request, token: str, db: Session = Depends(get_db)):
+async def confirmed_email(request: Request, token: str, db: AsyncSession = Depends(get_db)):
     """
     The confirmed_email function is used to confirm a user's email address.
         - It takes the token from the URL and uses it to get the user's email address.
@@ -164,13 +168,13 @@ async def confirmed_email(request: Request, token: str, db: Session = Depends(ge
             we call repository_users' confirmed_email function with that user's email as a parameter.
     
     :param token: str: Get the token from the url
-    :param db: Session: Access the database
+    :param db: AsyncSession: Access the database
     :return: A dict with a message
     :doc-author: Python-WEB13-project-team-2
     """
     response_dict = {"request": request,
                      "title": messages.CONTACTS_APP,
-                     "user": app.extra["user"]}
+                     "user": get_user_context(request)}
     errors = {}
     try:
         email = auth_service.get_email_from_token(token)
@@ -193,7 +197,7 @@ async def confirmed_email(request: Request, token: str, db: Session = Depends(ge
 
 @router.post('/request_email')
 async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, request: Request,
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     """
     The request_email function is used to send an email to the user with a link that will allow them
     to confirm their email address. The function takes in a RequestEmail object, which contains the
@@ -202,7 +206,7 @@ async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, r
     :param body: RequestEmail: Get the email from the request body
     :param background_tasks: BackgroundTasks: Add a task to the background tasks queue
     :param request: Request: Get the base url of the application
-    :param db: Session: Pass the database session to the repository_users
+    :param db: AsyncSession: Pass the database session to the repository_users
     :return: A message: check your email for confirmation
     :doc-author: Python-WEB13-project-team-2
     """
@@ -1,11 +1,12 @@
+import json
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, UploadFile, File, Body, Query, HTTPException, status, Request, responses
-from fastapi.responses import JSONResponse, HTMLResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, select
 
-from src.base import app, templates
+from src.base import templates
 from src.database.db import get_db
 from src.database.models import User, UserRole, Photo, PhotoURL
 from src.repository.auth import Auth as repository_auth
@@ -21,7 +22,10 @@ from src.services.validators import Validator
 from src.services.roles import RoleAccess
 from src.services.custom_limiter import RateLimiter
 from src.services.custom_json import Jsons
+from src.services.auth_context import get_user_context
+from src.services.page_cache import page_cache
 from src.conf import messages
+from src.conf.config import PHOTOS_PER_PAGE, SIMILAR_DISTANCE, SIMILAR_MAX_DISTANCE
 
 allowed_operation_all = RoleAccess([UserRole.admin, UserRole.moderator, UserRole.user])
 # allowed_operation = RoleAccess([UserRole.admin, UserRole.user])
@@ -35,50 +39,88 @@ async def get_and_search_photos(request: Request,
                                 per_page: int = Query(None, description="Items per page"),
                                 user_id: int = Query(None, description="Filter by user"),
                                 keyword: str = Query(None, description="Keyword to search in photo descriptions"),
-                                tag: str = Query(None, description="Filter photos by tag"),
-                                order_by: str = Query("newest", description="Sort order date('newest' or 'oldest'"),
-                                db: Session = Depends(get_db)):
+                                tag: List[str] = Query(None, description="Filter photos by tags"),
+                                match: str = Query("all", description="Tags match('all' or 'any')"),
+                                order_by: str = Query("newest", description="Sort order date('newest' or 'oldest') or 'rank' of keyword relevance"),
+                                cursor: str = Query(None, description="Cursor of the next/previous page"),
+                                db: AsyncSession = Depends(get_db)):
 
     await repository_auth().check_authentication(request=request, db=db)
     # print(request.url)
     # print(f'page = {page}, per_page = {per_page}')
-    photos, pages = await PhotosRepository().search_photos(db, page, per_page, user_id, keyword, tag, order_by)
+    photos, pages = await PhotosRepository().search_photos(db, page, per_page, user_id, keyword, tag, order_by, cursor, match)
     return photos, pages
 
 
 @router.get('/photo-add', response_class=HTMLResponse)
 # @router.get('/photo-add', response_model=List[TagDetail])
 async def new_photo(request: Request, 
-                    db: Session = Depends(get_db)):
+                    db: AsyncSession = Depends(get_db)):
     
     current_user = await repository_auth().check_authentication(request=request, db=db)
     if current_user:
         tags = await TagRepository().get_tags_all(session=db)
         return templates.TemplateResponse('photo/photo-add.html', {"request": request,
                                                                    "title": messages.CONTACTS_APP, 
-                                                                   "user": app.extra["user"],
+                                                                   "user": get_user_context(request),
                                                                    "tags": Jsons.list_tagresponse_to_json(tags)})
     return responses.RedirectResponse("/",
                                       status_code=status.HTTP_302_FOUND)
 
 
+@router.get('/stream', response_class=StreamingResponse, description="All photos as NDJSON, one photo per line")
+async def stream_photos(request: Request,
+                        user_id: int = Query(None, description="Filter by user"),
+                        db: AsyncSession = Depends(get_db)):
+
+    await repository_auth().check_authentication(request=request, db=db)
+
+    async def photos_ndjson():
+        async for photo in PhotosRepository().stream_photos(session=db, user_id=user_id):
+            yield json.dumps(Jsons.photoresponse_to_json(photo), default=str) + "\n"
+
+    return StreamingResponse(photos_ndjson(), media_type="application/x-ndjson")
+
+
+@router.get('/{photo_id}/similar', response_model=List[PhotoResponse])
+async def get_similar_photos(request: Request,
+                             photo_id: int,
+                             distance: int = Query(SIMILAR_DISTANCE, ge=0, le=SIMILAR_MAX_DISTANCE,
+                                                   description="Largest Hamming distance of the perceptual hashes, bits"),
+                             limit: int = Query(PHOTOS_PER_PAGE, ge=1, le=100, description="Maximum number of photos"),
+                             db: AsyncSession = Depends(get_db)):
+
+    await repository_auth().check_authentication(request=request, db=db)
+    return await PhotosRepository().get_similar_photos(photo_id, distance, limit, db)
+
+
 @router.get('/{photo_id}', response_model=PhotoResponse, response_class=HTMLResponse)
 async def get_photo_by_id(request: Request, 
                           photo_id: int,
-                          db: Session = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db)):
+    cache_key = page_cache.get_key(request)
+    if cache_key:
+        cached = await page_cache.get(cache_key)
+        if cached:
+            return cached
+        generation = await page_cache.generation()
+
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
 
     image = await PhotosRepository().get_photo_by_id(photo_id, db)
     tags = await TagRepository().get_tags_all(session=db)
     transforms = await PhotosRepository().get_transform_photos(photo_id=photo_id, session=db)
-    return templates.TemplateResponse('photo/photo.html', {"request": request,
-                                                            "title": messages.CONTACTS_APP, 
-                                                            "user": app.extra["user"],
-                                                            "roles": UserRole,
-                                                            "photo": Jsons.photoresponse_to_json(image),
-                                                            "tags": Jsons.list_tagresponse_to_json(tags),
-                                                            "transforms": Jsons.list_transformphotoresponse_to_json(transforms)})
+    response = templates.TemplateResponse('photo/photo.html', {"request": request,
+                                                                "title": messages.CONTACTS_APP, 
+                                                                "user": get_user_context(request),
+                                                                "roles": UserRole,
+                                                                "photo": Jsons.photoresponse_to_json(image),
+                                                                "tags": Jsons.list_tagresponse_to_json(tags),
+                                                                "transforms": Jsons.list_transformphotoresponse_to_json(transforms)})
+    if cache_key:
+        page_cache.set(cache_key, response.body, generation)
+    return response
 
 
 # @router.post('/', status_code=201, response_model=PhotoExtResponse, dependencies=[Depends(allowed_operation_all)])
@@ -86,7 +128,7 @@ async def get_photo_by_id(request: Request,
 async def upload_photo(request: Request,
                        body: PhotoNewModel = Body(...),
                        photo_file: UploadFile = File(...),
-                       db: Session = Depends(get_db)):
+                       db: AsyncSession = Depends(get_db)):
     url_redirect = "/"
     message = ""
     check_auth = repository_auth()
@@ -117,7 +159,7 @@ async def upload_photo(request: Request,
 async def add_tag_to_photo(request: Request,
                            photo_id: int,
                            body: PhotoAddTagsModel,
-                           db: Session = Depends(get_db)):
+                           db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
@@ -139,7 +181,7 @@ async def add_tag_to_photo(request: Request,
 async def remove_tag_from_photo(request: Request,
                                 photo_id: int,
                                 tag: str,
-                                db: Session = Depends(get_db)):
+                                db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
@@ -161,7 +203,7 @@ async def remove_tag_from_photo(request: Request,
 async def update_photo_description(request: Request,
                                    photo_id: int,
                                    body: PhotoUpdateModel,
-                                   db: Session = Depends(get_db)):
+                                   db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
@@ -182,7 +224,7 @@ async def update_photo_description(request: Request,
 @router.delete('/{photo_id}', response_model=DetailResponse, status_code=200, dependencies=[Depends(allowed_operation_all)])
 async def delete_photo(request: Request,
                        photo_id: int,
-                       db: Session = Depends(get_db)):
+                       db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
@@ -204,7 +246,7 @@ async def delete_photo(request: Request,
 async def get_photo_transform( request: Request, 
                                photo_id: int,
                                transform_id: int=None,
-                               db: Session = Depends(get_db)):
+                               db: AsyncSession = Depends(get_db)):
     
     message = ""
     check_auth = repository_auth()
@@ -218,7 +260,7 @@ async def get_photo_transform( request: Request,
 
             return templates.TemplateResponse('photo/photo-trans.html', {"request": request,
                                                                         "title": messages.CONTACTS_APP, 
-                                                                        "user": app.extra["user"],
+                                                                        "user": get_user_context(request),
                                                                         "photo": Jsons.only_photoresponse_to_json(image["photo"]),
                                                                         "transform": Jsons.transformphotoresponse_to_json(transform),
                                                                         "qualifiers": qualifiers})
@@ -239,14 +281,14 @@ async def get_photo_transform( request: Request,
 async def photo_transform(request: Request, 
                           body: PhotoTransformModel, 
                           photo_id: int,
-                          db: Session = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db)):
 
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
     if current_user:
         try:
-            base_photo = db.query(Photo).filter(Photo.id == photo_id).first()
+            base_photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
 
             if base_photo is None:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -277,14 +319,14 @@ async def update_photo_transform(request: Request,
                                  body: PhotoTransformModel,
                                  photo_id: int,
                                  transform_id: int,
-                                 db: Session = Depends(get_db)):
+                                 db: AsyncSession = Depends(get_db)):
 
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
     if current_user:
         try:
-            base_photo = db.query(Photo).filter(Photo.id == photo_id).first()
+            base_photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
 
             if base_photo is None:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -292,7 +334,7 @@ async def update_photo_transform(request: Request,
             if base_photo.user_id != current_user.id:
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
 
-            photourl = db.query(PhotoURL).filter(and_(PhotoURL.photo_id == photo_id, PhotoURL.id == transform_id)).first()
+            photourl = await db.scalar(select(PhotoURL).filter(and_(PhotoURL.photo_id == photo_id, PhotoURL.id == transform_id)))
             if not photourl:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.TRANS_PHOTO_NOT_FOUND)
 
@@ -317,13 +359,13 @@ async def update_photo_transform(request: Request,
 async def create_qrcode(request: Request,
                         body: PhotoQRCodeModel,
                         photo_id: int,
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
     if current_user:
         try:
-            base_photo = db.query(Photo).filter(Photo.id == photo_id).first()
+            base_photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
 
             if base_photo is None:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -353,14 +395,14 @@ async def create_trans_qrcode(request: Request,
                               body: PhotoQRCodeModel, 
                               photo_id: int, 
                               transform_photo_id: int,
-                              db: Session = Depends(get_db)):
+                              db: AsyncSession = Depends(get_db)):
 
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
     if current_user:
         try:
-            base_photo = db.query(Photo).filter(Photo.id == photo_id).first()
+            base_photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
 
             if base_photo is None:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -369,8 +411,8 @@ async def create_trans_qrcode(request: Request,
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
 
             if transform_photo_id:
-                photo = db.query(PhotoURL).filter(and_(PhotoURL.photo_id == photo_id,
-                                                        PhotoURL.id == transform_photo_id)).first()
+                photo = await db.scalar(select(PhotoURL).filter(and_(PhotoURL.photo_id == photo_id,
+                                                        PhotoURL.id == transform_photo_id)))
                 if photo is None:
                     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.TRANS_PHOTO_NOT_FOUND)
             else:
@@ -390,20 +432,62 @@ async def create_trans_qrcode(request: Request,
                                       status_code=status.HTTP_302_FOUND)
 
 
+@router.post("/{photo_id}/qrcodes",
+             response_model=DetailResponse,
+             description=messages.NO_MORE_THAN_10_REQUESTS_PER_MINUTE,
+             dependencies=[Depends(allowed_operation_all), Depends(RateLimiter(times=10, seconds=60))])
+async def create_all_qrcodes(request: Request,
+                             body: PhotoQRCodeModel,
+                             photo_id: int,
+                             db: AsyncSession = Depends(get_db)):
+    """
+    Schedules a background job creating the missing QR-codes of a photo and all its transformations.
+    Returns the job id and the QR-code urls existing already:
+    "qr_url" of the photo and "qr_url_<id>" of every transformation.
+    """
+    message = ""
+    check_auth = repository_auth()
+    current_user = await check_auth.check_authentication(request=request, db=db)
+    if current_user:
+        try:
+            base_photo = await db.scalar(select(Photo).filter(Photo.id == photo_id))
+
+            if base_photo is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
+
+            if current_user.roles == UserRole.user and base_photo.user_id != current_user.id:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=messages.OPERATION_NOT_AVAILABLE)
+
+            job_id = await PhotosRepository().create_all_qr_urls_later(body, base_photo, db)
+            photos = [base_photo] + list(await db.scalars(select(PhotoURL).filter(PhotoURL.photo_id == photo_id)))
+            success = [{"key": "job_id", "value": f"{job_id}"}]
+            success += [{"key": "qr_url" if isinstance(photo, Photo) else f"qr_url_{photo.id}", "value": f"{photo.qr_url}"}
+                        for photo in photos if photo.qr_url]
+            return {"detail": {"success": success}}
+
+        except HTTPException as err:
+            return {"detail": {"errors": [{"key": "error-msg", "value": err.detail}]}}
+    else:
+        message = check_auth.errors[0]["value"]
+
+    return responses.RedirectResponse(f"/api/photos/{photo_id}/?message={message}",
+                                      status_code=status.HTTP_302_FOUND)
+
+
 @router.delete("/{photo_id}/{transform_photo_id}",
                status_code=204,
                description=messages.NO_MORE_THAN_10_REQUESTS_PER_MINUTE,
                dependencies=[Depends(allowed_operation_all), Depends(RateLimiter(times=10, seconds=60))])
 async def delete_transform_photo(photo_id: int,
                                  transform_photo_id: int,
-                                 user: User = Depends(auth_service.get_current_user), db: Session = Depends(get_db)):
+                                 user: User = Depends(auth_service.get_current_user), db: AsyncSession = Depends(get_db)):
 
-    photo = db.query(PhotoURL).filter(and_(Photo.id == photo_id, PhotoURL.id == transform_photo_id)).first()
+    photo = await db.scalar(select(PhotoURL).filter(and_(Photo.id == photo_id, PhotoURL.id == transform_photo_id)))
 
     if photo is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.TRANS_PHOTO_NOT_FOUND)
 
-    base_photo = db.query(Photo).filter(Photo.id == photo.photo_id).first()
+    base_photo = await db.scalar(select(Photo).filter(Photo.id == photo.photo_id))
 
     if base_photo is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.PHOTO_NOT_FOUND)
@@ -418,7 +502,7 @@ async def delete_transform_photo(photo_id: int,
 async def create_comment(request: Request,
                          photo_id: int,
                          body: CommentModel,
-                         db: Session = Depends(get_db)):
+                         db: AsyncSession = Depends(get_db)):
     message = ""
     check_auth = repository_auth()
     current_user = await check_auth.check_authentication(request=request, db=db)
@@ -443,7 +527,7 @@ async def update_comment(photo_id: int,
                          comment_id: int,
                          body: CommentModel,
                          user: User = Depends(auth_service.get_current_user),
-                         db: Session = Depends(get_db)):
+                         db: AsyncSession = Depends(get_db)):
     comment = await repository_comments.update_comment(photo_id, comment_id, body, user, db)
     return comment
 
@@ -454,6 +538,6 @@ async def update_comment(photo_id: int,
 async def delete_comment(photo_id: int,
                          comment_id: int,
                          user: User = Depends(auth_service.get_current_user),
-                         db: Session = Depends(get_db)):
+                         db: AsyncSession = Depends(get_db)):
     comment = await repository_comments.delete_comment(photo_id, comment_id, user, db)
     return comment
@@ -2,9 +2,9 @@ from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Path, Request, Response, responses
 # from fastapi_limiter.depends import RateLimiter
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.base import app, templates
+from src.base import templates
 from src.database.db import get_db
 from src.database.models import User, UserRole
 from src.repository import users as repository_users
@@ -15,6 +15,7 @@ from src.services.roles import RoleAccess
 from src.conf import messages
 from src.services.custom_limiter import RateLimiter
 from src.services.custom_json import Jsons
+from src.services.auth_context import get_user_context
 
 allowed_operation_all = RoleAccess([UserRole.admin, UserRole.moderator, UserRole.user])
 allowed_operation_notuser = RoleAccess([UserRole.admin, UserRole.moderator])
@@ -34,7 +35,7 @@ async def get_users(request: Request,
                     # offset: int = 0, 
                     search_mask: str = '',
                     # current_user: User = Depends(auth_service.get_current_user),
-                    db: Session = Depends(get_db)):
+                    db: AsyncSession = Depends(get_db)):
 
     current_user = await repository_auth().check_authentication(request=request, db=db)
     if current_user:
@@ -46,7 +47,7 @@ async def get_users(request: Request,
             users, pages = await repository_users.get_users_by_mask(per_page, page, search_mask, db)
         return templates.TemplateResponse("users/users.html", {"request": request,
                                                                 "title": messages.CONTACTS_APP, 
-                                                                "user": app.extra["user"],
+                                                                "user": get_user_context(request),
                                                                 "roles": UserRole,
                                                                 "users": Jsons.list_useradminresponse_to_json(users),
                                                                 "pages": pages})
@@ -61,7 +62,7 @@ async def get_users(request: Request,
 async def get_user(request: Request,
                    user_id: int = Path(ge=1),
                 #    current_user: User = Depends(auth_service.get_current_user),
-                   db: Session = Depends(get_db)):
+                   db: AsyncSession = Depends(get_db)):
 
     current_user = await repository_auth().check_authentication(request=request, db=db)
     if current_user:
@@ -70,7 +71,7 @@ async def get_user(request: Request,
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=messages.NOT_FOUND)
         return templates.TemplateResponse("users/user.html", {"request": request,
                                                               "title": messages.CONTACTS_APP, 
-                                                              "user": app.extra["user"],
+                                                              "user": get_user_context(request),
                                                               "roles": UserRole,
                                                               "user1": Jsons.useradminresponse_to_json(user)})
     return responses.RedirectResponse("/",
@@ -84,7 +85,7 @@ async def get_user(request: Request,
 async def toogle_banned_user(request: Request,
                              user_id: int = Path(ge=1),
                             #  current_user: User = Depends(auth_service.get_current_user),
-                             db: Session = Depends(get_db)):
+                             db: AsyncSession = Depends(get_db)):
     # print(f">>> toggle_ban user_id: {user_id}")
     current_user = await repository_auth().check_authentication(request=request, db=db)
     if current_user:
@@ -111,7 +112,7 @@ async def set_roles_user(request: Request,
                          user_id: int = Path(ge=1),
                          user_roles: str = 'user',
                         #  current_user: User = Depends(auth_service.get_current_user),
-                         db: Session = Depends(get_db)):
+                         db: AsyncSession = Depends(get_db)):
     # print(f">>> user_id: {user_id}, new_roles: {user_roles}")
     current_user = await repository_auth().check_authentication(request=request, db=db)
     if current_user:
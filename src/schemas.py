@@ -82,6 +82,12 @@ class PhotoSchema(BaseModel):
     created_at: datetime
     user_id: int
     username: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    format: Optional[str] = None
+    file_size: Optional[int] = None
+    orientation: Optional[int] = None
+    dominant_color: Optional[str] = None
 
 
 class PhotoUpdateModel(BaseModel):
@@ -1,24 +1,34 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 # import pickle
 
 from jose import JWTError, jwt
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Request
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 # import redis
 
-from src.base import app
 from src.database.db import get_db
 from src.repository import users as repository_users
-from src.conf.config import settings
+from src.conf.config import settings, PASSWORD_WORKERS
 from src.conf import messages
 from src.services.utils import OAuth2PasswordBearerWithCookie
+from src.services.user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
 
 class Auth:
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # a hash of another work factor needs an update: it is rehashed at the next login
+    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds,
+                               bcrypt__min_rounds=settings.bcrypt_rounds, bcrypt__max_rounds=settings.bcrypt_rounds)
+    # bcrypt releases the GIL, so a thread pool keeps the event loop free
+    pwd_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
     # oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
     oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="/api/auth/login")
 
@@ -26,7 +36,7 @@ class Auth:
     ALGORITHM = settings.algorithm
     # r = redis.Redis(host=settings.redis_host, port=settings.redis_port, password=settings.redis_password, db=0)
 
-    def verify_password(self, plain_password, hashed_password):
+    async def verify_password(self, plain_password, hashed_password):
         """
         The verify_password function takes a plain-text password and the hashed version of that password,
             and returns True if they match, False otherwise. This is used to verify that the user's login
@@ -38,9 +48,22 @@ class Auth:
         :return: True if the password is correct
         :doc-author: Python-WEB13-project-team-2
         """
-        return self.pwd_context.verify(plain_password, hashed_password)
+        return await self.run_in_pool(self.pwd_context.verify, plain_password, hashed_password)
+
+    async def verify_and_update_password(self, plain_password: str, hashed_password: str) -> Tuple[bool, str | None]:
+        """
+        The verify_and_update_password function verifies a password like verify_password and also returns
+            a new hash of it when the stored one is made with another work factor (or a deprecated scheme).
+        
+        :param self: Represent the instance of the class
+        :param plain_password: str: Check the password entered by the user
+        :param hashed_password: str: The stored hash of the password
+        :return: (True if the password is correct, the new hash or None)
+        :doc-author: Python-WEB13-project-team-2
+        """
+        return await self.run_in_pool(self.pwd_context.verify_and_update, plain_password, hashed_password)
 
-    def get_password_hash(self, password: str):
+    async def get_password_hash(self, password: str):
         """
         The get_password_hash function takes a password as input and returns the hash of that password.
             The function uses the pwd_context object to generate a hash from the given password.
@@ -50,7 +73,11 @@ class Auth:
         :return: A hash of the password
         :doc-author: Python-WEB13-project-team-2
         """
-        return self.pwd_context.hash(password)
+        return await self.run_in_pool(self.pwd_context.hash, password)
+
+    async def run_in_pool(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pwd_executor, func, *args)
 
     # define a function to generate a new access token
     async def create_access_token(self, data: dict, expires_delta: Optional[float] = None):
@@ -117,20 +144,48 @@ class Auth:
             print(err)
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=messages.COULD_NOT_VALIDATE_CREDENTIALS)
 
-    # async def get_current_user(self, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    async def get_current_user(self, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    # async def get_current_user(self, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    async def get_current_user(self, request: Request = None, token: str = Depends(oauth2_scheme),
+                               db: AsyncSession = Depends(get_db)):
         """
         The get_current_user function is a dependency that will be used in the UserController class.
             It takes in a token and db session as parameters, and returns the user object associated with
             the email address stored within the JWT token. If no user exists for that email address, or if 
             the JWT token is invalid, an HTTPException will be raised.
+            The user is resolved once per request (memo in request.state) and is cached by (email, token iat).
         
         :param self: Represent the instance of a class
+        :param request: Request: Keep the user resolved within the request
         :param token: str: Get the token from the request header
-        :param db: Session: Get the database session
+        :param db: AsyncSession: Get the database session
         :return: A user object
         :doc-author: Python-WEB13-project-team-2
         """
+        memo = getattr(request.state, "auth_user", None) if request is not None else None
+        if memo and memo[0] == token:
+            user = memo[1]
+            if isinstance(user, HTTPException):
+                raise user
+            if user not in db:
+                # resolved by the middleware in its own session
+                user = await db.merge(user, load=False)
+                request.state.auth_user = (token, user)
+            return user
+
+        try:
+            user = await self.resolve_user(token, db)
+        except HTTPException as err:
+            if request is not None:
+                request.state.auth_user = (token, err)
+            raise
+        if request is not None:
+            request.state.auth_user = (token, user)
+        return user
+
+    async def resolve_user(self, token: str, db: AsyncSession):
+        """
+        The user of an access token: from the cache of the users or the database
+        """
         credentials_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=messages.COULD_NOT_VALIDATE_CREDENTIALS,
@@ -146,26 +201,28 @@ class Auth:
                 # print(f">>> get_current_user: email={email}")
                 if email is None:
                     # print(">>> get_current_user: email is None")
-                    app.extra["user"].update({"is_authenticated": False})
                     raise credentials_exception
             else:
                 # print(">>> get_current_user: payload['scope'] != 'access_token'")
-                app.extra["user"].update({"is_authenticated": False})
                 raise credentials_exception
         except JWTError as e:
             # print(f">>> get_current_user: except JWTError \"{e}\"")
-            app.extra["user"].update({"is_authenticated": False})
             raise credentials_exception
 
+        key = (email, payload.get("iat"))
         try:
-            user = await repository_users.get_user_by_email(email, db)
+            user = await user_cache.get(key, db)
+            if user is None:
+                version = await user_cache.version(email)
+                user = await repository_users.get_user_by_email(email, db)
+                if user is not None and version is not None:
+                    user_cache.set(key, user, version)
         except SQLAlchemyError as err:
-            app.extra["user"].update({"is_authenticated": False})
+            logger.error(f"get_current_user: {err}")
             raise credentials_exception
 
         if user is None:
             # print(">>> get_current_user: user is None")
-            app.extra["user"].update({"is_authenticated": False})
             raise credentials_exception
         return user
 
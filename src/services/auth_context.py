@@ -0,0 +1,15 @@
+from fastapi import Request
+
+ANONYMOUS_USER = {"is_authenticated": False}
+
+
+def get_user_context(request: Request) -> dict:
+    """
+    The user of the request as rendered by the templates (Jsons.userresponse_to_json),
+    resolved by the auth context middleware
+    """
+    return getattr(request.state, "user", None) or dict(ANONYMOUS_USER)
+
+
+def set_user_context(request: Request, user: dict | None):
+    request.state.user = user or dict(ANONYMOUS_USER)
@@ -1,24 +1,82 @@
-import re
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-import cloudinary
-import cloudinary.uploader
+import urllib3
+import cloudinary.exceptions
+from fastapi import HTTPException, status
 
-from src.conf.config import settings
+from src.conf import messages
+from src.conf.config import settings, CLOUDINARY_WORKERS, CLOUDINARY_TIMEOUT, CLOUDINARY_RETRIES, CLOUDINARY_BACKOFF
 from src.database.models import User
+from src.services.storage import StorageBackend, get_storage
+
+# Errors worth another attempt: network failures, timeouts and throttling;
+# not OSError as a whole, a missing file or a denied permission fails the same way again
+TRANSIENT_ERRORS = (cloudinary.exceptions.GeneralError, cloudinary.exceptions.RateLimited,
+                    asyncio.TimeoutError, ConnectionError, urllib3.exceptions.HTTPError)
+# the prefixes of the messages the SDK wraps the transport failures in, as a bare cloudinary.exceptions.Error
+TRANSIENT_SDK_MESSAGES = ("Socket error", "Unexpected error")
+
+
+def is_transient(err: Exception) -> bool:
+    if isinstance(err, TRANSIENT_ERRORS):
+        return True
+    return type(err) is cloudinary.exceptions.Error and str(err).startswith(TRANSIENT_SDK_MESSAGES)
+
+
+class CloudClient:
+    """
+    Async facade over a blocking storage backend: the calls run on a bounded thread pool,
+    each attempt is limited by timeout, transient errors are retried with exponential backoff.
+    """
+    def __init__(self, backend: StorageBackend, workers: int=CLOUDINARY_WORKERS, timeout: float=CLOUDINARY_TIMEOUT,
+                 retries: int=CLOUDINARY_RETRIES, backoff: float=CLOUDINARY_BACKOFF):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cloudinary")
+
+    async def call(self, func, *args, **kwargs):
+        return await self.run(partial(func, *args, **kwargs), self.timeout)
+
+    async def run(self, func, timeout: float | None):
+        """
+        Run func on the pool with retries, each attempt limited by timeout (None - not limited here)
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                future = loop.run_in_executor(self.executor, func)
+                return await (asyncio.wait_for(future, timeout) if timeout else future)
+            except Exception as err:
+                if not is_transient(err) or attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def upload(self, file, **options) -> dict:
+        def upload_from_start():
+            # a retried attempt must send the whole file again
+            if hasattr(file, "seek"):
+                file.seek(0)
+            return self.backend.upload(file, **options)
+        # Not cut by wait_for: the thread of an abandoned attempt would go on reading the file
+        # while the retry rewinds it, and could still upload it a second time.
+        # The backend limits the attempt by the timeout of its SDK, so a retry starts after it is over.
+        return await self.run(upload_from_start, None)
+
+    async def destroy(self, public_id: str) -> dict:
+        return await self.call(self.backend.destroy, public_id)
+
+
+cloud_client = CloudClient(get_storage(settings.storage_backend))
 
 
 class CloudImage:
 
-    cloudinary.config(
-        cloud_name=settings.cloudinary_name,
-        api_key=settings.cloudinary_api_key,
-        api_secret=settings.cloudinary_api_secret,
-        secure=True
-    )
-
-
     @staticmethod
-    def upload_image(photo_file, user: User, folder: str=None) -> str:
+    async def upload_image(photo_file, user: User, folder: str=None) -> str:
         """
         The upload function takes a file and public_id as arguments.
             The function then uploads the file to Cloudinary with the given public_id, overwriting any existing files with that id.
@@ -30,36 +88,30 @@ class CloudImage:
         """
         if not folder:
             folder = user.username
-        res = cloudinary.uploader.upload(photo_file, folder=folder)
+        res = await cloud_client.upload(photo_file, folder=folder)
         return res["secure_url"]
 
 
     @staticmethod
-    def delete_image(image_url: str):
-        pattern = r"/v\d+/(.*?)\."
-        match = re.search(pattern, image_url)
-        if not match:
-            pattern = r"/v\d+/(.*?)$"
-            match = re.search(pattern, image_url)
-        if match:
-            public_id = match.group(1)
-            result = cloudinary.uploader.destroy(public_id)
+    async def delete_image(image_url: str):
+        public_id = cloud_client.backend.get_public_id(image_url)
+        if public_id:
+            result = await cloud_client.destroy(public_id)
             if result.get('result') == 'ok':
                 return ""
             else:
                 return result.get('message')
         else:
-            return "URL does not contain 'public_id' Cloudinary"
+            return messages.URL_WITHOUT_PUBLIC_ID
 
 
     @staticmethod
-    def upload_transform_image(body, photo_file_url) -> str:
+    async def upload_transform_image(body, photo_file_url) -> str:
 
         def prepare_property(value):
             prls = value.split('||')
             return prls[len(prls)-1]
         
-        public_id = re.search(r"/v\d+/(.+)\.\w+$", photo_file_url).group(1)
         trans_params = []
         
         trans = {}
@@ -86,15 +138,56 @@ class CloudImage:
             trans_params.append({'angle': prepare_property(body.angle)})
         print(f'>>> trans_params = {trans_params}')
 
-        url_changed_photo = cloudinary.CloudinaryImage(f"{public_id}").build_url(transformation=trans_params)
-        return url_changed_photo
+        return await CloudImage.build_transform_url(photo_file_url, trans_params)
+
+
+    @staticmethod
+    async def build_transform_url(photo_file_url: str, trans_params: list) -> str:
+        """
+        Url of the stored image with the transformations applied, in the Cloudinary format of trans_params
+        """
+        public_id = cloud_client.backend.get_public_id(photo_file_url)
+        try:
+            # LocalStorage renders the image here, keep it off the event loop
+            return await cloud_client.call(cloud_client.backend.build_url, public_id, trans_params)
+        except NotImplementedError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=messages.TRANSFORM_NOT_SUPPORTED)
+        except ValueError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+
+
+    @staticmethod
+    async def build_thumbnail_url(photo_file_url: str, width: int, fetch_format: str) -> str:
+        """
+        Url of a thumbnail: not wider than width, never upscaled
+        """
+        trans_params = [{'width': str(width), 'crop': 'limit'}, {'quality': 'auto'}, {'fetch_format': fetch_format}]
+        return await CloudImage.build_transform_url(photo_file_url, trans_params)
+
+
+    @staticmethod
+    def supports_format(fetch_format: str) -> bool:
+        return cloud_client.backend.supports_format(fetch_format)
+
+
+    @staticmethod
+    def get_public_id(image_url: str) -> str | None:
+        return cloud_client.backend.get_public_id(image_url)
+
+
+    @staticmethod
+    def get_folder(image_url: str) -> str:
+        """
+        The folder of a stored image, used to put its QR-code next to it
+        """
+        return cloud_client.backend.get_folder(image_url)
 
 
     @staticmethod
-    def upload_qrcode(qr_os_path, qr_ci_folder, qr_name) -> str:
+    async def upload_qrcode(qr_file, qr_ci_folder, qr_name) -> str:
 
-        result = cloudinary.uploader.upload(
-            qr_os_path,
+        result = await cloud_client.upload(
+            qr_file,
             folder=qr_ci_folder,
             resource_type="image",
             public_id=f"{qr_name}"
@@ -9,6 +9,9 @@ from src.schemas import (UserDbResponse, UserDbAdmin, UserRole,
                          PhotoResponse, CommentResponse, TagDetail, PhotoSchema, 
                          PhotoURLResponse, PhotoTransformModel)
 
+# Image metadata stored at upload, None for the photos uploaded before
+PHOTO_METADATA = ("width", "height", "format", "file_size", "orientation", "dominant_color")
+
 
 class Jsons:
 
@@ -76,6 +79,8 @@ class Jsons:
                         "created_at": photo.created_at.strftime("%Y-%m-%d %H:%M:%S.%f"), #"2023-10-22T04:04:09.329393"
                         "user_id": photo.user_id,
                     }
+        for field in PHOTO_METADATA:
+            res_photo.update({field: getattr(photo, field, None)})
         try:
             res_photo.update({"username": photo.username})
         except:
@@ -89,6 +94,7 @@ class Jsons:
         ph = photo["photo"]
         res_photo = {"photo": Jsons.only_photoresponse_to_json(ph)
                     }
+        res_photo["photo"].update({"srcset": Jsons.thumbnails_to_srcset(photo.get("thumbnails") or [])})
 
         res_tags = []
         for tag in photo["tags"]:
@@ -103,6 +109,19 @@ class Jsons:
         return res_photo
 
 
+    @staticmethod
+    def thumbnails_to_srcset(thumbnails: list) -> Dict[str, str]:
+        """
+        {format: "url 320w, url 640w, ..."} in the order of the thumbnails
+        """
+        res = {}
+        for thumbnail in thumbnails:
+            srcset = res.get(thumbnail.format)
+            item = f"{thumbnail.file_url} {thumbnail.width}w"
+            res[thumbnail.format] = f"{srcset}, {item}" if srcset else item
+        return res
+
+
     @staticmethod
     def transformphotoresponse_to_json(transformphoto: PhotoURLResponse):
         if transformphoto:
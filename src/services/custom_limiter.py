@@ -1,9 +1,179 @@
+import math
 import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
 
+import redis.asyncio
 from fastapi import Request, HTTPException
+from redis.exceptions import RedisError
+
+from src.conf.config import settings, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_REDIS_TIMEOUT, RATE_LIMIT_REDIS_COOLDOWN
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float      # seconds until the full limit is available again
+    retry_after: float      # seconds until the next request is allowed, 0 if allowed
+
+    @property
+    def headers(self) -> dict:
+        headers = {"X-RateLimit-Limit": str(self.limit),
+                   "X-RateLimit-Remaining": str(self.remaining),
+                   "X-RateLimit-Reset": str(math.ceil(round(self.reset_after, 6)))}
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(round(self.retry_after, 6)))
+        return headers
+
+
+def gcra(tat: float, now: float, times: int, seconds: float) -> tuple[float, RateLimitResult]:
+    """
+    Generic cell rate algorithm: one "theoretical arrival time" per key instead of a log of requests.
+    A request is allowed if it comes no more than seconds - interval before the tat, then the tat moves
+    by interval = seconds / times. It allows `times` requests in any window of `seconds`, spread or in a burst.
+    Returns the new tat and the result.
+    """
+    interval = seconds / times
+    tat = max(tat, now)
+    allow_at = tat - seconds + interval
+    if now < allow_at - 1e-9:     # float error of the accumulated intervals
+        return tat, RateLimitResult(False, times, 0, tat - now, allow_at - now)
+    tat += interval
+    remaining = int((seconds - (tat - now)) / interval + 1e-9)
+    return tat, RateLimitResult(True, times, remaining, tat - now, 0)
+
+
+class RateLimitBackend:
+    """
+    Storage of the rate limit states: hit() counts a request of the key and tells if it is allowed
+    """
+    async def hit(self, key: str, times: int, seconds: float) -> RateLimitResult:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryRateLimitStore(RateLimitBackend):
+    """
+    GCRA states of the keys in the process memory, each worker process has its own limits.
+    A key expires at its tat (its state equals a new one then): the keys are put in the buckets of a timing wheel
+    by the second of their expiry and every call drops the keys of the seconds passed, each key once,
+    so the cost of a call does not depend on the number of keys.
+    At most max_keys are kept, the least recently used ones are dropped first.
+    """
+    def __init__(self, max_keys: int=RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self.tats = OrderedDict()
+        self.buckets = {}
+        self.swept = int(clock())
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tats)
+
+    async def hit(self, key: str, times: int, seconds: float) -> RateLimitResult:
+        return self.check(key, times, seconds)
+
+    def check(self, key: str, times: int, seconds: float) -> RateLimitResult:
+        with self.lock:
+            now = self.clock()
+            self.sweep(int(now))
+            tat, result = gcra(self.tats.get(key, now), now, times, seconds)
+            if result.allowed:
+                self.tats[key] = tat
+                self.tats.move_to_end(key)
+                self.buckets.setdefault(int(tat) + 1, set()).add(key)
+                while len(self.tats) > self.max_keys:
+                    self.tats.popitem(last=False)
+            return result
+
+    def sweep(self, second: int):
+        if second <= self.swept:
+            return
+        if second - self.swept <= len(self.buckets):
+            passed = range(self.swept + 1, second + 1)
+        else:
+            passed = sorted(item for item in self.buckets if item <= second)
+        for item in passed:
+            for key in self.buckets.pop(item, ()):
+                tat = self.tats.get(key)
+                # the key may have moved to a later bucket since
+                if tat is not None and int(tat) + 1 <= item:
+                    del self.tats[key]
+        self.swept = second
+
+    def clear(self):
+        with self.lock:
+            self.tats.clear()
+            self.buckets.clear()
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    GCRA states in Redis, shared by all the workers and kept over restarts.
+    A hit is one Lua script, atomic on the server, timed by the clock of the server;
+    a key expires with its tat. While Redis is unavailable the limits are counted by the fallback in memory:
+    after a failure Redis is not tried for cooldown seconds, so the requests do not wait for its timeout each.
+    """
+    SCRIPT = """
+        local interval = tonumber(ARGV[2]) / tonumber(ARGV[1])
+        local period = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now)
+        local allow_at = tat - period + interval
+        if now < allow_at - 1e-9 then
+            return {0, 0, tostring(tat - now), tostring(allow_at - now)}
+        end
+        tat = tat + interval
+        redis.call('SET', KEYS[1], string.format('%.6f', tat), 'PX', math.ceil((tat - now) * 1000))
+        return {1, math.floor((period - (tat - now)) / interval + 1e-9), tostring(tat - now), '0'}
+    """
+
+    def __init__(self, client, prefix: str="ratelimit:", fallback: RateLimitBackend=None,
+                 cooldown: float=RATE_LIMIT_REDIS_COOLDOWN, clock=time.monotonic):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback or MemoryRateLimitStore()
+        self.script = client.register_script(self.SCRIPT)
+        self.cooldown = cooldown
+        self.clock = clock
+        self.retry_at = 0.0
+
+    async def hit(self, key: str, times: int, seconds: float) -> RateLimitResult:
+        if self.clock() < self.retry_at:
+            return await self.fallback.hit(key, times, seconds)
+        try:
+            allowed, remaining, reset_after, retry_after = await self.script(keys=[self.prefix + key],
+                                                                             args=[times, seconds])
+        except (RedisError, OSError) as err:
+            logger.error(f"RateLimiter: {err}, the limits are counted in memory for {self.cooldown}s")
+            self.retry_at = self.clock() + self.cooldown
+            return await self.fallback.hit(key, times, seconds)
+        return RateLimitResult(bool(allowed), times, int(remaining), float(reset_after), float(retry_after))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def get_rate_limit_backend(name: str) -> RateLimitBackend:
+    if name == 'redis':
+        client = redis.asyncio.Redis(host=settings.redis_host, port=settings.redis_port,
+                                     password=settings.redis_password, socket_timeout=RATE_LIMIT_REDIS_TIMEOUT)
+        return RedisRateLimitBackend(client)
+    return MemoryRateLimitStore()
+
+
+request_counters = get_rate_limit_backend(settings.rate_limit_backend)
 
-# In-memory storage for request counters
-request_counters = {}
 
 # Custom RateLimiter class with dynamic rate limiting values per route
 class RateLimiter:
@@ -15,31 +185,13 @@ class RateLimiter:
         client_ip = request.client.host
         route_path = request.url.path
 
-        # Get the current timestamp
-        current_time = int(time.time())
-
-        # Create a unique key based on client IP and route path
-        key = f"{client_ip}:{route_path}"
+        # Create a unique key based on client IP, route path and the limit
+        key = f"{client_ip}:{route_path}:{self.requests_limit}/{self.time_window}"
 
-        # Check if client's request counter exists
-        if key not in request_counters:
-            request_counters[key] = {"timestamp": current_time, "count": 0}
-        else:
-            # Check if the time window has elapsed, reset the counter if needed
-            if current_time - request_counters[key]["timestamp"] > self.time_window:
-                # Reset the counter and update the timestamp
-                request_counters[key]["timestamp"] = current_time
-                request_counters[key]["count"] = 0
-            else:
-                # Check if the client has exceeded the request limit
-                if request_counters[key]["count"] >= self.requests_limit:
-                    raise HTTPException(status_code=429, detail="Too Many Requests")
-                else:
-                    request_counters[key]["count"] += 1
-
-        # Clean up expired client data (optional)
-        for k in list(request_counters.keys()):
-            if current_time - request_counters[k]["timestamp"] > self.time_window:
-                request_counters.pop(k)
+        result = await request_counters.hit(key, self.requests_limit, self.time_window)
+        if not result.allowed:
+            raise HTTPException(status_code=429, detail="Too Many Requests", headers=result.headers)
 
+        # added to the response by rate_limit_headers_middleware
+        request.state.rate_limit_headers = result.headers
         return True
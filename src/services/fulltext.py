@@ -0,0 +1,51 @@
+import re
+import typing as t
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.models import Photo, PHOTO_FTS_CONFIG, PHOTO_FTS_COLUMN, PHOTO_FTS_TABLE
+
+
+class FullTextSearch:
+    """
+    Ranked full-text search over Photo.description.
+    Every word of the keyword must match, the last letters of a word may be omitted (prefix matching).
+    PostgreSQL uses the generated tsvector column, SQLite - the FTS5 table, other backends fall back to ILIKE.
+    """
+    def __init__(self, session: AsyncSession):
+        self.dialect = session.get_bind().dialect.name
+
+    @staticmethod
+    def get_terms(keyword: str) -> t.List[str]:
+        return re.findall(r"\w+", keyword.lower()) if keyword else []
+
+    def search_photos(self, select: sa.sql.Select[t.Any], keyword: str) -> t.Tuple[sa.sql.Select[t.Any], t.Any]:
+        """
+        Filter the photos query by keyword
+        Args:
+            select: The query selecting from Photo.
+            keyword (str): The words to search in photo descriptions.
+        Returns:
+            The filtered query and the rank expression (higher is more relevant)
+        """
+        terms = self.get_terms(keyword)
+        if not terms:
+            return select, None
+
+        if self.dialect == 'postgresql':
+            tsv = sa.literal_column(f"{Photo.__tablename__}.{PHOTO_FTS_COLUMN}")
+            tsq = sa.func.to_tsquery(PHOTO_FTS_CONFIG, " & ".join(f"{term}:*" for term in terms))
+            return select.where(tsv.op("@@")(tsq)), sa.func.ts_rank(tsv, tsq)
+
+        if self.dialect == 'sqlite':
+            fts = sa.table(PHOTO_FTS_TABLE, sa.column("rowid"), sa.column("description"))
+            matched = sa.select(fts.c.rowid.label("photo_id"),
+                                (-sa.func.bm25(sa.literal_column(PHOTO_FTS_TABLE))).label("rank")) \
+                        .where(fts.c.description.match(" AND ".join(f'"{term}"*' for term in terms))) \
+                        .subquery()
+            return select.join(matched, matched.c.photo_id == Photo.id), matched.c.rank
+
+        for term in terms:
+            select = select.where(Photo.description.ilike(f"%{term}%"))
+        return select, sa.literal(0)
@@ -0,0 +1,55 @@
+import hashlib
+
+from PIL import Image, ImageFile
+
+from src.conf.config import READ_CHUNK_SIZE
+from src.services.similarity import dhash, to_signed
+
+# EXIF orientations of the images stored rotated by 90 or 270 degrees
+TRANSPOSED = (5, 6, 7, 8)
+
+
+def dominant_color(img: Image.Image) -> str:
+    """
+    The most frequent color of the image reduced to a small palette, as #rrggbb
+    """
+    palette_img = img.convert("RGB").quantize(colors=5, method=Image.Quantize.MEDIANCUT)
+    _, index = max(palette_img.getcolors())
+    red, green, blue = palette_img.getpalette()[index * 3:index * 3 + 3]
+    return f"#{red:02x}{green:02x}{blue:02x}"
+
+
+def inspect_image(file, chunk_size: int=READ_CHUNK_SIZE) -> dict:
+    """
+    Reads an uploaded file once, chunk by chunk: every chunk is hashed and fed to the image parser.
+    Returns the SHA-256 and the size of the file and, if it is an image,
+    its displayed width and height (EXIF orientation applied), format, orientation, dominant color and dHash.
+    """
+    sha256 = hashlib.sha256()
+    parser = ImageFile.Parser()
+    file_size = 0
+    while chunk := file.read(chunk_size):
+        sha256.update(chunk)
+        file_size += len(chunk)
+        if parser is not None:
+            try:
+                parser.feed(chunk)
+            except (OSError, ValueError, SyntaxError):
+                parser = None   # not an image, keep hashing
+    info = {"content_hash": sha256.hexdigest(), "file_size": file_size, "width": None, "height": None,
+            "format": None, "orientation": None, "dominant_color": None, "phash": None}
+    if parser is None:
+        return info
+    try:
+        img = parser.close()
+    except (OSError, ValueError, SyntaxError):
+        return info
+
+    orientation = img.getexif().get(0x0112, 1)
+    width, height = (img.height, img.width) if orientation in TRANSPOSED else (img.width, img.height)
+    small = img.convert("RGB")
+    small.thumbnail((256, 256))
+    info.update({"width": width, "height": height, "format": (img.format or "").lower() or None,
+                 "orientation": orientation, "dominant_color": dominant_color(small),
+                 "phash": to_signed(dhash(small))})
+    return info
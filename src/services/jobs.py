@@ -0,0 +1,151 @@
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict
+
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from src.conf.config import JOB_WORKERS, JOB_POLL_INTERVAL, JOB_LEASE, JOB_MAX_ATTEMPTS, JOB_BACKOFF
+from src.database.db import DBSession
+from src.database.models import Job
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[dict, AsyncSession], Awaitable[None]]
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class JobQueue:
+    """
+    Persistent queue of side effects in the jobs table, run by a pool of asyncio workers.
+    A job is added by enqueue() in the session of the request, so it is committed together with the data.
+    Workers claim a job by a conditional UPDATE (safe for several workers and processes),
+    retry a failed job with exponential backoff and mark it dead after max_attempts.
+    A job held by a crashed worker is taken over when its lease expires.
+    """
+    def __init__(self, session_factory: async_sessionmaker=DBSession, workers: int=JOB_WORKERS,
+                 poll_interval: float=JOB_POLL_INTERVAL, lease: int=JOB_LEASE, backoff: float=JOB_BACKOFF):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.backoff = backoff
+        self.handlers: Dict[str, JobHandler] = {}
+        self.tasks = []
+        self.wakeup = None
+
+    def handler(self, kind: str):
+        """
+        Decorator registering the coroutine running the jobs of a kind: handler(payload, session)
+        """
+        def register(func: JobHandler) -> JobHandler:
+            self.handlers[kind] = func
+            return func
+        return register
+
+    async def enqueue(self, session: AsyncSession, kind: str, payload: dict, key: str=None,
+                      max_attempts: int=JOB_MAX_ATTEMPTS, delay: float=0) -> Job:
+        """
+        Add a job to the session, the caller commits it.
+        A pending or running job with the same idempotency key is returned instead of a new one,
+        a finished (done or dead) job with the key is scheduled again.
+        """
+        job = await session.scalar(select(Job).filter(Job.idempotency_key == key)) if key else None
+        if job is None:
+            job = Job(kind=kind, idempotency_key=key)
+            session.add(job)
+        elif job.status in ("pending", "running"):
+            return job
+        job.payload = json.dumps(payload)
+        job.status = "pending"
+        job.attempts = 0
+        job.max_attempts = max_attempts
+        job.run_at = utcnow() + timedelta(seconds=delay)
+        job.locked_until = None
+        job.last_error = None
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job
+
+    async def claim(self, session: AsyncSession) -> Job | None:
+        now = utcnow()
+        claimable = or_(and_(Job.status == "pending", Job.run_at <= now),
+                        and_(Job.status == "running", Job.locked_until < now))
+        job_ids = (await session.execute(select(Job.id).filter(claimable).order_by(Job.run_at).limit(self.workers)))\
+            .scalars().all()
+        for job_id in job_ids:
+            result = await session.execute(update(Job).where(and_(Job.id == job_id, claimable))
+                                           .values(status="running", attempts=Job.attempts + 1,
+                                                   locked_until=now + timedelta(seconds=self.lease)))
+            await session.commit()
+            if result.rowcount == 1:
+                return await session.get(Job, job_id, populate_existing=True)
+        return None
+
+    async def run_job(self, job: Job, session: AsyncSession):
+        job_id, handler = job.id, self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler of the '{job.kind}' jobs")
+            await handler(json.loads(job.payload), session)
+        except Exception as err:
+            await session.rollback()
+            job = await session.get(Job, job_id, populate_existing=True)
+            job.last_error = f"{type(err).__name__}: {err}"
+            job.locked_until = None
+            if job.attempts >= job.max_attempts or handler is None:
+                job.status = "dead"
+                logger.error(f"Job {job_id} ({job.kind}) is dead after {job.attempts} attempts: {job.last_error}")
+            else:
+                job.status = "pending"
+                job.run_at = utcnow() + timedelta(seconds=self.backoff * 2 ** (job.attempts - 1))
+        else:
+            job.status = "done"
+            job.locked_until = None
+            job.last_error = None
+        await session.commit()
+
+    async def run_once(self) -> bool:
+        """
+        Claim and run one job, False if there is nothing to run
+        """
+        async with self.session_factory() as session:
+            job = await self.claim(session)
+            if job is None:
+                return False
+            await self.run_job(job, session)
+            return True
+
+    async def worker(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Job worker failed")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.wakeup = None
+
+
+job_queue = JobQueue()
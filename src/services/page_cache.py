@@ -0,0 +1,176 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import redis.asyncio
+from redis.exceptions import RedisError
+from fastapi import Request
+from fastapi.responses import HTMLResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.conf.config import settings, PAGE_CACHE_TTL, PAGE_CACHE_SIZE, PAGE_CACHE_MAX_BYTES, CACHE_REDIS_TIMEOUT
+
+# Tables written by PhotosRepository, TagRepository and the comments repository
+PAGE_CACHE_TABLES = {"photos", "photo_urls", "photo_thumbnails", "tags", "tag_m2m_photo", "comments"}
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache:
+    """
+    LRU cache of rendered HTML pages for anonymous visitors.
+    Key: route path + normalized query parameters + auth state.
+    Limited by the number of pages and their total size, entries expire after ttl seconds
+    and the whole cache is dropped on any write to PAGE_CACHE_TABLES.
+    Without a generations client a write drops the pages of this process only, the other workers
+    keep theirs up to ttl seconds. With a Redis client a commit also bumps the generation in Redis,
+    a page is stored with the generation read before it was rendered and is a miss in every worker
+    once the generation moves on.
+    """
+    def __init__(self, ttl: int=PAGE_CACHE_TTL, maxsize: int=PAGE_CACHE_SIZE, max_bytes: int=PAGE_CACHE_MAX_BYTES,
+                 generations=None, generation_key: str="pagecache:generation"):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.generations = generations
+        self.generation_key = generation_key
+        self.tasks = set()
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(request: Request) -> tuple | None:
+        """
+        Cache key of the request, None if the page must not be cached (authenticated visitor)
+        """
+        if request.cookies.get("atuser"):
+            return None
+        params = tuple(sorted((name, value) for name, value in request.query_params.multi_items() if value != ""))
+        return request.url.path.rstrip("/") or "/", params, "anonymous"
+
+    async def generation(self) -> str | None:
+        """
+        The generation of the pages, None if it is unknown: the pages must not be used then
+        """
+        if self.generations is None:
+            return "0"
+        try:
+            generation = await self.generations.get(self.generation_key)
+        except (RedisError, OSError) as err:
+            logger.error(f"PageCache: {err}")
+            return None
+        return generation.decode() if generation else "0"
+
+    async def get(self, key: tuple) -> HTMLResponse | None:
+        with self.lock:
+            item = self.items.get(key)
+        stale = item is not None and self.generations is not None and await self.generation() != item[1]
+        with self.lock:
+            if item is None or stale or item[0] < time.monotonic() or self.items.get(key) is not item:
+                if item is not None and self.items.get(key) is item:
+                    self._pop(key)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return HTMLResponse(content=item[2], headers={"X-Page-Cache": "HIT"})
+
+    def set(self, key: tuple, body: bytes, generation: str | None="0"):
+        """
+        Store the rendered page, generation is the one read before the rendering
+        """
+        if len(body) > self.max_bytes or generation is None:
+            return
+        with self.lock:
+            if key in self.items:
+                self._pop(key)
+            self.items[key] = (time.monotonic() + self.ttl, generation, body)
+            self.size += len(body)
+            while len(self.items) > self.maxsize or self.size > self.max_bytes:
+                self._pop(next(iter(self.items)))
+                self.evictions += 1
+
+    def _pop(self, key: tuple):
+        _, _, body = self.items.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        with self.lock:
+            if self.items:
+                self.invalidations += 1
+            self.items.clear()
+            self.size = 0
+
+    def publish(self):
+        """
+        Bump the shared generation, the pages of the other workers become misses
+        """
+        if self.generations is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.error("PageCache: the generation is not bumped out of the event loop")
+            return
+        task = loop.create_task(self.bump())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def bump(self):
+        try:
+            await self.generations.incr(self.generation_key)
+        except (RedisError, OSError) as err:
+            logger.error(f"PageCache: {err}")
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.generations is not None:
+            await self.generations.aclose()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "pages": len(self.items),
+                    "bytes": self.size}
+
+
+def get_page_cache(name: str) -> PageCache:
+    if name == 'redis':
+        client = redis.asyncio.Redis(host=settings.redis_host, port=settings.redis_port,
+                                     password=settings.redis_password, socket_timeout=CACHE_REDIS_TIMEOUT)
+        return PageCache(generations=client)
+    return PageCache()
+
+
+page_cache = get_page_cache(settings.cache_backend)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def invalidate_page_cache(conn, cursor, statement, parameters, context, executemany):
+    if context is None or context.compiled is None:
+        return
+    if context.isinsert or context.isupdate or context.isdelete:
+        table = getattr(context.compiled.statement, "table", None)
+        if table is not None and table.name in PAGE_CACHE_TABLES:
+            page_cache.clear()
+            # a page rendered before the commit may already hold the old data
+            conn.info["page_cache_dirty"] = True
+
+
+@event.listens_for(Engine, "commit")
+def invalidate_page_cache_on_commit(conn):
+    if conn.info.pop("page_cache_dirty", False):
+        page_cache.clear()
+        page_cache.publish()
@@ -1,8 +1,21 @@
 import typing as t
 import math
+import json
+import time
+import base64
+import threading
+from collections import OrderedDict
+from datetime import datetime
 
 import sqlalchemy as sa
-from sqlalchemy.orm import Session, lazyload, Query
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import lazyload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.util import find_tables
+from fastapi import HTTPException, status
+
+from src.conf import messages
+from src.conf.config import COUNT_CACHE_TTL, COUNT_CACHE_SIZE, COUNT_ESTIMATE_MIN
 
 VISIBLE_PAGE_COUNT = 9
 
@@ -94,41 +107,202 @@ class Pager:
 
     def prepare_full_range(self):
         self.extend_by_range(1, self.last_page + 1)
-        self.pages[self.page - 1]['class'] = 'active'
+        if self.page <= len(self.pages):
+            self.pages[self.page - 1]['class'] = 'active'
+
+
+class Keyset:
+    """
+    Seek columns for cursor (keyset) pagination: a sort column plus a unique tie-breaker.
+    The cursor is an opaque url-safe string holding the direction and the values of the seek columns.
+    """
+    def __init__(self, columns: t.List[sa.Column], descending: bool=True):
+        self.columns = columns
+        self.descending = descending
+
+    def order_by(self, reverse: bool=False):
+        descending = self.descending != reverse
+        return [col.desc() if descending else col.asc() for col in self.columns]
+
+    def seek(self, values: t.List[t.Any], reverse: bool=False):
+        row = sa.tuple_(*self.columns)
+        key = sa.tuple_(*[sa.literal(value, col.type) for col, value in zip(self.columns, values)])
+        descending = self.descending != reverse
+        return row < key if descending else row > key
+
+    def encode(self, item, direction: str) -> str:
+        values = []
+        for col in self.columns:
+            value = getattr(item, col.key)
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+        raw = json.dumps([direction, values]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    def decode(self, cursor: str) -> t.Tuple[str, t.List[t.Any]]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            direction, values = json.loads(raw)
+            if direction not in ("next", "prev") or len(values) != len(self.columns):
+                raise ValueError(cursor)
+            result = []
+            for col, value in zip(self.columns, values):
+                python_type = col.type.python_type
+                result.append(datetime.fromisoformat(value) if python_type is datetime else python_type(value))
+            return direction, result
+        except Exception:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=messages.INVALID_CURSOR)
+
+
+class CountCache:
+    """
+    Row counts of paginated queries keyed by the compiled statement and its parameters.
+    Entries expire after ttl seconds and are dropped as soon as one of their tables is written.
+    """
+    def __init__(self, ttl: int=COUNT_CACHE_TTL, maxsize: int=COUNT_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(select: sa.sql.Select[t.Any], dialect) -> tuple:
+        compiled = select.compile(dialect=dialect)
+        params = tuple(sorted((name, repr(value)) for name, value in compiled.params.items()))
+        return dialect.name, str(compiled), params
+
+    def get(self, key: tuple) -> int | None:
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, count, _ = item
+            if expires < time.monotonic():
+                self.items.pop(key)
+                return None
+            self.items.move_to_end(key)
+            return count
+
+    def set(self, key: tuple, count: int, tables: t.Set[str]):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, count, tables)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, table: str):
+        with self.lock:
+            for key in [key for key, item in self.items.items() if table in item[2]]:
+                self.items.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+count_cache = CountCache()
+
+
+@sa.event.listens_for(Engine, "after_cursor_execute")
+def invalidate_count_cache(conn, cursor, statement, parameters, context, executemany):
+    if context is None or context.compiled is None:
+        return
+    if context.isddl:
+        count_cache.clear()
+    elif context.isinsert or context.isupdate or context.isdelete:
+        table = getattr(context.compiled.statement, "table", None)
+        if table is not None:
+            count_cache.invalidate(table.name)
 
 
 class Pagination:
-    def __init__(self, select: sa.sql.Select[t.Any], session: Session, page: int, per_page: int):
+    def __init__(self, select: sa.sql.Select[t.Any], session: AsyncSession, page: int, per_page: int,
+                 keyset: Keyset=None, cursor: str=None):
         self.select = select
         self.session = session
-        count = self._query_count()
-        self.pager = Pager(page, per_page, count)
-
-    def get_page(self):
-        pg = self.pager.get_pages()
-        self.skip = (self.pager.page - 1) * self.pager.page_size
-        first_row = self.skip + 1
-        last_row = self.pager.page * self.pager.page_size
-        last_row = last_row if last_row < self.pager.count else self.pager.count
-        pages = [{"per_page": self.pager.page_size,
-                  "first_row": first_row,
-                  "last_row": last_row,
-                  "total_rows": self.pager.count}]
-        pages.extend(pg)
-        items = self._query_items()
+        self.page = page
+        self.per_page = per_page
+        self.keyset = keyset
+        self.cursor = cursor if keyset else None
+        self.pager = None
+
+    async def get_page(self):
+        if self.cursor:
+            # a cursor page has no offset and no page numbers, so the rows are not counted
+            self.pager = Pager(self.page, self.per_page, 0)
+            pages = [{"per_page": self.pager.page_size}]
+            items, has_prev, has_next = await self._query_items_keyset()
+        else:
+            count = await self._query_count()
+            self.pager = Pager(self.page, self.per_page, count)
+            pg = self.pager.get_pages()
+            self.skip = (self.pager.page - 1) * self.pager.page_size
+            first_row = self.skip + 1
+            last_row = self.pager.page * self.pager.page_size
+            last_row = last_row if last_row < self.pager.count else self.pager.count
+            pages = [{"per_page": self.pager.page_size,
+                      "first_row": first_row,
+                      "last_row": last_row,
+                      "total_rows": self.pager.count}]
+            pages.extend(pg)
+            items = await self._query_items()
+            has_prev, has_next = self.pager.page > 1, last_row < self.pager.count
+        if self.keyset:
+            pages[0].update({"prev_cursor": self.keyset.encode(items[0], "prev") if items and has_prev else None,
+                             "next_cursor": self.keyset.encode(items[-1], "next") if items and has_next else None})
         # print(f"items.count = {len(items)}, page = {self.pager.page}, per_page = {self.pager.page_size}, pages = {self.pager.last_page}, total_rows = {self.pager.count}")
         # print(pages)
         # print(items)
         return items, pages
 
-    def _query_items(self):
-        select = self.select.limit(self.pager.page_size).offset(self.skip)
-        # res = list(self.session.execute(select).scalars())
-        res = list(self.session.execute(select).all())
+    async def _query_items(self):
+        select = self.select
+        if self.keyset:
+            select = select.order_by(None).order_by(*self.keyset.order_by())
+        select = select.limit(self.pager.page_size).offset(self.skip)
+        # res = list((await self.session.execute(select)).scalars())
+        res = list((await self.session.execute(select)).all())
         return res
 
-    def _query_count(self) -> int:
-        sub = self.select.options(lazyload("*")).order_by(None).subquery()
-        out = self.session.execute(sa.select(sa.func.count()).select_from(sub)).scalar()
+    async def _query_items_keyset(self):
+        direction, values = self.keyset.decode(self.cursor)
+        reverse = direction == "prev"
+        select = self.select.where(self.keyset.seek(values, reverse)) \
+                            .order_by(None) \
+                            .order_by(*self.keyset.order_by(reverse)) \
+                            .limit(self.pager.page_size + 1)
+        res = list((await self.session.execute(select)).all())
+        has_more = len(res) > self.pager.page_size
+        res = res[:self.pager.page_size]
+        if reverse:
+            res.reverse()
+            return res, has_more, True
+        return res, True, has_more
+
+    async def _query_count(self) -> int:
+        select = self.select.options(lazyload("*")).order_by(None)
+        dialect = self.session.get_bind().dialect
+        key = CountCache.get_key(select, dialect)
+        out = count_cache.get(key)
+        if out is not None:
+            return out
+
+        out = None
+        if dialect.name == 'postgresql':
+            out = await self._query_count_estimate(select)
+        if out is None:
+            sub = select.subquery()
+            out = await self.session.scalar(sa.select(sa.func.count()).select_from(sub))
+        count_cache.set(key, out, {table.name for table in find_tables(select, include_joins=True)})
         return out  # type: ignore[no-any-return]
 
+    async def _query_count_estimate(self, select: sa.sql.Select[t.Any]) -> int | None:
+        # Planner estimate for an unfiltered listing of a single big table (PostgreSQL only)
+        froms = select.get_final_froms()
+        if select.whereclause is not None or select._group_by_clauses or select._having_criteria \
+                or select._distinct or len(froms) != 1 or not isinstance(froms[0], sa.Table):
+            return None
+        estimate = await self.session.scalar(sa.text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+                                             {"table": froms[0].fullname})
+        if estimate is None or estimate < COUNT_ESTIMATE_MIN:
+            return None
+        return estimate
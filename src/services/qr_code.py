@@ -0,0 +1,57 @@
+import io
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+
+from src.conf.config import QR_CACHE_SIZE, QR_WORKERS
+
+
+class QRCodeRenderer:
+    """
+    QR-codes rendered to PNG bytes in memory on a worker pool, so the encoding does not block the event loop.
+    The bytes are kept in a bounded LRU cache keyed by (url, fill_color, back_color).
+    """
+    def __init__(self, workers: int=QR_WORKERS, maxsize: int=QR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qrcode")
+
+    @staticmethod
+    def make_png(url: str, fill_color: str, back_color: str) -> bytes:
+        qr = qrcode.QRCode()
+        qr.add_data(url)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color=fill_color, back_color=back_color)
+        buffer = io.BytesIO()
+        img.save(buffer)
+        return buffer.getvalue()
+
+    def get(self, key: tuple) -> bytes | None:
+        with self.lock:
+            png = self.items.get(key)
+            if png is not None:
+                self.items.move_to_end(key)
+            return png
+
+    def set(self, key: tuple, png: bytes):
+        with self.lock:
+            self.items[key] = png
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    async def render(self, url: str, fill_color: str, back_color: str) -> bytes:
+        key = (url, fill_color, back_color)
+        png = self.get(key)
+        if png is None:
+            loop = asyncio.get_running_loop()
+            png = await loop.run_in_executor(self.executor, self.make_png, url, fill_color, back_color)
+            self.set(key, png)
+        return png
+
+
+qr_renderer = QRCodeRenderer()
@@ -0,0 +1,280 @@
+import io
+import os
+import re
+import time
+import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:     # not POSIX: the lock holds within one process only
+    fcntl = None
+
+import cloudinary
+import cloudinary.uploader
+
+from src.conf import messages
+from src.conf.config import settings, CLOUDINARY_TIMEOUT, STORAGE_DIR, STORAGE_URL, READ_CHUNK_SIZE, UPLOAD_CHUNK_SIZE
+from src.services.transform import ImageTransformer, image_transformer, FORMATS
+
+
+class StorageBackend:
+    """
+    Blocking image storage used by CloudImage through CloudClient.
+    upload() and destroy() return dictionaries shaped like the Cloudinary API responses,
+    the other methods parse and build the urls of the stored images.
+    """
+    def upload(self, file, folder: str=None, public_id: str=None, **options) -> dict:
+        raise NotImplementedError
+
+    def destroy(self, public_id: str) -> dict:
+        raise NotImplementedError
+
+    def get_public_id(self, url: str) -> str | None:
+        raise NotImplementedError
+
+    def supports_format(self, fetch_format: str) -> bool:
+        """
+        Can build_url() deliver the images in the fetch_format
+        """
+        return True
+
+    def get_folder(self, url: str) -> str:
+        raise NotImplementedError
+
+    def build_url(self, public_id: str, transformation: list) -> str:
+        raise NotImplementedError
+
+    @staticmethod
+    def read(file) -> bytes:
+        if isinstance(file, str):
+            with open(file, "rb") as fh:
+                return fh.read()
+        return file if isinstance(file, bytes) else file.read()
+
+    @staticmethod
+    def open(file):
+        """
+        A path, bytes or a file object as a file object
+        """
+        if isinstance(file, str):
+            return open(file, "rb")
+        return io.BytesIO(file) if isinstance(file, bytes) else file
+
+
+class KeepOpen:
+    """
+    File object proxy ignoring close(): cloudinary.uploader.upload_large() closes the file it was given,
+    the caller still needs it for a retry
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def close(self):
+        pass
+
+
+class CloudinaryStorage(StorageBackend):
+    """
+    Images stored in Cloudinary, urls look like .../image/upload/v<version>/<folder>/<name>.<ext>
+    """
+    def __init__(self, timeout: int=CLOUDINARY_TIMEOUT):
+        self.timeout = timeout
+        cloudinary.config(
+            cloud_name=settings.cloudinary_name,
+            api_key=settings.cloudinary_api_key,
+            api_secret=settings.cloudinary_api_secret,
+            secure=True
+        )
+
+    def upload(self, file, **options) -> dict:
+        options.setdefault("resource_type", "image")
+        if hasattr(file, "read") and file.seek(0, os.SEEK_END) > UPLOAD_CHUNK_SIZE:
+            # big files are sent in chunks, never read into memory at once
+            file.seek(0)
+            return cloudinary.uploader.upload_large(KeepOpen(file), chunk_size=UPLOAD_CHUNK_SIZE,
+                                                    timeout=self.timeout, **options)
+        if hasattr(file, "seek"):
+            file.seek(0)
+        return cloudinary.uploader.upload(file, timeout=self.timeout, **options)
+
+    def destroy(self, public_id: str) -> dict:
+        return cloudinary.uploader.destroy(public_id, timeout=self.timeout)
+
+    def get_public_id(self, url: str) -> str | None:
+        match = re.search(r"/v\d+/(.*?)\.\w+$", url) or re.search(r"/v\d+/(.*?)$", url)
+        return match.group(1) if match else None
+
+    def get_folder(self, url: str) -> str:
+        public_id = self.get_public_id(url) or ""
+        return public_id.rpartition("/")[0]
+
+    def build_url(self, public_id: str, transformation: list) -> str:
+        return cloudinary.CloudinaryImage(public_id).build_url(transformation=transformation)
+
+
+class FakeStorage(CloudinaryStorage):
+    """
+    In-memory stand-in for Cloudinary (tests, offline development).
+    Returns urls of the same shape as Cloudinary does.
+    """
+    def __init__(self, cloud_name: str='fake'):
+        self.cloud_name = cloud_name
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def upload(self, file, folder: str=None, public_id: str=None, **options) -> dict:
+        data = self.read(file)
+        public_id = public_id or uuid.uuid4().hex[:20]
+        if folder:
+            public_id = f"{folder}/{public_id}"
+        version = int(time.time())
+        url = f"://res.cloudinary.com/{self.cloud_name}/image/upload/v{version}/{public_id}.png"
+        with self.lock:
+            self.images[public_id] = data
+        return {"public_id": public_id, "version": version, "bytes": len(data),
+                "url": f"http{url}", "secure_url": f"https{url}"}
+
+    def destroy(self, public_id: str) -> dict:
+        with self.lock:
+            found = self.images.pop(public_id, None) is not None
+        return {"result": "ok" if found else "not found"}
+
+    def build_url(self, public_id: str, transformation: list) -> str:
+        return cloudinary.CloudinaryImage(public_id).build_url(transformation=transformation,
+                                                                cloud_name=self.cloud_name)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Content-addressed store on the local filesystem, served by the /static mount.
+    A file is named by the SHA-256 of its content and sharded by the first two bytes of the hash:
+        <root>/ab/cd/abcd...ef.png  ->  <base_url>/ab/cd/abcd...ef.png
+    Identical uploads share one file. It is not reference counted: the callers delete an image
+    only when no photo refers to its url any more (delete_image_job), destroy() removes the file.
+    The file operations are serialized by an flock on <root>/.lock, across the worker processes.
+    Folders are not part of the address and are ignored.
+    Transformations are rendered locally by ImageTransformer, the derivatives are cached on disk.
+    """
+    SIGNATURES = ((b"\x89PNG\r\n\x1a\n", "png"), (b"\xff\xd8\xff", "jpg"), (b"GIF87a", "gif"), (b"GIF89a", "gif"),
+                  (b"BM", "bmp"), (b"II*\x00", "tif"), (b"MM\x00*", "tif"))
+
+    def __init__(self, root: str=STORAGE_DIR, base_url: str=STORAGE_URL, transformer: ImageTransformer=None):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.transformer = transformer or image_transformer
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_format(cls, data: bytes) -> str:
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "webp"
+        for signature, extension in cls.SIGNATURES:
+            if data.startswith(signature):
+                return extension
+        return "bin"
+
+    @staticmethod
+    def get_shard(digest: str) -> str:
+        return f"{digest[:2]}/{digest[2:4]}"
+
+    def get_path(self, public_id: str) -> str | None:
+        directory = os.path.join(self.root, self.get_shard(public_id))
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.startswith(public_id + ".") and not name.endswith(".refs"):
+                    return os.path.join(directory, name)
+        return None
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, ".lock"), "a") as fh:
+                if fcntl is not None:
+                    fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def upload(self, file, folder: str=None, public_id: str=None, **options) -> dict:
+        # the file is copied in chunks and hashed on the way, the name is known only at the end
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = os.path.join(self.root, f"{uuid.uuid4().hex}.tmp")
+        sha256 = hashlib.sha256()
+        size = 0
+        extension = None
+        source = self.open(file)
+        try:
+            with open(tmp_path, "wb") as fh:
+                while chunk := source.read(READ_CHUNK_SIZE):
+                    if extension is None:
+                        extension = self.get_format(chunk)
+                    sha256.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+        finally:
+            if isinstance(file, str):
+                source.close()
+        digest = sha256.hexdigest()
+        relative = f"{self.get_shard(digest)}/{digest}.{extension or 'bin'}"
+        path = os.path.join(self.root, relative)
+        with self.locked():
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        url = f"{self.base_url}/{relative}"
+        return {"public_id": digest, "bytes": size, "url": url, "secure_url": url}
+
+    def destroy(self, public_id: str) -> dict:
+        with self.locked():
+            path = self.get_path(public_id)
+            if path is None:
+                return {"result": "not found"}
+            os.remove(path)
+            # left by the reference counters of the older versions
+            if os.path.exists(path + ".refs"):
+                os.remove(path + ".refs")
+        return {"result": "ok"}
+
+    def get_public_id(self, url: str) -> str | None:
+        match = re.search(r"/([0-9a-f]{64})\.\w+$", url)
+        return match.group(1) if match else None
+
+    def get_folder(self, url: str) -> str:
+        return ""
+
+    def supports_format(self, fetch_format: str) -> bool:
+        return fetch_format in FORMATS
+
+    def build_url(self, public_id: str, transformation: list) -> str:
+        path = self.get_path(public_id) if public_id else None
+        if path is None:
+            raise ValueError(messages.URL_WITHOUT_PUBLIC_ID)
+        try:
+            return self.transformer.derive(path, public_id, transformation)
+        except OSError as err:
+            # a broken source is not a transient error, CloudClient must not retry it
+            raise ValueError(str(err)) from err
+
+
+def get_storage(name: str) -> StorageBackend:
+    if name == 'local':
+        return LocalStorage()
+    if name == 'fake':
+        return FakeStorage()
+    return CloudinaryStorage()
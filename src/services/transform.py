@@ -0,0 +1,260 @@
+import io
+import os
+import json
+import uuid
+import hashlib
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageOps, features
+
+from src.conf.config import DERIVATIVE_DIR, DERIVATIVE_URL
+
+# fetch_format value -> Pillow format
+FORMATS = {"jpg": "JPEG", "jpe": "JPEG", "jpeg": "JPEG", "png": "PNG", "gif": "GIF", "bmp": "BMP",
+           "ico": "ICO", "tif": "TIFF", "tiff": "TIFF", "webp": "WEBP", "avif": "AVIF", "jp2": "JPEG2000"}
+# the codecs Pillow may be built without (AVIF is written since Pillow 11.2)
+FORMATS = {ext: fmt for ext, fmt in FORMATS.items()
+           if fmt not in ("WEBP", "AVIF", "JPEG2000") or features.check({"JPEG2000": "jpg_2000"}.get(fmt, fmt.lower()))}
+ALPHA_FORMATS = {"PNG", "GIF", "ICO", "TIFF", "WEBP", "AVIF", "JPEG2000"}
+QUALITY = {"auto": 80, "best": 90, "good": 80, "eco": 65, "low": 50}
+
+# gravity -> (x, y) centering, 0.0 - left/top, 1.0 - right/bottom
+GRAVITY = {"north_west": (0.0, 0.0), "north": (0.5, 0.0), "north_east": (1.0, 0.0),
+           "west": (0.0, 0.5), "center": (0.5, 0.5), "east": (1.0, 0.5),
+           "south_west": (0.0, 1.0), "south": (0.5, 1.0), "south_east": (1.0, 1.0)}
+
+
+class ImageTransformer:
+    """
+    Local rendering of the Cloudinary qualifiers described in src/transformation.json
+    (height, width, crop, gravity, radius, effect, quality, fetch_format, angle) with Pillow.
+    Rendered derivatives are cached on disk by the hash of the source plus the canonical transformation JSON.
+    Face/subject detection is not available locally: face and auto gravities fall back to the center.
+    """
+    def __init__(self, cache_dir: str=DERIVATIVE_DIR, base_url: str=DERIVATIVE_URL):
+        self.cache_dir = cache_dir
+        self.base_url = base_url.rstrip("/")
+
+    @staticmethod
+    def canonical(transformation: list) -> str:
+        return json.dumps(transformation, sort_keys=True, separators=(",", ":"))
+
+    @staticmethod
+    def get_extension(transformation: list, source_extension: str) -> str:
+        for step in transformation:
+            fetch_format = step.get("fetch_format")
+            if fetch_format and fetch_format != "auto":
+                if fetch_format not in FORMATS:
+                    raise ValueError(f"Unsupported format '{fetch_format}'")
+                return fetch_format
+        return source_extension
+
+    def get_derivative(self, source_digest: str, source_extension: str, transformation: list) -> tuple:
+        """
+        Relative path and url of the derivative of a source image
+        """
+        key = hashlib.sha256(f"{source_digest}:{self.canonical(transformation)}".encode()).hexdigest()
+        relative = f"{key[:2]}/{key}.{self.get_extension(transformation, source_extension)}"
+        return relative, f"{self.base_url}/{relative}"
+
+    def derive(self, source_path: str, source_digest: str, transformation: list) -> str:
+        """
+        Render (or take from the cache) the derivative of a source image, return its url
+        """
+        source_extension = os.path.splitext(source_path)[1].lstrip(".")
+        relative, url = self.get_derivative(source_digest, source_extension, transformation)
+        path = os.path.join(self.cache_dir, relative)
+        if not os.path.exists(path):
+            with open(source_path, "rb") as fh:
+                data = self.render(fh.read(), transformation, source_extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, path)
+        return url
+
+    def render(self, data: bytes, transformation: list, source_extension: str="png") -> bytes:
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+        source_format = img.format or FORMATS.get(source_extension, "PNG")
+        save_format = FORMATS.get(self.get_extension(transformation, source_extension), source_format)
+        quality = None
+        for step in transformation:
+            if {"width", "height", "crop", "gravity"} & step.keys():
+                img = self.resize(img, step)
+            if step.get("radius"):
+                img = self.round_corners(img, step["radius"])
+            if step.get("effect"):
+                img = self.apply_effect(img, step["effect"])
+            if step.get("angle"):
+                img = self.rotate(img, step["angle"])
+            if step.get("quality"):
+                level = step["quality"].split(":")
+                quality = QUALITY.get(level[-1] if level[0] == "auto" else level[0]) or int(level[0])
+
+        if img.mode in ("RGBA", "LA", "P") and save_format not in ALPHA_FORMATS:
+            background = Image.new("RGB", img.size, "white")
+            img = img.convert("RGBA")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        options = {"quality": quality} if quality and save_format in ("JPEG", "WEBP", "AVIF") else {}
+        img.save(out, format=save_format, **options)
+        return out.getvalue()
+
+    # ------------------------  height, width, crop, gravity  ------------------------
+    @staticmethod
+    def get_size(value: str | None, initial: int) -> int | None:
+        if not value:
+            return None
+        if value in ("iw", "ih"):
+            return initial
+        if "." in value:
+            return max(1, round(initial * float(value)))
+        return int(value)
+
+    def resize(self, img: Image.Image, step: dict) -> Image.Image:
+        crop = step.get("crop") or "scale"
+        gravity = GRAVITY.get((step.get("gravity") or "center").split(":")[0], (0.5, 0.5))
+        width = self.get_size(step.get("width"), img.width)
+        height = self.get_size(step.get("height"), img.height)
+        if width is None and height is None:
+            return img
+        if width is None:
+            width = img.width if crop == "crop" else max(1, round(img.width * height / img.height))
+        if height is None:
+            height = img.height if crop == "crop" else max(1, round(img.height * width / img.width))
+
+        if crop == "scale":
+            return img.resize((width, height), Image.LANCZOS)
+        if crop in ("fill", "lfill", "thumb"):
+            if crop == "lfill" and width >= img.width and height >= img.height:
+                return img
+            return ImageOps.fit(img, (width, height), Image.LANCZOS, centering=gravity)
+        if crop in ("fit", "limit", "mfit"):
+            scale = min(width / img.width, height / img.height)
+            if (crop == "limit" and scale >= 1) or (crop == "mfit" and scale <= 1):
+                return img
+            return img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        if crop in ("pad", "lpad", "mpad", "fill_pad"):
+            scale = min(width / img.width, height / img.height)
+            if (crop == "lpad" and scale > 1) or (crop == "mpad" and scale < 1):
+                scale = 1
+            resized = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            return ImageOps.pad(resized, (max(width, resized.width), max(height, resized.height)),
+                                color="white", centering=gravity)
+        if crop == "crop":
+            width, height = min(width, img.width), min(height, img.height)
+            left = round((img.width - width) * gravity[0])
+            top = round((img.height - height) * gravity[1])
+            return img.crop((left, top, left + width, top + height))
+        raise ValueError(f"Unsupported crop mode '{crop}'")
+
+    # ------------------------  radius  ------------------------
+    @staticmethod
+    def round_corners(img: Image.Image, radius: str) -> Image.Image:
+        img = img.convert("RGBA")
+        mask = Image.new("L", img.size, 0)
+        draw = ImageDraw.Draw(mask)
+        box = (0, 0, img.width - 1, img.height - 1)
+        if radius == "max":
+            draw.ellipse(box, fill=255)
+        else:
+            values = [int(value) for value in radius.split(":")]
+            # the same order as the CSS border-radius: top-left, top-right, bottom-right, bottom-left
+            tl, tr, br, bl = {1: lambda v: v * 4,
+                              2: lambda v: [v[0], v[1], v[0], v[1]],
+                              3: lambda v: [v[0], v[1], v[2], v[1]],
+                              4: lambda v: v}[len(values)](values)
+            draw.rectangle(box, fill=255)
+            for r, (x, y), start in ((tl, (0, 0), 180), (tr, (img.width - 1, 0), 270),
+                                     (br, (img.width - 1, img.height - 1), 0), (bl, (0, img.height - 1), 90)):
+                r = min(r, img.width // 2, img.height // 2)
+                if r > 0:
+                    x0 = x if x == 0 else x - r
+                    y0 = y if y == 0 else y - r
+                    draw.rectangle((x0, y0, x0 + r, y0 + r), fill=0)
+                    cx = x0 if x == 0 else x0 - r
+                    cy = y0 if y == 0 else y0 - r
+                    draw.pieslice((cx, cy, cx + 2 * r, cy + 2 * r), start, start + 90, fill=255)
+        img.putalpha(Image.composite(img.getchannel("A"), mask, mask))
+        return img
+
+    # ------------------------  effect  ------------------------
+    @staticmethod
+    def apply_effect(img: Image.Image, effect: str) -> Image.Image:
+        name, _, value = effect.partition(":")
+        level = int(value.split(":")[0]) if value and value.split(":")[0].lstrip("-").isdigit() else None
+        alpha = img.getchannel("A") if img.mode in ("RGBA", "LA") else None
+        rgb = img.convert("RGB")
+
+        if name == "grayscale":
+            rgb = ImageOps.grayscale(rgb).convert("RGB")
+        elif name == "blackwhite":
+            threshold = 255 * (50 if level is None else level) // 100
+            rgb = ImageOps.grayscale(rgb).point(lambda p: 255 if p > threshold else 0).convert("RGB")
+        elif name == "sepia":
+            strength = (80 if level is None else level) / 100
+            sepia = ImageOps.colorize(ImageOps.grayscale(rgb), "#2e1d0f", "#fff4e0")
+            rgb = Image.blend(rgb, sepia, strength)
+        elif name == "negate":
+            rgb = ImageOps.invert(rgb)
+        elif name == "blur":
+            rgb = rgb.filter(ImageFilter.GaussianBlur((500 if level is None else level) / 100))
+        elif name == "sharpen":
+            rgb = rgb.filter(ImageFilter.UnsharpMask(radius=2, percent=100 if level is None else level, threshold=3))
+        elif name in ("brightness", "brightness_hsb"):
+            rgb = ImageEnhance.Brightness(rgb).enhance(1 + (80 if level is None else level) / 100)
+        elif name == "contrast":
+            rgb = ImageEnhance.Contrast(rgb).enhance(1 + (0 if level is None else level) / 100)
+        elif name == "saturation":
+            rgb = ImageEnhance.Color(rgb).enhance(1 + (80 if level is None else level) / 100)
+        elif name == "hue":
+            shift = round((80 if level is None else level) * 255 / 200)
+            h, s, v = rgb.convert("HSV").split()
+            rgb = Image.merge("HSV", (h.point(lambda p: (p + shift) % 256), s, v)).convert("RGB")
+        elif name == "gamma":
+            gamma = 1 + (0 if level is None else level) / 100
+            rgb = rgb.point(lambda p: round(255 * (p / 255) ** (1 / gamma)) if gamma > 0 else p)
+        elif name in ("red", "green", "blue"):
+            factor = 1 + (0 if level is None else level) / 100
+            bands = list(rgb.split())
+            index = ("red", "green", "blue").index(name)
+            bands[index] = bands[index].point(lambda p: min(255, round(p * factor)))
+            rgb = Image.merge("RGB", bands)
+        elif name in ("auto_contrast", "auto_color", "improve"):
+            rgb = ImageOps.autocontrast(rgb, cutoff=1)
+        elif name == "auto_brightness":
+            rgb = Image.blend(rgb, ImageOps.equalize(rgb), (100 if level is None else level) / 100)
+        elif name == "vignette":
+            strength = (20 if level is None else level) / 100
+            mask = Image.radial_gradient("L").resize(rgb.size).point(lambda p: round(255 - p * strength))
+            rgb = Image.composite(rgb, Image.new("RGB", rgb.size, "black"), mask)
+        else:
+            raise ValueError(f"Unsupported effect '{name}'")
+
+        if alpha is not None:
+            rgb.putalpha(alpha)
+        return rgb
+
+    # ------------------------  angle  ------------------------
+    @staticmethod
+    def rotate(img: Image.Image, angle: str) -> Image.Image:
+        for mode in angle.split("."):
+            if mode == "hflip":
+                img = ImageOps.mirror(img)
+            elif mode == "vflip":
+                img = ImageOps.flip(img)
+            elif mode in ("ignore", "auto_right", "auto_left"):
+                continue
+            else:
+                degrees = int(mode)
+                if degrees % 360:
+                    # Cloudinary rotates clockwise, Pillow - counterclockwise
+                    img = img.convert("RGBA").rotate(-degrees, resample=Image.BICUBIC, expand=True)
+        return img
+
+
+image_transformer = ImageTransformer()
@@ -0,0 +1,114 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import redis.asyncio
+from redis.exceptions import RedisError
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import settings, AUTH_CACHE_TTL, AUTH_CACHE_SIZE, CACHE_REDIS_TIMEOUT
+from src.database.models import User
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    Snapshots of the authenticated users keyed by (email, token iat).
+    A snapshot is the column values of the User row: a hit is merged into the session of the request
+    without a query, so the changes of the returned user are saved as usual.
+    Entries expire after ttl seconds and are dropped by invalidate() when the user is changed.
+    Without a versions client invalidate() reaches the snapshots of this process only, the other workers
+    keep theirs up to ttl seconds. With a Redis client it also bumps the version of the user in Redis,
+    a snapshot is taken with the version it was read at and is a miss in every worker once the version moves on.
+    """
+    def __init__(self, ttl: int=AUTH_CACHE_TTL, maxsize: int=AUTH_CACHE_SIZE, versions=None,
+                 prefix: str="usercache:"):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.versions = versions
+        self.prefix = prefix
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def version(self, email: str) -> str | None:
+        """
+        The version of the user, None if it is unknown: the snapshots must not be used then
+        """
+        if self.versions is None:
+            return "0"
+        try:
+            version = await self.versions.get(self.prefix + email)
+        except (RedisError, OSError) as err:
+            logger.error(f"UserCache: {err}")
+            return None
+        return version.decode() if version else "0"
+
+    async def get(self, key: tuple, db: AsyncSession) -> User | None:
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, version, values = item
+            if expires < time.monotonic():
+                self.items.pop(key)
+                return None
+            self.items.move_to_end(key)
+        if self.versions is not None and await self.version(key[0]) != version:
+            with self.lock:
+                if self.items.get(key) is item:
+                    self.items.pop(key)
+            return None
+        user = User(**values)
+        make_transient_to_detached(user)
+        return await db.merge(user, load=False)
+
+    def set(self, key: tuple, user: User, version: str="0"):
+        """
+        Store the user read from the database, version is the one taken before the read
+        """
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, version, values)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    async def invalidate(self, email: str=None, user_id: int=None):
+        """
+        Drop the snapshots of a user, by email or id; the shared version is bumped by email
+        """
+        with self.lock:
+            for key in [key for key, (_, _, values) in self.items.items()
+                        if key[0] == email or values["id"] == user_id]:
+                self.items.pop(key)
+        if self.versions is not None and email is not None:
+            try:
+                # the version outlives the snapshots taken before it moved
+                async with self.versions.pipeline(transaction=True) as pipe:
+                    await pipe.incr(self.prefix + email).expire(self.prefix + email, self.ttl).execute()
+            except (RedisError, OSError) as err:
+                logger.error(f"UserCache: {err}")
+
+    async def close(self):
+        if self.versions is not None:
+            await self.versions.aclose()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+def get_user_cache(name: str) -> UserCache:
+    if name == 'redis':
+        client = redis.asyncio.Redis(host=settings.redis_host, port=settings.redis_port,
+                                     password=settings.redis_password, socket_timeout=CACHE_REDIS_TIMEOUT)
+        return UserCache(versions=client)
+    return UserCache()
+
+
+user_cache = get_user_cache(settings.cache_backend)
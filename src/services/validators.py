@@ -1,10 +1,91 @@
+import time
+import asyncio
 from typing import List
+from collections import OrderedDict
 
 from fastapi import HTTPException, status
-import requests
+import httpx
 
 from src.conf import messages
-from src.conf.config import MAX_TAGS_COUNT
+from src.conf.config import (MAX_TAGS_COUNT, URL_CHECK_TIMEOUT, URL_CHECK_CONNECTIONS, URL_CHECK_TTL,
+                             URL_CHECK_NEGATIVE_TTL, URL_CHECK_CACHE_SIZE)
+
+
+class UrlChecker:
+    """
+    HEAD requests through one pooled keep-alive client, so repeated checks reuse the TLS connection.
+    The answers of the server (the error text, "" if the url is valid) are cached by url:
+    valid urls for ttl seconds, invalid ones for negative_ttl seconds.
+    Concurrent checks of the same url share one request. Network errors are not cached.
+    """
+    def __init__(self, timeout: float=URL_CHECK_TIMEOUT, connections: int=URL_CHECK_CONNECTIONS,
+                 ttl: int=URL_CHECK_TTL, negative_ttl: int=URL_CHECK_NEGATIVE_TTL, maxsize: int=URL_CHECK_CACHE_SIZE):
+        self.timeout = timeout
+        self.connections = connections
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.pending = {}
+        self.client = None
+        self.loop = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        # the pool is bound to the event loop it was opened in
+        loop = asyncio.get_running_loop()
+        if self.client is None or self.loop is not loop:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections),
+                follow_redirects=True
+            )
+            self.loop = loop
+        return self.client
+
+    def get(self, url: str) -> str | None:
+        item = self.items.get(url)
+        if item is None:
+            return None
+        expires, result = item
+        if expires < time.monotonic():
+            self.items.pop(url)
+            return None
+        self.items.move_to_end(url)
+        return result
+
+    def set(self, url: str, result: str):
+        self.items[url] = (time.monotonic() + (self.negative_ttl if result else self.ttl), result)
+        self.items.move_to_end(url)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    async def head(self, url: str) -> str:
+        response = await self.get_client().head(url)
+        result = ""
+        if response.status_code != 200:
+            result = response.headers.get('x-cld-error') or f"{response.status_code} {response.reason_phrase}"
+        self.set(url, result)
+        return result
+
+    async def check(self, url: str) -> str:
+        result = self.get(url)
+        if result is not None:
+            return result
+        task = self.pending.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self.head(url))
+            self.pending[url] = task
+            task.add_done_callback(lambda _: self.pending.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+url_checker = UrlChecker()
+
 
 class Validator:
 
@@ -38,14 +119,15 @@ class Validator:
 
     async def check_transform_url(self, url) -> str:
         result = ""
+        if not url.startswith(("http://", "https://")):
+            # rendered by the local storage, nothing to check remotely
+            return result
         try:
-            req = requests.head(url, allow_redirects=True)
-            if req.status_code != 200:
-                result = req.headers.get('x-cld-error')
+            result = await url_checker.check(url)
         except HTTPException as err:
             result = err.detail
         except Exception as err:
-            result = err.args
+            result = str(err) or type(err).__name__
         return result
 
 
@@ -0,0 +1,28 @@
+"""
+Per-call cost of the in-memory rate limiter by the number of keys it holds:
+    python -m tests.benchmark_rate_limiter
+The cost must stay flat: a call touches its own key and the expired keys only.
+"""
+import time
+
+from src.services.custom_limiter import MemoryRateLimitStore
+
+CALLS = 100000
+
+
+def measure(keys: int) -> float:
+    now = [0.0]
+    store = MemoryRateLimitStore(max_keys=keys, clock=lambda: now[0])
+    for index in range(keys):
+        store.check(f"10.0.{index}:/api/photos", 10, 60)
+        now[0] += 30 / keys     # the keys expire in turn during the measurement
+    start = time.perf_counter()
+    for index in range(CALLS):
+        store.check(f"10.1.{index}:/api/photos", 10, 60)
+        now[0] += 30 / CALLS
+    return (time.perf_counter() - start) / CALLS
+
+
+if __name__ == "__main__":
+    for keys in (1000, 10000, 100000, 1000000):
+        print(f"{keys:>9} keys: {measure(keys) * 1e6:.2f} us per call")
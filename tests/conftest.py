@@ -4,6 +4,8 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 
 from main import app
 from src.database.models import Base
@@ -17,6 +19,10 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The application works with AsyncSession, TestClient may run every request in its own event loop
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 
 @pytest.fixture(scope="module")
 def session():
@@ -36,11 +42,12 @@ def session():
 def client(session):
     # Dependency override
 
-    def override_get_db():
+    async def override_get_db():
+        db = TestingAsyncSessionLocal()
         try:
-            yield session
+            yield db
         finally:
-            session.close()
+            await db.close()
 
     app.dependency_overrides[get_db] = override_get_db
 
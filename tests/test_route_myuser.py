@@ -34,7 +34,7 @@ def test_read_myuser_me(client, token, user, monkeypatch):
 
 def test_update_avatar_user(client, token, user, monkeypatch):
     USER_AVATAR = "http://cloudimage.com/image.png"
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_image', MagicMock(return_value=USER_AVATAR))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_image', AsyncMock(return_value=USER_AVATAR))
 
     f = './fileupload.tst'
     with open(f, 'wb') as tmp:
@@ -1,7 +1,8 @@
-from unittest.mock import MagicMock
+import json
+from unittest.mock import MagicMock, AsyncMock
 import pytest
 
-from src.database.models import User, UserRole
+from src.database.models import User, UserRole, Job
 from src.conf import messages
 from src import schemas
 
@@ -55,7 +56,7 @@ def token2(client, user2, session, monkeypatch):
 
 
 def test_upload_photo(client, token, photo_request, photo, monkeypatch):
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_image', MagicMock(return_value=photo["photo"]["file_url"]))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_image', AsyncMock(return_value=photo["photo"]["file_url"]))
 
     body = str(photo_request).replace("'", '"')
 
@@ -206,7 +207,7 @@ def test_photo_transform(client, token, user, photo, monkeypatch):
     "fetch_format": ""
     }
     trans_url = "https://res.cloudinary.com/dqglsxwms/image/upload/c_fill,g_center,h_800,w_800/r_0/q_auto/f_jpg/v1/upload/d7pxlzuvmhossf46zxug"
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', MagicMock(return_value=trans_url))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', AsyncMock(return_value=trans_url))
 
     response = client.post(f"/api/photos/{photo['photo']['id']}/transform",
                             json=body,
@@ -233,7 +234,7 @@ def test_photo_transform_notfound(client, token, user, photo, monkeypatch):
     "fetch_format": ""
     }
     trans_url = "https://res.cloudinary.com/dqglsxwms/image/upload/c_fill,g_center,h_800,w_800/r_0/q_auto/f_jpg/v1/upload/d7pxlzuvmhossf46zxug"
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', MagicMock(return_value=trans_url))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', AsyncMock(return_value=trans_url))
 
     response = client.post("/api/photos/999/transform",
                             json=body,
@@ -256,7 +257,7 @@ def test_photo_transform_notoperation(client, token2, user2, photo, monkeypatch)
     "fetch_format": ""
     }
     trans_url = "https://res.cloudinary.com/dqglsxwms/image/upload/c_fill,g_center,h_800,w_800/r_0/q_auto/f_jpg/v1/upload/d7pxlzuvmhossf46zxug"
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', MagicMock(return_value=trans_url))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_transform_image', AsyncMock(return_value=trans_url))
 
     response = client.post("/api/photos/1/transform",
                             json=body,
@@ -272,7 +273,7 @@ def test_create_qrcode(client, token, user, photo, monkeypatch):
         "fill_color": "black",
         "back_color": "white"
     }
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_qrcode', MagicMock(return_value=photo["photo"]["qr_url"]))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_qrcode', AsyncMock(return_value=photo["photo"]["qr_url"]))
 
     response = client.post("/api/photos/1/qrcode",
                             json=body,
@@ -291,7 +292,7 @@ def test_create_trans_qrcode(client, token, user, photo, monkeypatch):
         "back_color": "white"
     }
     qr_url = "http://res.cloudinary.com/dqglsxwms/image/upload/v1697928381/upload/qr/c8.png"
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_qrcode', MagicMock(return_value=qr_url))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_qrcode', AsyncMock(return_value=qr_url))
 
     response = client.post(f"/api/photos/{photo['photo']['id']}/qrcode/1",
                             json=body,
@@ -302,8 +303,30 @@ def test_create_trans_qrcode(client, token, user, photo, monkeypatch):
     assert data["qr_url"] == qr_url
 
 
+def test_create_all_qrcodes(client, token, user, photo, session, monkeypatch):
+    body = {
+        "fill_color": "black",
+        "back_color": "white"
+    }
+    qr_url = "http://res.cloudinary.com/dqglsxwms/image/upload/v1697928381/upload/qr/c8.png"
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.upload_qrcode', AsyncMock(return_value=qr_url))
+
+    response = client.post(f"/api/photos/{photo['photo']['id']}/qrcodes",
+                            json=body,
+                            headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200, response.text
+    data = response.json()
+    success = data["detail"]["success"]
+    assert success[0]["key"] == "job_id"
+    assert all(item["key"].startswith("qr_url") for item in success[1:])
+    job = session.query(Job).filter(Job.id == int(success[0]["value"])).first()
+    assert job.kind == "create_qr_codes"
+    assert json.loads(job.payload)["photo_id"] == photo['photo']['id']
+
+
 def test_delete_transform_photo(client, token, user, photo, monkeypatch):
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.delete_image', MagicMock(return_value=None))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.delete_image', AsyncMock(return_value=None))
     
     response = client.delete(f"/api/photos/{photo['photo']['id']}/1",
                                 headers={"Authorization": f"Bearer {token}"})
@@ -325,7 +348,7 @@ def test_delete_photo(client, token, user, photo, monkeypatch):
     test_photo_transform(client, token, user, photo, monkeypatch)
     test_create_qrcode(client, token, user, photo, monkeypatch)
 
-    monkeypatch.setattr('src.services.cloud_image.CloudImage.delete_image', MagicMock(return_value=None))
+    monkeypatch.setattr('src.services.cloud_image.CloudImage.delete_image', AsyncMock(return_value=None))
     response = client.delete("/api/photos/2",
                                 headers={"Authorization": f"Bearer {token}"})
 
@@ -1,7 +1,7 @@
 import unittest
 from unittest.mock import MagicMock
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
 
 from src.database.models import User, Comment, Photo
@@ -10,6 +10,7 @@ from src.services.roles import UserRole
 from src.conf import messages
 from src.repository.comments import (
     get_comments,
+    get_comments_by_photos,
     create_comment,
     update_comment,
     delete_comment
@@ -19,7 +20,8 @@ from src.repository.comments import (
 class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        self.session = MagicMock(spec=Session)
+        self.session = MagicMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
         self.photo = Photo(id=1)
         self.user = User(id=1)
         self.comment = Comment(id=1, text="Comment", user=self.user, user_id = self.user.id, photo=self.photo, photo_id=self.photo.id)
@@ -27,21 +29,33 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     # get_comments,
     async def test_get_comments(self):
         comments = [Comment(), Comment(), Comment(), Comment()]
-        self.session.query().filter().all.return_value = comments
+        self.session.execute.return_value.all.return_value = comments
         result = await get_comments(photo_id=self.photo.id, db=self.session)
         self.assertEqual(result, comments)
 
     async def test_get_comments_notfound(self):
         comments = []
-        self.session.query().filter().all.return_value = comments
+        self.session.execute.return_value.all.return_value = comments
         result = await get_comments(photo_id=self.photo.id, db=self.session)
         self.assertEqual(result, comments)
 
 
+    # get_comments_by_photos
+    async def test_get_comments_by_photos(self):
+        comment2 = Comment(id=2, text="Comment2", user_id=self.user.id, photo_id=2)
+        self.session.execute.return_value.all.return_value = [self.comment, comment2]
+        result = await get_comments_by_photos(photo_ids=[1, 2, 3], per_photo=5, db=self.session)
+        self.assertEqual(result, {1: [self.comment], 2: [comment2], 3: []})
+
+    async def test_get_comments_by_photos_empty(self):
+        result = await get_comments_by_photos(photo_ids=[], per_photo=5, db=self.session)
+        self.assertEqual(result, {})
+
+
     # create_comment,
     async def test_create_comment(self):
         body_ = CommentModel(text=self.comment.text)
-        self.session.query().filter().first.return_value = self.photo
+        self.session.scalar.return_value = self.photo
         self.session.add.return_value = None
         self.session.commit.return_value = None
         self.session.refresh.return_value = None
@@ -50,7 +64,7 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_create_comment_photo_notfound(self):
         body_ = CommentModel(text=self.comment.text)
-        self.session.query().filter().first.return_value = None
+        self.session.scalar.return_value = None
         with self.assertRaises(HTTPException) as cm:
             result = await create_comment(photo_id=self.photo.id, body=body_, user=self.user, db=self.session)
         cm_exception = cm.exception
@@ -61,7 +75,7 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     # update_comment,
     async def test_update_comment(self):
         body_ = CommentModel(text=self.comment.text)
-        self.session.query().filter().first.return_value = self.comment
+        self.session.scalar.return_value = self.comment
         self.session.commit.return_value = None
         result = await update_comment(photo_id=self.photo.id, comment_id=self.comment.id, body=body_, user=self.user, db=self.session)
         self.assertEqual(result.id, self.comment.id)
@@ -69,7 +83,7 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_update_comment_notoperation(self):
         body_ = CommentModel(text=self.comment.text)
-        self.session.query().filter().first.return_value = self.comment
+        self.session.scalar.return_value = self.comment
         user_ = User(id=2)
         with self.assertRaises(HTTPException) as cm:
             result = await update_comment(photo_id=self.photo.id, comment_id=self.comment.id, body=body_, user=user_, db=self.session)
@@ -81,14 +95,14 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     # delete_comment
     async def test_delete_comment(self):
         # body_ = CommentDelete(id=self.comment.id)
-        self.session.query().filter().first.return_value = self.comment
+        self.session.scalar.return_value = self.comment
         self.session.commit.return_value = None
         result = await delete_comment(photo_id=self.photo.id, comment_id=self.comment.id, user=self.user, db=self.session)
         self.assertIsNone(result)
 
     async def test_delete_comment_notoperation(self):
         # body_ = CommentDelete(id=self.comment.id)
-        self.session.query().filter().first.return_value = self.comment
+        self.session.scalar.return_value = self.comment
         user_ = User(id=2)
         with self.assertRaises(HTTPException) as cm:
             result = await delete_comment(photo_id=self.photo.id, comment_id=self.comment.id, user=user_, db=self.session)
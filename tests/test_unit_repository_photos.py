@@ -1,25 +1,30 @@
+import io
+import hashlib
 from typing import List
 
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, AsyncMock, patch
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, UploadFile
 from cloudinary import uploader
 
-from src.database.models import User, Photo, Tag
-from src.schemas import PhotoUpdateModel, PhotoResponse
+from src.database.models import User, Photo, PhotoURL, Tag
+from src.schemas import PhotoUpdateModel, PhotoResponse, PhotoQRCodeModel
 from src.services.roles import UserRole
 from src.repository.photos import PhotosRepository
 from src.repository.tags import TagRepository
+from src.services.similarity import PhotoHashIndex
 from src.conf import messages
 
 
 class TestPhotos(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        self.session = MagicMock(spec=Session)
+        self.session = MagicMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
         self.uploadfile = MagicMock(spec=UploadFile("fileupload.tst"))
+        self.uploadfile.file = io.BytesIO(b"image")
         self.user = User(id=1, username="username", email="test@mail.com", roles=UserRole.admin)
         self.url_photo = "https://gravatar.com/image.png"
         self.description = "Test image"
@@ -36,15 +41,15 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
 
     # get_photo_by_id
     async def test_get_photo_by_id(self):
-        self.session.execute().scalar_one_or_none.return_value = self.photo
-        self.session.execute().scalars().all.return_value = self.tags
+        self.session.execute.return_value.scalar_one_or_none.return_value = self.photo
+        self.session.execute.return_value.scalars().all.return_value = self.tags
         result = await PhotosRepository().get_photo_by_id(photo_id=self.photo.id, current_user=self.user, session=self.session)
         self.assertEqual(result, self.result_photo)
 
 
     async def test_get_photo_by_id_notfound(self):
-        self.session.execute().scalar_one_or_none.return_value = None
-        self.session.execute().scalars().all.return_value = self.tags
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
+        self.session.execute.return_value.scalars().all.return_value = self.tags
         with self.assertRaises(HTTPException) as cm:
             result = await PhotosRepository().get_photo_by_id(photo_id=self.photo.id, current_user=self.user, session=self.session)
         cm_exception = cm.exception
@@ -53,69 +58,128 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
 
 
     # get_all_photos
-    @patch("src.repository.tags.TagRepository.get_tags_photo")
-    async def test_get_all_photos(self, mock_tags):
-        mock_tags.return_value = self.tags
-        self.session.execute().scalars().all.return_value = self.photos
-        result = await PhotosRepository().get_all_photos(page=1, per_page=10, session=self.session)
-        self.assertEqual(result, self.result_photos)
+    @patch("src.repository.photos.get_comments_by_photos")
+    @patch("src.repository.tags.TagRepository.get_tags_photos")
+    async def test_get_all_photos(self, mock_tags, mock_comments):
+        mock_tags.return_value = {1: self.tags, 2: self.tags}
+        mock_comments.return_value = {1: [], 2: []}
+        self.session.execute.return_value.all.return_value = self.photos
+        result = await PhotosRepository().get_all_photos(page=2, per_page=10, session=self.session)
+        self.assertEqual(result, [dict(photo, comments=[], thumbnails=[]) for photo in self.result_photos])
+        query = self.session.execute.call_args_list[0].args[0]
+        self.assertEqual(query._limit, 10)
+        self.assertEqual(query._offset, 10)
 
 
     # get_photos_by_user
-    @patch("src.repository.tags.TagRepository.get_tags_photo")
-    async def test_get_photos_by_user(self, mock_tags):
-        mock_tags.return_value = self.tags
-        self.session.execute().scalars().all.return_value = self.photos
+    @patch("src.repository.photos.get_comments_by_photos")
+    @patch("src.repository.tags.TagRepository.get_tags_photos")
+    async def test_get_photos_by_user(self, mock_tags, mock_comments):
+        mock_tags.return_value = {1: self.tags, 2: self.tags}
+        mock_comments.return_value = {1: [], 2: []}
+        self.session.execute.return_value.all.return_value = self.photos
         result = await PhotosRepository().get_photos_by_user(user_id=1, current_user=self.user, page=1, per_page=10, session=self.session)
-        self.assertEqual(result, self.result_photos)
+        self.assertEqual(result, [dict(photo, comments=[], thumbnails=[]) for photo in self.result_photos])
+        query = self.session.execute.call_args_list[0].args[0]
+        self.assertEqual(query._limit, 10)
+        self.assertEqual(query._offset, 0)
+
+
+    # stream_photos
+    @patch("src.repository.photos.get_comments_by_photos")
+    @patch("src.repository.tags.TagRepository.get_tags_photos")
+    async def test_stream_photos(self, mock_tags, mock_comments):
+        mock_tags.side_effect = [{1: self.tags}, {2: self.tags}]
+        mock_comments.side_effect = [{1: []}, {2: []}]
+        self.session.stream.return_value = MagicMock(close=AsyncMock())
+        self.session.stream.return_value.partitions().__aiter__.return_value = [[self.photo], [self.photo2]]
+        result = [photo async for photo in PhotosRepository().stream_photos(session=self.session, batch_size=1)]
+        self.assertEqual(result, [dict(photo, comments=[], thumbnails=[]) for photo in self.result_photos])
+        self.session.stream.return_value.close.assert_awaited_once()
+        query = self.session.stream.call_args.args[0]
+        self.assertEqual(query.get_execution_options()["yield_per"], 1)
 
 
     # search_photos
     @patch("src.repository.tags.TagRepository.get_tags_photo")
     async def test_search_photos(self, mock_tags):
         mock_tags.return_value = self.tags
-        self.session.execute().scalar_one_or_none.return_value = self.tag
-        self.session.execute().scalars().all.return_value = self.photos
+        self.session.execute.return_value.scalar_one_or_none.return_value = self.tag
+        self.session.execute.return_value.scalars().all.return_value = self.photos
         result = await PhotosRepository().search_photos(keyword="str", tag="#str", order_by="newest", session=self.session)
         self.assertEqual(result, self.result_photos)
         result = await PhotosRepository().search_photos(keyword="str", tag="#str", order_by="oldest", session=self.session)
         self.assertEqual(result, self.result_photos)
 
 
+    @patch("src.repository.photos.Pagination")
+    async def test_search_photos_tags_match(self, mock_pagination):
+        mock_pagination().get_page = AsyncMock(return_value=([], []))
+        await PhotosRepository().search_photos(tag=["tag1", "tag2"], match="all", order_by="newest", session=self.session)
+        query = str(mock_pagination.call_args.args[0])
+        self.assertIn("HAVING count(tags.id) = ", query)
+        await PhotosRepository().search_photos(tag=["tag1", "tag2"], match="any", order_by="newest", session=self.session)
+        query = str(mock_pagination.call_args.args[0])
+        self.assertIn("EXISTS (SELECT", query)
+        self.session.execute.assert_not_called()
+
+
+    # get_photos_by_ids
+    @patch("src.repository.photos.get_comments_by_photos")
+    @patch("src.repository.tags.TagRepository.get_tags_photos")
+    async def test_get_photos_by_ids(self, mock_tags, mock_comments):
+        mock_tags.return_value = {1: self.tags, 2: []}
+        mock_comments.return_value = {1: [], 2: []}
+        self.session.execute.return_value.all.return_value = self.photos
+        result = await PhotosRepository().get_photos_by_ids(photo_ids=[2, 1], session=self.session)
+        self.assertEqual(result, [{"photo": self.photo2, "tags": [], "comments": [], "thumbnails": []},
+                                  {"photo": self.photo, "tags": self.tags, "comments": [], "thumbnails": []}])
+
+    async def test_get_photos_by_ids_empty(self):
+        result = await PhotosRepository().get_photos_by_ids(photo_ids=[], session=self.session)
+        self.assertEqual(result, [])
+
+
     # delete_photo
-    async def test_delete_photo_notfound(self):
-        self.session.execute().scalar_one_or_none.return_value = None
+    @patch("src.repository.tags.TagRepository.change_usage_count")
+    async def test_delete_photo_notfound(self, mock_count):
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         with self.assertRaises(HTTPException) as cm:
             await PhotosRepository().delete_photo(photo_id=999, current_user=self.user, session=self.session)
         cm_exception = cm.exception
         self.assertEqual(cm_exception.status_code, 404)
         self.assertEqual(cm_exception.detail, messages.PHOTO_NOT_FOUND)
+        mock_count.assert_not_called()
 
-    async def test_delete_photo_noadmin(self):
+    @patch("src.repository.tags.TagRepository.change_usage_count")
+    async def test_delete_photo_noadmin(self, mock_count):
         user = User(id=2, username="username", email="test@mail.com", roles=UserRole.user)
         with self.assertRaises(HTTPException) as cm:
             await PhotosRepository().delete_photo(photo_id=1, current_user=user, session=self.session)
         cm_exception = cm.exception
         self.assertEqual(cm_exception.status_code, 403)
         self.assertEqual(cm_exception.detail, messages.OPERATION_NOT_AVAILABLE)
+        mock_count.assert_not_called()
 
+    @patch("src.services.jobs.job_queue.enqueue")
     @patch("src.services.cloud_image.CloudImage.delete_image")
-    async def test_delete_photo_badrequest(self, mock_destroy):
+    async def test_delete_photo_later(self, mock_destroy, mock_enqueue):
         photo = self.photo
         photo.file_url = "https://res.cloudinary.com/dqglsxwms/image/upload/v1697427418/upload/vplnv9bplyylkvyomdgd.jpg"
-        self.session.execute().scalar_one_or_none.return_value = photo
-        mock_destroy.return_value = messages.BAD_REQUEST
-        self.session.rollback.return_value = None
-        with self.assertRaises(HTTPException) as cm:
-            await PhotosRepository().delete_photo(photo_id=1, current_user=self.user, session=self.session)
-        cm_exception = cm.exception
-        self.assertEqual(cm_exception.status_code, 400)
+        self.session.execute.return_value.scalar_one_or_none.return_value = photo
+        self.session.execute.return_value.scalars().all.return_value = []
+        self.session.scalar.return_value = False
+        await PhotosRepository().delete_photo(photo_id=1, current_user=self.user, session=self.session)
+        mock_destroy.assert_not_called()
+        mock_enqueue.assert_awaited_once_with(self.session, "delete_image", {"url": photo.file_url},
+                                              key=f"delete_image:{photo.file_url}")
+        self.session.commit.assert_awaited_once()
 
     @patch("src.services.cloud_image.CloudImage.delete_image")
     async def test_delete_photo(self, mock_delete):
         photo = self.photo
         photo.file_url = "https://res.cloudinary.com/dqglsxwms/image/upload/v1697427418/upload/vplnv9bplyylkvyomdgd.jpg"
-        self.session.execute().scalar_one_or_none.return_value = photo
+        self.session.execute.return_value.scalar_one_or_none.return_value = photo
         mock_delete.return_value = ""
         self.session.commit.return_value = None
         result = await PhotosRepository().delete_photo(photo_id=1, current_user=self.user, session=self.session)
@@ -127,9 +191,8 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
     async def test_upload_new_photo_badrequest(self, mock_upload, mock_tag):
         mock_upload.return_value = self.photo.file_url
         mock_tag.return_value = self.tags
-        self.session.execute().scalar_one.return_value = self.photo
+        self.session.execute.return_value.scalar_one.return_value = self.photo
         self.session.commit.return_value = None
-        self.session.execute().return_value = None
         with self.assertRaises(HTTPException) as cm:
             result = await PhotosRepository().upload_new_photo(photo_description=self.photo.description, tags=self.tags,
                                                                photo_file=self.uploadfile, current_user=self.user, session=self.session)
@@ -141,20 +204,106 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
     async def test_upload_new_photo(self, mock_upload, mock_tag):
         mock_upload.return_value = self.photo.file_url
         mock_tag.return_value = self.tags
-        self.session.execute().scalar_one.return_value = self.photo
+        self.session.execute.return_value.scalar_one.return_value = self.photo
         self.session.commit.return_value = None
-        self.session.execute().return_value = None
         result = await PhotosRepository().upload_new_photo(photo_description=self.photo.description, tags=self.tags,
                                                            photo_file=self.uploadfile, current_user=self.user, session=self.session)
         self.assertEqual(result.get('photo'), self.result_photo.get('photo'))
         self.assertEqual(result.get('tags')[0], self.result_photo.get('tags')[0])
         self.assertEqual(result.get('tags')[1], self.result_photo.get('tags')[1])
 
+    @patch("src.services.jobs.job_queue.enqueue")
+    @patch("src.services.cloud_image.CloudImage.upload_image")
+    async def test_upload_new_photo_duplicate(self, mock_upload, mock_enqueue):
+        self.session.scalar.return_value = self.photo.file_url
+        self.session.execute.return_value.scalar_one.return_value = self.photo
+        result = await PhotosRepository().upload_new_photo(photo_description=self.photo.description, tags=[],
+                                                           photo_file=self.uploadfile, current_user=self.user, session=self.session)
+        self.assertEqual(result, self.photo)
+        mock_upload.assert_not_called()
+        query = self.session.execute.call_args.args[0]
+        self.assertEqual(query.compile().params["file_url"], self.photo.file_url)
+        self.assertEqual(query.compile().params["content_hash"], hashlib.sha256(b"image").hexdigest())
+        self.assertEqual(query.compile().params["file_size"], 5)
+        self.assertIsNone(query.compile().params["width"])
+        mock_enqueue.assert_awaited_once_with(self.session, "create_thumbnails", {"photo_id": self.photo.id},
+                                              key=f"create_thumbnails:{self.photo.id}")
+
+    # create_thumbnails
+    async def test_create_thumbnails(self):
+        self.session.execute.return_value.first.return_value = MagicMock(file_url=self.url_photo, width=1000)
+        build_url = AsyncMock(side_effect=lambda url, width, fetch_format: f"{url}/{width}.{fetch_format}")
+        with patch("src.services.cloud_image.CloudImage.build_thumbnail_url", build_url):
+            result = await PhotosRepository().create_thumbnails(photo_id=1, session=self.session)
+        self.assertEqual([(item.width, item.format) for item in result],
+                         [(320, "avif"), (640, "avif"), (320, "webp"), (640, "webp")])
+        self.assertEqual(result[0].file_url, f"{self.url_photo}/320.avif")
+        self.session.add_all.assert_called_once_with(result)
+        self.session.commit.assert_awaited_once()
+
+    async def test_create_thumbnails_small_photo(self):
+        self.session.execute.return_value.first.return_value = MagicMock(file_url=self.url_photo, width=100)
+        with patch("src.services.cloud_image.CloudImage.build_thumbnail_url", AsyncMock(return_value="url")):
+            result = await PhotosRepository().create_thumbnails(photo_id=1, session=self.session)
+        self.assertEqual([item.width for item in result], [320, 320])
+
+    async def test_create_thumbnails_failed_bucket(self):
+        self.session.execute.return_value.first.return_value = MagicMock(file_url=self.url_photo, width=1000)
+
+        async def build_url(url, width, fetch_format):
+            if fetch_format == "avif" and width == 640:
+                raise OSError("timeout")
+            return f"{url}/{width}.{fetch_format}"
+
+        with patch("src.services.cloud_image.CloudImage.build_thumbnail_url", build_url), \
+                self.assertRaises(OSError):
+            await PhotosRepository().create_thumbnails(photo_id=1, session=self.session)
+        thumbnails = self.session.add_all.call_args.args[0]
+        self.assertEqual([(item.width, item.format) for item in thumbnails],
+                         [(320, "avif"), (320, "webp"), (640, "webp")])
+        self.session.commit.assert_awaited_once()
+
+    async def test_create_thumbnails_unsupported_format(self):
+        self.session.execute.return_value.first.return_value = MagicMock(file_url=self.url_photo, width=100)
+        with patch("src.services.cloud_image.CloudImage.build_thumbnail_url", AsyncMock(return_value="url")), \
+                patch("src.services.cloud_image.CloudImage.supports_format", lambda fetch_format: fetch_format != "avif"):
+            result = await PhotosRepository().create_thumbnails(photo_id=1, session=self.session)
+        self.assertEqual([item.format for item in result], ["webp"])
+
+
+    # get_similar_photos
+    async def test_get_similar_photos(self):
+        index = PhotoHashIndex()
+        index.add(1, 0b1111)
+        index.add(2, 0b1110)
+        index.add(3, 0b0000)
+        index.add(4, 0xFFFF << 32)
+        self.session.execute.return_value.first.return_value = MagicMock(id=1, phash=0b1111)
+        with patch("src.repository.photos.photo_hash_index", index), \
+                patch.object(PhotosRepository, "get_photos_by_ids", AsyncMock(return_value=[])) as get_photos:
+            await PhotosRepository().get_similar_photos(photo_id=1, distance=4, limit=10, session=self.session)
+        get_photos.assert_awaited_once_with([2, 3], self.session)
+
+    async def test_get_similar_photos_notfound(self):
+        self.session.execute.return_value.first.return_value = None
+        with self.assertRaises(HTTPException) as cm:
+            await PhotosRepository().get_similar_photos(photo_id=999, distance=4, limit=10, session=self.session)
+        self.assertEqual(cm.exception.status_code, 404)
+
+    @patch("src.services.jobs.job_queue.enqueue")
+    async def test_delete_photo_shared(self, mock_enqueue):
+        self.session.execute.return_value.scalar_one_or_none.return_value = self.photo
+        self.session.execute.return_value.scalars().all.return_value = []
+        self.session.scalar.return_value = True
+        await PhotosRepository().delete_photo(photo_id=1, current_user=self.user, session=self.session)
+        mock_enqueue.assert_not_called()
+        self.session.commit.assert_awaited_once()
+
 
     # update_photo_description
     async def test_update_photo_description_notfound(self):
         description = self.photo.description
-        self.session.execute().scalar_one_or_none.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         with self.assertRaises(HTTPException) as cm:
             await PhotosRepository().update_photo_description(photo_id=999, description=description, current_user=self.user, session=self.session)
         cm_exception = cm.exception
@@ -173,23 +322,50 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
     @patch("src.repository.tags.TagRepository.get_tags_photo")
     async def test_update_photo_description(self, mock_tags):
         description = self.photo.description
-        self.session.execute().scalar_one_or_none.return_value = self.photo
+        self.session.execute.return_value.scalar_one_or_none.return_value = self.photo
         self.session.commit.return_value = None
         mock_tags.return_value = self.tags
         result = await PhotosRepository().update_photo_description(photo_id=self.photo.id, description=description, current_user=self.user, session=self.session)
         self.assertEqual(result, self.result_photo)
 
 
+    # update_all_qr_urls
+    async def test_update_all_qr_urls(self):
+        transforms = [PhotoURL(id=1, photo_id=1, file_url=self.url_photo + "1"),
+                      PhotoURL(id=2, photo_id=1, file_url=self.url_photo + "2", qr_url="https://qr/c2.png")]
+        self.session.execute.return_value.scalars().all.return_value = transforms
+        body = PhotoQRCodeModel()
+        with patch.object(PhotosRepository, "update_qr_url",
+                          AsyncMock(side_effect=lambda body, item, is_transform=False: f"https://qr/{item.id}.png")) as update:
+            result = await PhotosRepository().update_all_qr_urls(body=body, photo=self.photo, db=self.session)
+        self.assertEqual(result, [self.photo] + transforms)
+        self.assertEqual([item.qr_url for item in result], ["https://qr/1.png", "https://qr/1.png", "https://qr/c2.png"])
+        self.assertEqual(update.await_count, 2)
+        self.session.commit.assert_awaited_once()
+
+    async def test_update_all_qr_urls_failed(self):
+        transform = PhotoURL(id=3, photo_id=1, file_url=self.url_photo + "3")
+        self.session.execute.return_value.scalars().all.return_value = [transform]
+        update = AsyncMock(side_effect=["https://qr/b1.png", OSError("upload failed")])
+        with patch.object(PhotosRepository, "update_qr_url", update):
+            with self.assertRaises(HTTPException) as cm:
+                await PhotosRepository().update_all_qr_urls(body=PhotoQRCodeModel(), photo=self.photo, db=self.session)
+        self.assertEqual(cm.exception.detail, "upload failed")
+        self.assertEqual(self.photo.qr_url, "https://qr/b1.png")
+        self.assertIsNone(transform.qr_url)
+        self.session.commit.assert_awaited_once()
+
+
     # check_tag_exist_or_create
     async def test_check_tag_exist_or_create_exists(self):
-        self.session.execute().scalar_one_or_none.return_value = self.tag
-        self.session.execute().scalar_one.return_value = self.tag
+        self.session.execute.return_value.scalar_one_or_none.return_value = self.tag
+        self.session.execute.return_value.scalar_one.return_value = self.tag
         result = await TagRepository().check_tag_exist_or_create(tag_name=self.tag.name, session=self.session)
         self.assertEqual(result, self.tag)
 
     async def test_check_tag_exist_or_create_notexists(self):
-        self.session.execute().scalar_one_or_none.return_value = None
-        self.session.execute().scalar_one.return_value = self.tag
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
+        self.session.execute.return_value.scalar_one.return_value = self.tag
         self.session.commit.return_value = None
         result = await TagRepository().check_tag_exist_or_create(tag_name=self.tag.name, session=self.session)
         self.assertEqual(result, self.tag)
@@ -197,14 +373,38 @@ class TestPhotos(unittest.IsolatedAsyncioTestCase):
 
     # add_tags_to_photo
     async def test_add_tags_to_photo(self):
-        self.session.execute().return_value = None
-        self.session.execute().scalar_one.return_value = self.tag
-        self.session.execute().scalar_one_or_none.return_value = None
+        self.session.execute.return_value.scalar_one.return_value = self.tag
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         result = await TagRepository().add_tags_to_photo(tags=[self.tag.name], photo_id=1, session=self.session)
         self.assertEqual(result, [self.tag])
 
+    # change_usage_count
+    async def test_change_usage_count(self):
+        await TagRepository().change_usage_count(tag_ids=[1, 2], delta=-1, session=self.session)
+        query = str(self.session.execute.call_args.args[0])
+        self.assertIn("SET usage_count=(tags.usage_count + ", query)
+
+    async def test_change_usage_count_empty(self):
+        await TagRepository().change_usage_count(tag_ids=[], delta=1, session=self.session)
+        self.session.execute.assert_not_called()
+
+    # reconcile_usage_count
+    async def test_reconcile_usage_count(self):
+        await TagRepository().reconcile_usage_count(session=self.session)
+        query = str(self.session.execute.call_args.args[0])
+        self.assertIn("FROM tag_m2m_photo", query)
+        self.session.commit.assert_called_once()
+
+    # get_tags_photos
+    async def test_get_tags_photos(self):
+        tag_row = MagicMock(photo_id=1, id=self.tag.id)
+        tag_row.name = self.tag.name
+        self.session.execute.return_value.all.return_value = [tag_row]
+        result = await TagRepository().get_tags_photos(photo_ids=[1, 2], session=self.session)
+        self.assertEqual(result, {1: [tag_row], 2: []})
+
     # get_tags_photo
     async def test_get_tags_photo(self):
-        self.session.execute().scalars().all.return_value = self.tags
+        self.session.execute.return_value.scalars().all.return_value = self.tags
         result = await TagRepository().get_tags_photo(photo_id=1, session=self.session)
         self.assertEqual(result, self.tags)
@@ -1,8 +1,8 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from libgravatar import Gravatar
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.database.models import User
 from src.schemas import UserModel
@@ -30,7 +30,8 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     #     return super().setUpClass()
 
     def setUp(self):
-        self.session = MagicMock(spec=Session)
+        self.session = MagicMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
         self.gravatar = MagicMock(spec=Gravatar)
         self.gravatar.get_image = MagicMock(spec=Gravatar.get_image)
         self.user = User(id=1)
@@ -67,13 +68,13 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     # get_user_by_id,
     async def test_get_user_by_id_found(self):
         user = User()
-        self.session.query().filter().first.return_value = user
+        self.session.execute.return_value.first.return_value = user
         result = await get_user_by_id(user_id=1, db=self.session)
         self.assertEqual(result, user)
 
     async def test_get_user_by_id_notfound(self):
         user = None
-        self.session.query().filter().first.return_value = user
+        self.session.execute.return_value.first.return_value = user
         result = await get_user_by_id(user_id=1, db=self.session)
         self.assertEqual(result, user)
 
@@ -81,7 +82,7 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     async def test_toggle_banned_user(self):
         user0 = User(username=self.username, email=self.email, password=self.password, is_banned=False)
         user = User(username=self.username, email=self.email, password=self.password, is_banned=False)
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         result = await toggle_banned_user(user_id=1, db=self.session)
         self.assertEqual(result.id, user.id)
         self.assertEqual(result.email, user.email)
@@ -89,11 +90,18 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
         self.assertNotEqual(result.is_banned, user0.is_banned)
 
 
+    async def test_toggle_banned_user_invalidates_cache(self):
+        self.session.scalar.return_value = User(id=1, email=self.email, is_banned=False)
+        with patch("src.repository.users.user_cache", AsyncMock()) as cache:
+            await toggle_banned_user(user_id=1, db=self.session)
+        cache.invalidate.assert_awaited_once_with(email=self.email, user_id=1)
+
+
     # set_roles_user
     async def test_set_roles_user(self):
         user0 = User(username=self.username, email=self.email, password=self.password, roles=UserRole.admin)
         user = User(username=self.username, email=self.email, password=self.password, roles=UserRole.admin)
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         result = await set_roles_user(user_id=1, role=UserRole.moderator, db=self.session)
         self.assertEqual(result.id, user.id)
         self.assertEqual(result.email, user.email)
@@ -102,13 +110,13 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_user_by_email_found(self):
         user = User()
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         result = await get_user_by_email(email=self.email, db=self.session)
         self.assertEqual(result, user)
 
     async def test_get_user_by_email_notfound(self):
         user = None
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         result = await get_user_by_email(email=self.email, db=self.session)
         self.assertEqual(result, user)
 
@@ -135,14 +143,14 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
     async def test_confirmed_email(self):
         user = User(username=self.username, email=self.email, password=self.password, avatar=self.url_avatar)
         confirmed = True
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         self.session.commit.return_value = None
         await confirmed_email(email=user.email, db=self.session)
         self.assertEqual(user.confirmed, confirmed)
 
     async def test_update_avatar(self):
         user = User(username=self.username, email=self.email, password=self.password)
-        self.session.query().filter().first.return_value = user
+        self.session.scalar.return_value = user
         self.session.commit.return_value = None
         result = await update_avatar(user=user, url=self.url_avatar, db=self.session)
         self.assertEqual(result.avatar, self.url_avatar)
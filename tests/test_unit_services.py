@@ -1,11 +1,57 @@
+import io
+import os
+import hashlib
+import time
+import random
+import asyncio
+import tempfile
+import threading
+from types import SimpleNamespace
 import unittest
-from unittest.mock import MagicMock, patch
-from fastapi import HTTPException
+from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Depends, HTTPException, UploadFile
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+import cloudinary.exceptions
+import httpx
+from redis.exceptions import ConnectionError as RedisConnectionError
+from PIL import Image
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
-from src.services.validators import Validator
+from src.services.validators import Validator, UrlChecker
+from src.services.pager import Keyset, CountCache, Pagination
+from src.schemas import PhotoQRCodeModel
+from src.services.fulltext import FullTextSearch
+from src.services.page_cache import PageCache
+from src.services.cloud_image import CloudImage, CloudClient
+from src.services.storage import StorageBackend, FakeStorage, LocalStorage, CloudinaryStorage
+from src.services.transform import ImageTransformer
+from src.services.qr_code import QRCodeRenderer
+from src.services.similarity import PhotoHashIndex, dhash, to_signed, to_unsigned
+from src.services.image_info import inspect_image
+from src.services.jobs import JobQueue, utcnow, job_queue
+from src.services.user_cache import UserCache
+from src.services.auth import auth_service
+from src.services.auth_context import get_user_context
+from src.services.custom_limiter import MemoryRateLimitStore, RedisRateLimitBackend, RateLimiter
+from src.repository.auth import Auth as repository_auth
+from src.repository.users import get_user_by_email
+from src.services.custom_json import Jsons
+from src.repository.photos import PhotosRepository
+from src.database.db import get_db
+from src.database.models import Base, Photo, PhotoURL, PhotoThumbnail, Job, User
 from src.services.email import send_email
 from src.conf import messages
-from src.conf.config import MAX_TAGS_COUNT, settings
+from main import rate_limit_headers_middleware
+from src.conf.config import MAX_TAGS_COUNT, UPLOAD_CHUNK_SIZE, settings
 
 
 class TestServices(unittest.IsolatedAsyncioTestCase):
@@ -32,6 +78,140 @@ class TestServices(unittest.IsolatedAsyncioTestCase):
 
 
     # send_email
+    async def test_check_transform_url_cached(self):
+        calls = []
+
+        def handler(request):
+            calls.append(str(request.url))
+            if request.url.path == "/ok.png":
+                return httpx.Response(200)
+            return httpx.Response(400, headers={"x-cld-error": "Invalid crop mode"})
+
+        checker = UrlChecker(ttl=60, negative_ttl=60)
+        checker.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        checker.loop = asyncio.get_running_loop()
+        with patch("src.services.validators.url_checker", checker):
+            results = await asyncio.gather(*[Validator().check_transform_url("https://cdn.test/ok.png")
+                                             for _ in range(5)])
+            self.assertEqual(results, [""] * 5)
+            self.assertEqual(await Validator().check_transform_url("https://cdn.test/bad.png"), "Invalid crop mode")
+            self.assertEqual(await Validator().check_transform_url("https://cdn.test/bad.png"), "Invalid crop mode")
+            self.assertEqual(await Validator().check_transform_url("/static/storage/derived/ab/ab.png"), "")
+        self.assertEqual(calls, ["https://cdn.test/ok.png", "https://cdn.test/bad.png"])
+
+        checker.items["https://cdn.test/ok.png"] = (time.monotonic() - 1, "")
+        self.assertEqual(await checker.check("https://cdn.test/ok.png"), "")
+        self.assertEqual(len(calls), 3)
+        await checker.close()
+
+    async def test_qr_renderer_cache(self):
+        renderer = QRCodeRenderer(workers=1, maxsize=2)
+        png = await renderer.render("https://example.com/a.png", "black", "white")
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        with patch.object(QRCodeRenderer, "make_png") as make_png:
+            self.assertEqual(await renderer.render("https://example.com/a.png", "black", "white"), png)
+            make_png.assert_not_called()
+        await renderer.render("https://example.com/a.png", "red", "white")
+        await renderer.render("https://example.com/b.png", "black", "white")
+        self.assertEqual(len(renderer.items), 2)
+        self.assertNotIn(("https://example.com/a.png", "black", "white"), renderer.items)
+
+    async def test_update_qr_url_in_memory(self):
+        storage = FakeStorage()
+        photo = Photo(id=7, file_url="https://res.cloudinary.com/fake/image/upload/v1/user/photo.png")
+        body = MagicMock(fill_color="black", back_color="white")
+        with patch("src.services.cloud_image.cloud_client", CloudClient(storage, workers=1)):
+            url = await PhotosRepository().update_qr_url(body, photo)
+        self.assertIn("/user/qr/b7.png", url)
+        self.assertTrue(storage.images["user/qr/b7"].startswith(b"\x89PNG"))
+
+    async def test_dhash_similar_images(self):
+        gradient = Image.linear_gradient("L").resize((320, 240)).convert("RGB")
+        original, resized, other = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        gradient.save(original, format="PNG")
+        gradient.resize((160, 120)).save(resized, format="JPEG", quality=70)
+        gradient.rotate(90).save(other, format="PNG")
+        value = dhash(Image.open(original))
+        self.assertLessEqual((value ^ dhash(Image.open(resized))).bit_count(), 4)
+        self.assertGreater((value ^ dhash(Image.open(other))).bit_count(), 16)
+        self.assertEqual(to_unsigned(to_signed(2 ** 64 - 1)), 2 ** 64 - 1)
+        self.assertEqual(to_signed(2 ** 64 - 1), -1)
+
+    async def test_inspect_image(self):
+        img = Image.new("RGB", (300, 200), "white")
+        img.paste((200, 30, 30), (0, 0, 300, 150))
+        exif = img.getexif()
+        exif[0x0112] = 6
+        data = io.BytesIO()
+        img.save(data, format="JPEG", exif=exif)
+        size = data.tell()
+        data.seek(0)
+        info = inspect_image(data, chunk_size=256)
+        self.assertEqual(info["file_size"], size)
+        self.assertEqual(info["content_hash"], hashlib.sha256(data.getvalue()).hexdigest())
+        self.assertEqual((info["width"], info["height"]), (200, 300))
+        self.assertEqual((info["format"], info["orientation"]), ("jpeg", 6))
+        red, green, blue = (int(info["dominant_color"][i:i + 2], 16) for i in (1, 3, 5))
+        self.assertTrue(red > 180 and green < 60 and blue < 60)
+        self.assertIsNotNone(info["phash"])
+
+        info = inspect_image(io.BytesIO(b"not an image" * 100), chunk_size=256)
+        self.assertEqual(info["file_size"], 1200)
+        self.assertIsNone(info["width"])
+        self.assertIsNone(info["phash"])
+
+    def test_photo_metadata_json(self):
+        photo = Photo(id=1, file_url="/a.png", description="", created_at=datetime(2023, 10, 22), user_id=1,
+                      width=640, height=480, format="png", file_size=1024, orientation=1, dominant_color="#ffffff")
+        result = Jsons.only_photoresponse_to_json(photo)
+        self.assertEqual((result["width"], result["height"], result["dominant_color"]), (640, 480, "#ffffff"))
+        self.assertIsNone(Jsons.only_photoresponse_to_json(MagicMock(spec=["id", "file_url", "qr_url", "description",
+                                                                          "created_at", "user_id"]))["width"])
+
+    def test_thumbnails_srcset(self):
+        thumbnails = [PhotoThumbnail(width=320, format="avif", file_url="/a320.avif"),
+                      PhotoThumbnail(width=640, format="avif", file_url="/a640.avif"),
+                      PhotoThumbnail(width=320, format="webp", file_url="/a320.webp")]
+        self.assertEqual(Jsons.thumbnails_to_srcset(thumbnails),
+                         {"avif": "/a320.avif 320w, /a640.avif 640w", "webp": "/a320.webp 320w"})
+
+    async def test_cloud_image_thumbnail_local(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root, "/static/storage",
+                                   ImageTransformer(os.path.join(root, "derived"), "/static/storage/derived"))
+            data = io.BytesIO()
+            Image.new("RGB", (1000, 500), "green").save(data, format="JPEG")
+            url = storage.upload(data.getvalue())["url"]
+            with patch("src.services.cloud_image.cloud_client", CloudClient(storage, workers=1)):
+                thumbnail_url = await CloudImage.build_thumbnail_url(url, 320, "webp")
+            img = Image.open(os.path.join(root, "derived", thumbnail_url.removeprefix("/static/storage/derived/")))
+            self.assertEqual((img.format, img.size), ("WEBP", (320, 160)))
+
+    def test_storage_supports_format(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root, "/static/storage")
+            self.assertTrue(storage.supports_format("png"))
+            self.assertFalse(storage.supports_format("heic"))
+            with patch("src.services.storage.FORMATS", {"png": "PNG"}):
+                self.assertFalse(storage.supports_format("avif"))
+
+    async def test_photo_hash_index_search(self):
+        rnd = random.Random(17)
+        index = PhotoHashIndex()
+        hashes = {photo_id: rnd.getrandbits(64) for photo_id in range(20000)}
+        for photo_id, value in hashes.items():
+            index.add(photo_id, value)
+        query = hashes[5] ^ 0b1011 ^ (1 << 40) ^ (1 << 63)
+        index.add(20000, query)
+        for distance in (0, 5, 10):
+            expected = sorted(((value ^ query).bit_count(), photo_id) for photo_id, value in hashes.items()
+                              if (value ^ query).bit_count() <= distance)
+            self.assertEqual([item for item in index.search(query, distance) if item[1] != 20000], expected)
+        self.assertIn((5, 5), index.search(query, 5))
+        index.remove(5)
+        self.assertEqual(index.search(query, 5), [(0, 20000)])
+        self.assertEqual(len(index), 20000)
+
     @patch("src.services.email.FastMail.send_message")
     async def test_send_email(self, mock_fm):
         mock_fm.return_value = None
@@ -42,3 +222,815 @@ class TestServices(unittest.IsolatedAsyncioTestCase):
         self.assertIsNone(result)
 
 
+    # Keyset
+    async def test_keyset_cursor(self):
+        keyset = Keyset([Photo.created_at, Photo.id], descending=True)
+        photo = Photo(id=7, created_at=datetime(2023, 10, 22, 4, 4, 9, 329393))
+        cursor = keyset.encode(photo, "next")
+        self.assertEqual(keyset.decode(cursor), ("next", [photo.created_at, photo.id]))
+
+    async def test_keyset_cursor_invalid(self):
+        keyset = Keyset([Photo.created_at, Photo.id], descending=True)
+        with self.assertRaises(HTTPException) as cm:
+            keyset.decode("invalid")
+        cm_exception = cm.exception
+        self.assertEqual(cm_exception.status_code, 400)
+        self.assertEqual(cm_exception.detail, messages.INVALID_CURSOR)
+
+    async def test_pagination_cursor_no_count(self):
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        keyset = Keyset([Photo.created_at, Photo.id], descending=True)
+        async with async_sessionmaker(engine)() as session:
+            session.add(User(id=1, username="username", email="test@mail.com", password="qwerty1234"))
+            session.add_all([Photo(id=index, user_id=1, file_url=f"/{index}.png",
+                                   created_at=datetime(2023, 10, index)) for index in range(1, 6)])
+            await session.commit()
+            query = select(Photo.id, Photo.created_at).order_by(Photo.created_at.desc())
+            first, pages = await Pagination(query, session, 1, 2, keyset=keyset).get_page()
+            self.assertEqual([item.id for item in first], [5, 4])
+            self.assertEqual(pages[0]["total_rows"], 5)
+            with patch.object(Pagination, "_query_count") as query_count:
+                second, pages = await Pagination(query, session, 1, 2, keyset=keyset,
+                                                 cursor=pages[0]["next_cursor"]).get_page()
+            query_count.assert_not_called()
+        await engine.dispose()
+        self.assertEqual([item.id for item in second], [3, 2])
+        self.assertEqual(pages, [{"per_page": 2, "prev_cursor": keyset.encode(second[0], "prev"),
+                                  "next_cursor": keyset.encode(second[-1], "next")}])
+
+
+    # FullTextSearch
+    async def test_fulltext_terms(self):
+        self.assertEqual(FullTextSearch.get_terms("Sunset, over the SEA!"), ["sunset", "over", "the", "sea"])
+        self.assertEqual(FullTextSearch.get_terms("' OR \"\""), ["or"])
+        self.assertEqual(FullTextSearch.get_terms(""), [])
+
+    async def test_fulltext_postgresql(self):
+        session = MagicMock()
+        session.get_bind().dialect.name = "postgresql"
+        query, rank = FullTextSearch(session).search_photos(select(Photo.id), "Sun sea")
+        self.assertIn("description_tsv @@ to_tsquery", str(query))
+        self.assertIsNotNone(rank)
+
+    async def test_fulltext_no_terms(self):
+        session = MagicMock()
+        session.get_bind().dialect.name = "sqlite"
+        sel = select(Photo.id)
+        query, rank = FullTextSearch(session).search_photos(sel, " ,.")
+        self.assertIs(query, sel)
+        self.assertIsNone(rank)
+
+
+    # CountCache
+    async def test_count_cache(self):
+        cache = CountCache(ttl=60, maxsize=2)
+        cache.set("photos", 10, {"photos"})
+        cache.set("tags", 5, {"tags", "tag_m2m_photo"})
+        self.assertEqual(cache.get("photos"), 10)
+        cache.set("users", 3, {"users"})
+        self.assertIsNone(cache.get("tags"))
+        cache.invalidate("photos")
+        self.assertIsNone(cache.get("photos"))
+        self.assertEqual(cache.get("users"), 3)
+
+    async def test_count_cache_expired(self):
+        cache = CountCache(ttl=-1)
+        cache.set("photos", 10, {"photos"})
+        self.assertIsNone(cache.get("photos"))
+
+
+    # PageCache
+    async def test_page_cache_key(self):
+        request = MagicMock()
+        request.cookies = {}
+        request.url.path = "/"
+        request.query_params.multi_items.return_value = [("per_page", "10"), ("page", "1"), ("tag", "")]
+        self.assertEqual(PageCache.get_key(request), ("/", (("page", "1"), ("per_page", "10")), "anonymous"))
+        request.cookies = {"atuser": "Bearer token"}
+        self.assertIsNone(PageCache.get_key(request))
+
+    async def test_page_cache(self):
+        cache = PageCache(ttl=60, maxsize=2, max_bytes=10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+        self.assertEqual((await cache.get("a")).body, b"12345")
+        cache.set("c", b"123")
+        self.assertIsNone(await cache.get("b"))
+        cache.clear()
+        self.assertIsNone(await cache.get("a"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "evictions": 1, "invalidations": 1, "pages": 0, "bytes": 0})
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    async def test_page_cache_shared_invalidate(self):
+        server = fakeredis.FakeServer()
+        worker = PageCache(ttl=60, generations=fakeredis.FakeAsyncRedis(server=server))
+        other = PageCache(ttl=60, generations=fakeredis.FakeAsyncRedis(server=server))
+        worker.set("a", b"12345", await worker.generation())
+        self.assertEqual((await worker.get("a")).body, b"12345")
+        other.publish()
+        await asyncio.gather(*other.tasks)
+        self.assertIsNone(await worker.get("a"))
+        self.assertEqual(worker.stats()["pages"], 0)
+        worker.set("a", b"12345", await worker.generation())
+        self.assertEqual((await worker.get("a")).body, b"12345")
+
+    async def test_page_cache_redis_down(self):
+        cache = PageCache(ttl=60, generations=MagicMock(get=AsyncMock(side_effect=RedisConnectionError("down"))))
+        cache.set("a", b"12345", await cache.generation())
+        self.assertEqual(cache.stats()["pages"], 0)
+
+    # CloudImage / CloudClient
+    async def test_cloud_image_fake_backend(self):
+        backend = FakeStorage()
+        with patch("src.services.cloud_image.cloud_client", CloudClient(backend, workers=2)):
+            url = await CloudImage.upload_image(photo_file=b"image", user=MagicMock(username="user"))
+            self.assertRegex(url, r"^https://res.cloudinary.com/fake/image/upload/v\d+/user/\w+\.png$")
+            self.assertEqual(list(backend.images.values()), [b"image"])
+            self.assertEqual(await CloudImage.delete_image(url), "")
+            self.assertEqual(backend.images, {})
+
+    async def test_cloud_client_retry(self):
+        backend = MagicMock()
+        backend.destroy.side_effect = [cloudinary.exceptions.GeneralError("timeout"), {"result": "ok"}]
+        client = CloudClient(backend, workers=1, retries=2, backoff=0)
+        self.assertEqual(await client.destroy("id"), {"result": "ok"})
+        self.assertEqual(backend.destroy.call_count, 2)
+
+    async def test_cloud_client_no_retry(self):
+        backend = MagicMock()
+        backend.destroy.side_effect = cloudinary.exceptions.BadRequest("bad id")
+        client = CloudClient(backend, workers=1, retries=2, backoff=0)
+        with self.assertRaises(cloudinary.exceptions.BadRequest):
+            await client.destroy("id")
+        self.assertEqual(backend.destroy.call_count, 1)
+
+    async def test_cloud_client_transient_errors(self):
+        for error, calls in ((FileNotFoundError("photo.jpg"), 1), (PermissionError("storage"), 1),
+                             (ConnectionResetError("reset"), 3),
+                             (cloudinary.exceptions.Error("Socket error: timeout"), 3),
+                             (cloudinary.exceptions.Error("Invalid image file"), 1)):
+            backend = MagicMock()
+            backend.destroy.side_effect = error
+            client = CloudClient(backend, workers=1, retries=2, backoff=0)
+            with self.assertRaises(type(error)):
+                await client.destroy("id")
+            self.assertEqual(backend.destroy.call_count, calls, error)
+
+    async def test_cloud_client_timeout(self):
+        backend = MagicMock()
+        backend.destroy.side_effect = lambda public_id: time.sleep(0.2)
+        client = CloudClient(backend, workers=1, timeout=0.05, retries=0)
+        with self.assertRaises(asyncio.TimeoutError):
+            await client.destroy("id")
+
+    async def test_cloud_client_upload_retry(self):
+        # a slow attempt is not abandoned: the retry starts when it is over and reads the file from the start
+        reads = []
+
+        def upload(file, **options):
+            reads.append(file.read())
+            time.sleep(0.1)
+            if len(reads) == 1:
+                raise cloudinary.exceptions.GeneralError("timeout")
+            return {"secure_url": "url"}
+
+        backend = MagicMock()
+        backend.upload.side_effect = upload
+        client = CloudClient(backend, workers=2, timeout=0.05, retries=1, backoff=0)
+        self.assertEqual(await client.upload(io.BytesIO(b"image")), {"secure_url": "url"})
+        self.assertEqual(reads, [b"image", b"image"])
+
+    # storage backends
+    async def test_local_storage(self):
+        png = b"\x89PNG\r\n\x1a\n" + b"image"
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root=root, base_url="/static/storage")
+            first = storage.upload(png, folder="user")
+            second = storage.upload(png, folder="other")
+            self.assertEqual(first, second)
+            digest = first["public_id"]
+            self.assertEqual(first["url"], f"/static/storage/{digest[:2]}/{digest[2:4]}/{digest}.png")
+            self.assertEqual(storage.get_public_id(first["url"]), digest)
+            path = os.path.join(root, digest[:2], digest[2:4], f"{digest}.png")
+            self.assertEqual(storage.destroy(digest), {"result": "ok"})
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(storage.destroy(digest), {"result": "not found"})
+
+    async def test_cloudinary_storage_urls(self):
+        storage = CloudinaryStorage()
+        url = "https://res.cloudinary.com/demo/image/upload/v1697427418/upload/user/vplnv9bplyylkvyomdgd.jpg"
+        self.assertEqual(storage.get_public_id(url), "upload/user/vplnv9bplyylkvyomdgd")
+        self.assertEqual(storage.get_folder(url), "upload/user")
+        self.assertIsNone(storage.get_public_id("https://example.com/image.jpg"))
+
+    async def test_cloudinary_storage_chunked_upload(self):
+        storage = CloudinaryStorage()
+        big = tempfile.TemporaryFile()
+        big.write(b"\0" * (UPLOAD_CHUNK_SIZE + 1))
+        with patch("cloudinary.uploader.upload_large", return_value={"url": "big"}) as upload_large, \
+                patch("cloudinary.uploader.upload", return_value={"url": "small"}) as upload:
+            self.assertEqual(storage.upload(big, folder="user"), {"url": "big"})
+            self.assertEqual(storage.upload(io.BytesIO(b"\0" * 10), folder="user"), {"url": "small"})
+        self.assertEqual(upload_large.call_args.kwargs["chunk_size"], UPLOAD_CHUNK_SIZE)
+        self.assertEqual(upload_large.call_args.kwargs["resource_type"], "image")
+        upload.assert_called_once()
+        upload_large.call_args.args[0].close()
+        self.assertFalse(big.closed)
+        big.close()
+
+    async def test_cloud_image_transform_not_supported(self):
+        with patch("src.services.cloud_image.cloud_client", CloudClient(StorageBackend(), workers=1)):
+            with patch.object(StorageBackend, "get_public_id", return_value="image"):
+                with self.assertRaises(HTTPException) as cm:
+                    await CloudImage.upload_transform_image(MagicMock(), "/image.png")
+        self.assertEqual(cm.exception.detail, messages.TRANSFORM_NOT_SUPPORTED)
+
+    async def test_image_transformer_render(self):
+        transformer = ImageTransformer()
+        data = io.BytesIO()
+        Image.new("RGB", (200, 100), "red").save(data, format="PNG")
+        data = data.getvalue()
+
+        img = Image.open(io.BytesIO(transformer.render(data, [{"width": "50"}])))
+        self.assertEqual(img.size, (50, 25))
+        img = Image.open(io.BytesIO(transformer.render(data, [{"width": "80", "height": "80", "crop": "fill",
+                                                                "gravity": "north"}])))
+        self.assertEqual(img.size, (80, 80))
+        img = Image.open(io.BytesIO(transformer.render(data, [{"width": "0.5", "height": "20", "crop": "crop"}])))
+        self.assertEqual(img.size, (100, 20))
+        img = Image.open(io.BytesIO(transformer.render(data, [{"radius": "max"}, {"angle": "90"}])))
+        self.assertEqual(img.size, (100, 200))
+        self.assertEqual(img.getpixel((0, 0))[3], 0)
+        img = Image.open(io.BytesIO(transformer.render(data, [{"effect": "grayscale"}, {"quality": "auto"},
+                                                              {"fetch_format": "jpg"}])))
+        self.assertEqual(img.format, "JPEG")
+        r, g, b = img.getpixel((100, 50))
+        self.assertTrue(abs(r - g) < 3 and abs(g - b) < 3)
+        with self.assertRaises(ValueError):
+            transformer.render(data, [{"effect": "cartoonify"}])
+
+    async def test_local_storage_transform_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root, "/static/storage",
+                                   ImageTransformer(os.path.join(root, "derived"), "/static/storage/derived"))
+            data = io.BytesIO()
+            Image.new("RGB", (64, 64), "blue").save(data, format="PNG")
+            digest = storage.upload(data.getvalue())["public_id"]
+            transformation = [{"height": "32", "width": "32", "crop": "fill"}, {"fetch_format": "webp"}]
+
+            with patch("src.services.cloud_image.cloud_client", CloudClient(storage, workers=1)):
+                body = MagicMock(height="32", width="32", crop="fill", gravity=None, radius=None, effect=None,
+                                 quality=None, fetch_format="webp", angle=None)
+                url = await CloudImage.upload_transform_image(body, f"/static/storage/{digest}.png")
+            self.assertTrue(url.startswith("/static/storage/derived/") and url.endswith(".webp"))
+            path = os.path.join(root, "derived", url.removeprefix("/static/storage/derived/"))
+            self.assertEqual(Image.open(path).size, (32, 32))
+
+            with patch.object(ImageTransformer, "render") as render:
+                self.assertEqual(storage.build_url(digest, transformation), url)
+                render.assert_not_called()
+            self.assertNotEqual(storage.build_url(digest, [{"width": "16"}]), url)
+            with self.assertRaises(ValueError):
+                storage.build_url("0" * 64, transformation)
+
+
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Job.__table__.create)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.queue = JobQueue(self.session_factory, workers=1, backoff=10)
+        self.calls = []
+
+        @self.queue.handler("echo")
+        async def echo(payload, session):
+            self.calls.append(payload)
+            if payload.get("fail"):
+                raise RuntimeError("failed")
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def enqueue(self, payload, **kwargs) -> Job:
+        async with self.session_factory() as session:
+            job = await self.queue.enqueue(session, "echo", payload, **kwargs)
+            await session.commit()
+            return job
+
+    async def get_job(self, job_id) -> Job:
+        async with self.session_factory() as session:
+            return await session.get(Job, job_id)
+
+    async def test_job_done(self):
+        job = await self.enqueue({"id": 1})
+        self.assertTrue(await self.queue.run_once())
+        self.assertFalse(await self.queue.run_once())
+        self.assertEqual(self.calls, [{"id": 1}])
+        job = await self.get_job(job.id)
+        self.assertEqual((job.status, job.attempts), ("done", 1))
+
+    async def test_job_idempotency_key(self):
+        first = await self.enqueue({"id": 1}, key="echo:1")
+        second = await self.enqueue({"id": 2}, key="echo:1")
+        self.assertEqual(first.id, second.id)
+        await self.queue.run_once()
+        third = await self.enqueue({"id": 3}, key="echo:1")
+        self.assertEqual(third.id, first.id)
+        self.assertEqual((await self.get_job(third.id)).status, "pending")
+        await self.queue.run_once()
+        self.assertEqual(self.calls, [{"id": 1}, {"id": 3}])
+
+    async def test_job_retry_and_dead(self):
+        job = await self.enqueue({"fail": True}, max_attempts=2)
+        await self.queue.run_once()
+        failed = await self.get_job(job.id)
+        self.assertEqual((failed.status, failed.attempts, failed.last_error), ("pending", 1, "RuntimeError: failed"))
+        self.assertGreater(failed.run_at, utcnow())
+        self.assertFalse(await self.queue.run_once())
+
+        with patch("src.services.jobs.utcnow", return_value=utcnow() + timedelta(seconds=11)):
+            await self.queue.run_once()
+        self.assertEqual((await self.get_job(job.id)).status, "dead")
+        self.assertEqual(len(self.calls), 2)
+
+    async def test_job_without_handler(self):
+        async with self.session_factory() as session:
+            job = await self.queue.enqueue(session, "unknown", {})
+            await session.commit()
+        await self.queue.run_once()
+        job = await self.get_job(job.id)
+        self.assertEqual((job.status, job.last_error), ("dead", "LookupError: No handler of the 'unknown' jobs"))
+
+    async def test_job_lease_expired(self):
+        job = await self.enqueue({"id": 1})
+        async with self.session_factory() as session:
+            self.assertIsNotNone(await self.queue.claim(session))
+        self.assertFalse(await self.queue.run_once())
+
+        with patch("src.services.jobs.utcnow", return_value=utcnow() + timedelta(seconds=self.queue.lease + 1)):
+            self.assertTrue(await self.queue.run_once())
+        job = await self.get_job(job.id)
+        self.assertEqual((job.status, job.attempts), ("done", 2))
+
+    async def test_job_worker_error_logged(self):
+        self.queue.poll_interval = 0.01
+        with patch.object(self.queue, "run_once", side_effect=[RuntimeError("database is gone"), False]), \
+                self.assertLogs("src.services.jobs", level="ERROR") as logs:
+            self.queue.start()
+            await asyncio.sleep(0.05)
+            await self.queue.stop()
+        self.assertIn("Traceback", logs.output[0])
+        self.assertIn("database is gone", logs.output[0])
+
+    async def test_job_workers(self):
+        for index in range(5):
+            await self.enqueue({"id": index})
+        self.queue.poll_interval = 0.01
+        self.queue.start()
+        for _ in range(100):
+            if len(self.calls) == 5:
+                break
+            await asyncio.sleep(0.01)
+        await self.queue.stop()
+        self.assertEqual(sorted(call["id"] for call in self.calls), list(range(5)))
+
+
+class TestImageJobs(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.base_url = "https://res.cloudinary.com/demo/image/upload"
+        async with self.session_factory() as session:
+            session.add(Photo(id=1, file_url=f"{self.base_url}/v1/user/photo.jpg"))
+            session.add(PhotoURL(id=5, photo_id=1, file_url=f"{self.base_url}/c_fill/v1/user/photo.jpg",
+                                 qr_url=f"{self.base_url}/v2/user/qr/c5.png"))
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def run_delete_image(self, url: str) -> MagicMock:
+        with patch("src.services.cloud_image.cloud_client", CloudClient(CloudinaryStorage(), workers=1)), \
+                patch.object(CloudImage, "delete_image", AsyncMock(return_value="")) as delete_image:
+            async with self.session_factory() as session:
+                await job_queue.handlers["delete_image"]({"url": url}, session)
+        return delete_image
+
+    async def test_delete_old_qr_version(self):
+        # the old version of the QR-code: the new one lives at the same public_id
+        delete_image = await self.run_delete_image(f"{self.base_url}/v1/user/qr/c5.png")
+        delete_image.assert_not_called()
+
+    async def test_delete_unused_image(self):
+        delete_image = await self.run_delete_image(f"{self.base_url}/v1/user/qr/c55.png")
+        delete_image.assert_awaited_once()
+        delete_image = await self.run_delete_image(f"{self.base_url}/v3/user/photo.jpg")
+        delete_image.assert_not_called()
+
+
+class TestDuplicatePhotos(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.user = User(id=1, username="username", email="test@mail.com", password="qwerty1234")
+        async with self.session_factory() as session:
+            session.add(self.user)
+            await session.commit()
+        self.root = tempfile.TemporaryDirectory()
+        self.client = CloudClient(LocalStorage(self.root.name, "/static/storage"), workers=1)
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+        self.root.cleanup()
+
+    async def test_duplicate_photos_qr_codes(self):
+        data = io.BytesIO()
+        Image.new("RGB", (64, 64), "red").save(data, format="PNG")
+        body = PhotoQRCodeModel(fill_color="black", back_color="white")
+        with patch("src.services.cloud_image.cloud_client", self.client), \
+                patch("src.repository.photos.photo_hash_index", PhotoHashIndex()):
+            async with self.session_factory() as session:
+                photos = [await PhotosRepository().upload_new_photo(
+                              photo_description="photo", tags="",
+                              photo_file=UploadFile(io.BytesIO(data.getvalue()), filename="photo.png"),
+                              current_user=self.user, session=session) for _ in range(2)]
+                self.assertEqual(photos[0].file_url, photos[1].file_url)
+                await PhotosRepository().update_photo_qr_url(body, photos[0], session)
+                await PhotosRepository().update_all_qr_urls(body, photos[1], session)
+        async with self.session_factory() as session:
+            qr_urls = (await session.execute(select(Photo.qr_url).order_by(Photo.id))).scalars().all()
+        self.assertEqual(len(qr_urls), 2)
+        self.assertTrue(all(qr_urls))
+
+    async def test_duplicate_photos_delete(self):
+        png = b"\x89PNG\r\n\x1a\n" + b"image"
+        url = self.client.backend.upload(png)["url"]
+        self.client.backend.upload(png)
+        path = self.client.backend.get_path(self.client.backend.get_public_id(url))
+        async with self.session_factory() as session:
+            session.add_all([Photo(id=1, user_id=1, file_url=url), Photo(id=2, user_id=1, file_url=url)])
+            await session.commit()
+        with patch("src.services.cloud_image.cloud_client", self.client):
+            for photo_id in (1, 2):
+                async with self.session_factory() as session:
+                    await session.execute(delete(Photo).where(Photo.id == photo_id))
+                    await session.commit()
+                    await job_queue.handlers["delete_image"]({"url": url}, session)
+                # the file is kept while a photo refers to it, and removed with the last one
+                self.assertEqual(os.path.exists(path), photo_id == 1)
+
+
+class TestFullTextSearchSQLite(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+        async with self.session_factory() as session:
+            session.add(User(id=1, username="username", email="test@mail.com", password="qwerty1234"))
+            session.add_all([Photo(id=1, user_id=1, file_url="/1.png", description="Sunset over the sea"),
+                             Photo(id=2, user_id=1, file_url="/2.png", description="Sunny sea, sea and sea"),
+                             Photo(id=3, user_id=1, file_url="/3.png", description="Mountains in the fog")])
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def search(self, keyword: str, order_by: str='rank') -> list:
+        async with self.session_factory() as session:
+            photos, _ = await PhotosRepository().search_photos(session=session, keyword=keyword, order_by=order_by)
+        return [photo["photo"].id for photo in photos]
+
+    async def test_search_photos(self):
+        self.assertEqual(sorted(await self.search("sun")), [1, 2])
+        self.assertEqual(await self.search("SUN, sea!"), [2, 1])
+        self.assertEqual(await self.search("sunset sea"), [1])
+        self.assertEqual(await self.search("fog"), [3])
+        self.assertEqual(await self.search("desert"), [])
+
+    async def test_search_photos_bm25(self):
+        # the more occurrences of the term in the shorter description, the higher the rank
+        self.assertEqual(await self.search("sea"), [2, 1])
+        async with self.session_factory() as session:
+            session.add(Photo(id=4, user_id=1, file_url="/4.png", description="Sea"))
+            await session.commit()
+        ids = await self.search("sea")
+        self.assertLess(ids.index(4), ids.index(1))
+
+    async def test_search_photos_update_delete(self):
+        async with self.session_factory() as session:
+            await session.execute(update(Photo).where(Photo.id == 3).values(description="Sunrise in the fog"))
+            await session.execute(delete(Photo).where(Photo.id == 2))
+            await session.commit()
+        self.assertEqual(sorted(await self.search("sun")), [1, 3])
+        self.assertEqual(await self.search("mountains"), [])
+        self.assertEqual(await self.search("sea"), [1])
+
+
+class TestUserCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(User.__table__.create)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+        async with self.session_factory() as session:
+            session.add(User(id=1, username="username", email="test@mail.com", password="qwerty1234"))
+            await session.commit()
+        self.cache = UserCache(ttl=60, maxsize=2)
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def test_user_cache_merge(self):
+        async with self.session_factory() as session:
+            self.cache.set(("test@mail.com", 1), await session.get(User, 1))
+        async with self.session_factory() as session:
+            with patch.object(session, "execute", wraps=session.execute) as execute:
+                user = await self.cache.get(("test@mail.com", 1), session)
+                execute.assert_not_called()
+            self.assertEqual((user.id, user.username), (1, "username"))
+            user.avatar = "https://gravatar.com/image.png"
+            await session.commit()
+        async with self.session_factory() as session:
+            self.assertEqual((await session.get(User, 1)).avatar, "https://gravatar.com/image.png")
+
+    async def test_user_cache_invalidate(self):
+        user = User(id=1, username="username", email="test@mail.com")
+        self.cache.set(("test@mail.com", 1), user)
+        self.cache.set(("test@mail.com", 2), user)
+        await self.cache.invalidate(user_id=1)
+        self.assertEqual(len(self.cache.items), 0)
+        self.cache.set(("test@mail.com", 1), user)
+        await self.cache.invalidate(email="other@mail.com")
+        self.assertEqual(len(self.cache.items), 1)
+        await self.cache.invalidate(email="test@mail.com")
+        self.assertEqual(len(self.cache.items), 0)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    async def test_user_cache_shared_invalidate(self):
+        server = fakeredis.FakeServer()
+        worker = UserCache(ttl=60, versions=fakeredis.FakeAsyncRedis(server=server))
+        other = UserCache(ttl=60, versions=fakeredis.FakeAsyncRedis(server=server))
+        async with self.session_factory() as session:
+            user = await session.get(User, 1)
+            worker.set(("test@mail.com", 1), user, await worker.version("test@mail.com"))
+            self.assertIsNotNone(await worker.get(("test@mail.com", 1), session))
+            await other.invalidate(email="test@mail.com")
+            self.assertIsNone(await worker.get(("test@mail.com", 1), session))
+            self.assertEqual(len(worker.items), 0)
+            worker.set(("test@mail.com", 1), user, await worker.version("test@mail.com"))
+            self.assertIsNotNone(await worker.get(("test@mail.com", 1), session))
+
+    async def test_user_cache_redis_down(self):
+        versions = MagicMock(get=AsyncMock(side_effect=RedisConnectionError("down")))
+        cache = UserCache(ttl=60, versions=versions)
+        cache.set(("test@mail.com", 1), User(id=1, email="test@mail.com"), "0")
+        self.assertIsNone(await cache.version("test@mail.com"))
+        async with self.session_factory() as session:
+            self.assertIsNone(await cache.get(("test@mail.com", 1), session))
+
+    async def test_user_cache_expired(self):
+        self.cache.set(("test@mail.com", 1), User(id=1, email="test@mail.com"))
+        with patch("src.services.user_cache.time.monotonic", return_value=time.monotonic() + 61):
+            async with self.session_factory() as session:
+                self.assertIsNone(await self.cache.get(("test@mail.com", 1), session))
+
+    @patch.object(auth_service, "ALGORITHM", "HS256")
+    async def test_get_current_user_cached(self):
+        token = await auth_service.create_access_token({"sub": "test@mail.com"})
+        request = MagicMock(state=SimpleNamespace())
+        with patch("src.services.auth.user_cache", self.cache), \
+                patch("src.repository.users.get_user_by_email", wraps=get_user_by_email) as get_user:
+            async with self.session_factory() as session:
+                user = await auth_service.get_current_user(request=request, token=token, db=session)
+                self.assertIs(await auth_service.get_current_user(request=request, token=token, db=session), user)
+            async with self.session_factory() as session:
+                other = await auth_service.get_current_user(token=token, db=session)
+        self.assertEqual(other.id, user.id)
+        get_user.assert_awaited_once()
+
+
+    @patch.object(auth_service, "ALGORITHM", "HS256")
+    async def test_user_resolved_once(self):
+        token = await auth_service.create_access_token({"sub": "test@mail.com"})
+
+        async def get_session():
+            async with self.session_factory() as session:
+                yield session
+
+        request = MagicMock(state=SimpleNamespace(), cookies={"atuser": f"Bearer {token}"},
+                            app=SimpleNamespace(dependency_overrides={get_db: get_session}))
+        with patch("src.services.auth.user_cache", self.cache), \
+                patch("src.repository.users.get_user_by_email", wraps=get_user_by_email) as get_user:
+            await repository_auth.resolve_user_context(request)
+            self.assertEqual(get_user_context(request)["email"], "test@mail.com")
+            async with self.session_factory() as session:
+                user = await repository_auth().check_authentication(request=request, db=session)
+                self.assertIn(user, session)
+                user.avatar = "https://gravatar.com/image.png"
+                await session.commit()
+        get_user.assert_awaited_once()
+        async with self.session_factory() as session:
+            self.assertEqual((await session.get(User, 1)).avatar, "https://gravatar.com/image.png")
+
+
+    @patch.object(auth_service, "ALGORITHM", "HS256")
+    async def test_logout_revokes_refresh_token(self):
+        token = await auth_service.create_access_token({"sub": "test@mail.com"})
+        async with self.session_factory() as session:
+            user = await session.get(User, 1)
+            user.refresh_token = "refresh"
+            await session.commit()
+        request = MagicMock(state=SimpleNamespace(), cookies={"atuser": f"Bearer {token}"})
+        with patch("src.services.auth.user_cache", self.cache), \
+                patch("src.repository.auth.user_cache", self.cache):
+            async with self.session_factory() as session:
+                await repository_auth().check_authentication(request=request, db=session, is_logout=True)
+        self.assertEqual(len(self.cache.items), 0)
+        async with self.session_factory() as session:
+            self.assertIsNone((await session.get(User, 1)).refresh_token)
+
+
+class TestPasswords(unittest.IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_context(rounds: int) -> CryptContext:
+        return CryptContext(schemes=["sha256_crypt"], sha256_crypt__rounds=rounds,
+                            sha256_crypt__min_rounds=rounds, sha256_crypt__max_rounds=rounds)
+
+    async def test_password_in_pool(self):
+        threads = []
+        context = self.get_context(1000)
+        hash_password = context.hash
+
+        def record(password):
+            threads.append(threading.current_thread().name)
+            return hash_password(password)
+
+        with patch.object(auth_service, "pwd_context", context), patch.object(context, "hash", record):
+            hashed = await auth_service.get_password_hash("qwerty1234")
+            self.assertTrue(await auth_service.verify_password("qwerty1234", hashed))
+            self.assertFalse(await auth_service.verify_password("qwerty", hashed))
+        self.assertTrue(threads[0].startswith("password"))
+
+    async def test_password_rehash(self):
+        hashed = self.get_context(1000).hash("qwerty1234")
+        with patch.object(auth_service, "pwd_context", self.get_context(1000)):
+            self.assertEqual(await auth_service.verify_and_update_password("qwerty1234", hashed), (True, None))
+        with patch.object(auth_service, "pwd_context", self.get_context(2000)):
+            is_valid, new_hash = await auth_service.verify_and_update_password("qwerty1234", hashed)
+            self.assertTrue(is_valid)
+            self.assertIn("rounds=2000", new_hash)
+            self.assertEqual(await auth_service.verify_and_update_password("qwerty", hashed), (False, None))
+
+
+class TestAuthContext(unittest.IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def get_request(token: str=None) -> MagicMock:
+        return MagicMock(state=SimpleNamespace(), cookies={"atuser": f"Bearer {token}"} if token else {},
+                         app=SimpleNamespace(dependency_overrides={}))
+
+    async def test_anonymous_context(self):
+        request = self.get_request()
+        with patch.object(auth_service, "get_current_user") as get_current_user:
+            await repository_auth.resolve_user_context(request)
+        get_current_user.assert_not_called()
+        self.assertEqual(get_user_context(request), {"is_authenticated": False})
+        get_user_context(request).update({"avatar": "url"})
+        self.assertEqual(get_user_context(self.get_request()), {"is_authenticated": False})
+
+    async def test_user_context_per_request(self):
+        users = {"token1": User(id=1, username="user1", email="user1@mail.com"),
+                 "token2": User(id=2, username="user2", email="user2@mail.com")}
+
+        async def get_current_user(request, token, db):
+            await asyncio.sleep(0)
+            if token not in users:
+                raise HTTPException(status_code=401, detail=messages.COULD_NOT_VALIDATE_CREDENTIALS)
+            return users[token]
+
+        requests = [self.get_request(token) for token in ("token1", "token2", "expired")]
+        with patch.object(auth_service, "get_current_user", get_current_user):
+            await asyncio.gather(*[repository_auth.resolve_user_context(request) for request in requests])
+        self.assertEqual([get_user_context(request).get("email") for request in requests],
+                         ["user1@mail.com", "user2@mail.com", None])
+        self.assertEqual([get_user_context(request)["is_authenticated"] for request in requests], [True, True, False])
+
+    async def test_user_context_database_error(self):
+        request = self.get_request("token1")
+        error = OperationalError("SELECT", {}, ConnectionRefusedError())
+        with patch.object(auth_service, "get_current_user", side_effect=error):
+            await repository_auth.resolve_user_context(request)
+        self.assertEqual(get_user_context(request), {"is_authenticated": False})
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.store = MemoryRateLimitStore(max_keys=100, clock=lambda: self.now)
+
+    def test_rate_limit_burst(self):
+        results = [self.store.check("ip:/", 3, 10) for _ in range(4)]
+        self.assertEqual([result.allowed for result in results], [True, True, True, False])
+        self.assertEqual([result.remaining for result in results], [2, 1, 0, 0])
+        self.assertAlmostEqual(results[3].retry_after, 10 / 3)
+        self.assertEqual(results[3].headers, {"X-RateLimit-Limit": "3", "X-RateLimit-Remaining": "0",
+                                              "X-RateLimit-Reset": "10", "Retry-After": "4"})
+        self.now += 10 / 3
+        self.assertTrue(self.store.check("ip:/", 3, 10).allowed)
+        self.assertFalse(self.store.check("ip:/", 3, 10).allowed)
+
+    def test_rate_limit_expiry(self):
+        for index in range(50):
+            self.store.check(f"ip{index}:/", 2, 5)
+        self.store.check("ip0:/", 2, 5)
+        self.now += 3
+        self.store.check("other:/", 2, 5)
+        self.assertEqual(len(self.store), 2)
+        self.now += 3
+        self.store.check("other:/", 2, 5)
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(sum(len(keys) for keys in self.store.buckets.values()), 1)
+
+    def test_rate_limit_max_keys(self):
+        for index in range(150):
+            self.store.check(f"ip{index}:/", 2, 5)
+        self.assertEqual(len(self.store), 100)
+        self.assertNotIn("ip0:/", self.store.tats)
+
+    def test_rate_limit_headers(self):
+        app = FastAPI()
+        app.middleware("http")(rate_limit_headers_middleware)
+
+        @app.get("/", dependencies=[Depends(RateLimiter(times=2, seconds=60))])
+        async def root():
+            return {}
+
+        with patch("src.services.custom_limiter.request_counters", self.store):
+            client = TestClient(app)
+            responses = [client.get("/") for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(responses[0].headers["X-RateLimit-Remaining"], "1")
+        self.assertEqual(responses[2].headers["Retry-After"], "30")
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class TestRedisRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def get_backend(self) -> RedisRateLimitBackend:
+        return RedisRateLimitBackend(fakeredis.FakeAsyncRedis(server=self.server))
+
+    async def test_redis_rate_limit(self):
+        backend = self.get_backend()
+        results = [await backend.hit("ip:/", 3, 10) for _ in range(4)]
+        self.assertEqual([result.allowed for result in results], [True, True, True, False])
+        self.assertEqual([result.remaining for result in results], [2, 1, 0, 0])
+        self.assertAlmostEqual(results[3].retry_after, 10 / 3, delta=0.1)
+        self.assertAlmostEqual(results[3].reset_after, 10, delta=0.1)
+        ttl = await backend.client.pttl("ratelimit:ip:/")
+        self.assertTrue(9000 < ttl <= 10000)
+
+    async def test_redis_rate_limit_shared(self):
+        workers = [self.get_backend() for _ in range(3)]
+        results = await asyncio.gather(*[worker.hit("ip:/", 5, 60) for worker in workers * 3])
+        self.assertEqual(sum(result.allowed for result in results), 5)
+
+    async def test_redis_rate_limit_fallback(self):
+        self.server.connected = False
+        backend = self.get_backend()
+        results = [await backend.hit("ip:/", 2, 10) for _ in range(3)]
+        self.assertEqual([result.allowed for result in results], [True, True, False])
+        self.assertEqual(len(backend.fallback), 1)
+
+    async def test_redis_rate_limit_cooldown(self):
+        now = [100.0]
+        backend = RedisRateLimitBackend(fakeredis.FakeAsyncRedis(server=self.server), cooldown=5, clock=lambda: now[0])
+        self.server.connected = False
+        with patch.object(backend, "script", wraps=backend.script) as script, \
+                self.assertLogs("src.services.custom_limiter", "ERROR") as logs:
+            for _ in range(3):
+                await backend.hit("ip:/", 10, 60)
+            self.assertEqual(script.call_count, 1)
+            self.assertEqual(len(logs.output), 1)
+            self.server.connected = True
+            now[0] += 5
+            result = await backend.hit("ip:/", 10, 60)
+            self.assertEqual(script.call_count, 2)
+        self.assertEqual(result.remaining, 9)